@@ -9,6 +9,8 @@ class PropertyAttribute(object):
   def __init__(self, name, rank):
     self.name = name
     self.rank = rank
+    # Position in ATTRIBUTES_RANKED, set once all attributes are known.
+    self.index = None
 
   def Render(self):
     return self.name
@@ -30,17 +32,90 @@ class PropertyAttributeWithValue(object):
 
 class PropertyAttributes(object):
   """Container for set of property attributes.
+
+  The values are kept in a list indexed by the position of the attribute in
+  ATTRIBUTES_RANKED, with None for the attributes that aren't set.
   """
 
-  def __init__(self, attrs):
-    self.attr_name_to_attr = dict((a.property_attribute.name, a) for a in attrs)
+  __slots__ = ('values', 'derived_inputs')
+
+  def __init__(self, attrs=()):
+    self.values = [None] * len(ATTRIBUTES_RANKED)
+    # Derived attribute index -> (input values, value) of its last evaluation.
+    self.derived_inputs = None
+    for a in attrs:
+      self.values[a.property_attribute.index] = a.value
 
   def Merge(self, attrs_other):
-    for a in attrs_other.attr_name_to_attr.values():
-      self.attr_name_to_attr[a.property_attribute.name] = a
+    """Overlays the attributes that are set in attrs_other.
+
+    Returns:
+      The set of names of the attributes whose values changed.
+    """
+    changed = set()
+    values = self.values
+    for i, o in enumerate(attrs_other.values):
+      if o is not None and o != values[i]:
+        values[i] = o
+        changed.add(ATTRIBUTES_RANKED[i].name)
+    return changed
+
+  def MergeMissing(self, attrs_other):
+    """Sets the attributes that are set in attrs_other but not in these
+    attributes, leaving the ones that are set untouched.
+
+    Returns:
+      The set of names of the attributes that were set.
+    """
+    changed = set()
+    values = self.values
+    for i, o in enumerate(attrs_other.values):
+      if o is not None and values[i] is None:
+        values[i] = o
+        changed.add(ATTRIBUTES_RANKED[i].name)
+    return changed
+
+  def UpdateDerivedAttributes(self, changed_names=None):
+    """Evaluates the derived attributes in dependency order.
+
+    A derived attribute is skipped when its inputs and its value are the same
+    as when it was last evaluated for this property.  A derived attribute that
+    fails to evaluate is logged and keeps its current value.
+
+    Args:
+      changed_names - If present, only the derived attributes that depend on
+                      these attributes, directly or through other derived
+                      attributes, are evaluated (e.g. the result of Merge()).
+    """
+    if changed_names is None:
+      derived = DERIVED_ATTRIBUTES_ORDERED
+    else:
+      affected = set()
+      for name in changed_names:
+        affected.update(DERIVED_DEPENDENTS.get(name, ()))
+      if not affected:
+        return
+      derived = [d for d in DERIVED_ATTRIBUTES_ORDERED if d.name in affected]
+
+    if self.derived_inputs is None:
+      self.derived_inputs = {}
+    values = self.values
+    for d in derived:
+      inputs = tuple(values[i] for i in d.input_indices)
+      last = self.derived_inputs.get(d.index)
+      if last and last[0] == inputs and last[1] == values[d.index]:
+        continue
+      try:
+        value = d.Apply(self)
+      except Exception, e:
+        print 'Failed computing %s: %r' % (d.name, e)
+        continue
+      values[d.index] = value
+      self.derived_inputs[d.index] = (inputs, value)
 
   def __repr__(self):
-    return '%s' % self.attr_name_to_attr.values()
+    return '%s' % ['%s: %s' % (ATTRIBUTES_RANKED[i].name, v)
+                   for i, v in enumerate(self.values) if v is not None]
 
   def RenderToSpreadsheet(self, cells):
     """Return the attributes in the form of spreadsheet cells.
@@ -50,13 +125,29 @@ class PropertyAttributes(object):
     for c in cells.values():
       c.value = ''
 
-    for i, a in enumerate(ATTRIBUTES_RANKED):
-      cells[i].value = self.GetValue(a.name)
+    for i, v in enumerate(self.values):
+      if v is not None:
+        cells[i].value = v
 
     return cells
 
+  def HasValue(self, attr_name):
+    return self.values[NAME_TO_INDEX[attr_name]] is not None
+
   def GetValue(self, attr_name):
-    return self.attr_name_to_attr[attr_name].value
+    value = self.values[NAME_TO_INDEX[attr_name]]
+    if value is None:
+      raise KeyError(attr_name)
+    return value
+
+  def SetValue(self, attr_name, value):
+    self.values[NAME_TO_INDEX[attr_name]] = value
+
+  def ToDict(self):
+    """Returns the attribute values as a dict of name -> value.
+    """
+    return dict((ATTRIBUTES_RANKED[i].name, v)
+                for i, v in enumerate(self.values) if v is not None)
 
 class FactParser(object):
 
@@ -72,18 +163,181 @@ class FactParser(object):
     if match:
       return match.group(1)
 
+class FactMatcher(object):
+  """Classifies fact strings against a list of FactParsers in a single pass.
+
+  Each parser's regex is indexed by its literal prefix, so a fact is only
+  matched against the parsers whose prefix it starts with, plus the parsers
+  without a literal prefix.  Parsers without a prefix are only run on facts
+  that contain the literal text their regex requires.  The results are the
+  same as trying every parser in order.
+  """
+
+  def __init__(self, fact_parsers):
+    self._fact_parsers = list(fact_parsers)
+    unprefixed = []
+    # First character of prefix -> [(parser index, prefix, literal, parser)]
+    char_to_prefixed = {}
+    for i, fp in enumerate(self._fact_parsers):
+      if fp.regex.flags & re.IGNORECASE:
+        prefix, literal = '', ''
+      else:
+        prefix, literal = _RequiredLiterals(fp.regex.pattern)
+      if prefix:
+        char_to_prefixed.setdefault(prefix[0], []).append(
+          (i, prefix, '', fp))
+      else:
+        unprefixed.append((i, '', literal, fp))
+
+    # First character of a fact -> candidate parsers, in registry order.
+    self._unprefixed = unprefixed
+    self._char_to_candidates = dict(
+      (c, sorted(prefixed + unprefixed))
+      for c, prefixed in char_to_prefixed.iteritems())
+
+  def Match(self, fact_string):
+    """Returns the (name, value) pairs of the parsers that match fact_string,
+    in registry order.
+    """
+    candidates = self._char_to_candidates.get(fact_string[:1], self._unprefixed)
+    matches = []
+    for _, prefix, literal, fp in candidates:
+      if fact_string.startswith(prefix) and literal in fact_string:
+        x = fp.Parse(fact_string)
+        if x:
+          matches.append((fp.name, x))
+    return matches
+
+  def MatchAll(self, facts_list):
+    """Returns a dict of name -> value for the provided facts, where a later
+    fact overrides an earlier one for the same name.
+    """
+    values = {}
+    for fact in facts_list:
+      for name, x in self.Match(fact):
+        values[name] = x
+    return values
+
+def _RequiredLiterals(pattern):
+  """Finds literal text that every match of a regex pattern must contain.
+
+  Only runs of plain characters outside of groups and character classes are
+  considered, and a character followed by a quantifier that allows zero
+  repetitions is not part of a run.
+
+  Returns:
+    A (prefix, literal) tuple: the literal text that every match starts with,
+    and the longest literal run that every match contains.  Either may be ''.
+  """
+  runs = []
+  run = []
+  run_start = 0
+  depth = 0
+  i = 0
+  while i < len(pattern):
+    c = pattern[i]
+    if c == '|' and depth == 0:
+      return '', ''
+    if c in '*?{' and depth == 0 and run:
+      run.pop()
+    if c == '\\' or c == '[' or c == '{' or c in '.^$*+?|()':
+      if run:
+        runs.append((run_start, ''.join(run)))
+      run = []
+      if c == '\\':
+        i += 1
+      elif c == '[':
+        i = pattern.find(']', i + 2)
+      elif c == '{':
+        i = pattern.find('}', i)
+      elif c == '(':
+        depth += 1
+      elif c == ')':
+        depth -= 1
+      if i < 0:
+        return '', ''
+    elif depth == 0:
+      if not run:
+        run_start = i
+      run.append(c)
+    i += 1
+  if run:
+    runs.append((run_start, ''.join(run)))
+
+  prefix = runs[0][1] if runs and runs[0][0] == 0 else ''
+  literal = max([r for _, r in runs] or [''], key=len)
+  return prefix, literal
+
 class DerivedAttribute(object):
+  """An attribute computed by fn from the values of the attributes named in
+  attrs, which may be other derived attributes.
+  """
 
   def __init__(self, name, rank, attrs, fn):
     self.name = name
     self.rank = rank
     self.attrs = attrs
     self.fn = fn
+    # Positions in ATTRIBUTES_RANKED of the inputs and of this attribute.
+    self.input_indices = None
+    self.index = None
 
-  def Apply(self):
-    """Applies the function to the static attributes.
+  def Apply(self, property_attributes):
+    """Applies the function to the current values of the input attributes of
+    the provided PropertyAttributes, with '' for the ones that aren't set.
     """
-    return 'blah'
+    values = property_attributes.values
+    return self.fn(*['' if values[i] is None else values[i]
+                     for i in self.input_indices])
+
+def _OrderDerivedAttributes(derived_attributes):
+  """Orders the derived attributes so that each one comes after the derived
+  attributes that it reads, keeping the given order otherwise.
+
+  Raises:
+    ValueError if the derived attributes depend on each other in a cycle.
+  """
+  name_to_derived = dict((d.name, d) for d in derived_attributes)
+  ordered = []
+  done = set()
+  visiting = []
+
+  def _Visit(d):
+    if d.name in done:
+      return
+    if d.name in visiting:
+      cycle = visiting[visiting.index(d.name):] + [d.name]
+      raise ValueError('Derived attributes depend on each other: %s' %
+                       ' -> '.join(cycle))
+    visiting.append(d.name)
+    for name in d.attrs:
+      if name in name_to_derived:
+        _Visit(name_to_derived[name])
+    visiting.pop()
+    done.add(d.name)
+    ordered.append(d)
+
+  for d in derived_attributes:
+    _Visit(d)
+  return ordered
+
+def _DerivedDependents(ordered_derived_attributes):
+  """Returns a dict of attribute name -> the set of names of the derived
+  attributes that depend on it, directly or through other derived attributes.
+  """
+  # Derived attribute name -> names of all the attributes it depends on.
+  depends_on = {}
+  for d in ordered_derived_attributes:
+    names = set(d.attrs)
+    for name in d.attrs:
+      names.update(depends_on.get(name, ()))
+    depends_on[d.name] = names
+
+  dependents = {}
+  for d in ordered_derived_attributes:
+    for name in depends_on[d.name]:
+      dependents.setdefault(name, set()).add(d.name)
+  return dependents
 
 ALL_FACT_PARSERS = [
   FactParser('built_year', 'Built in\s+(.*)', 103),
@@ -103,6 +357,8 @@ ALL_FACT_PARSERS = [
   FactParser('last_sold', 'Last sold: (.*)', 117),
 ]
 
+FACT_MATCHER = FactMatcher(ALL_FACT_PARSERS)
+
 ALL_DERIVED_ATTRIBUTES = [
   DerivedAttribute('price_indoor_sqft', 101, ['price_sqft_zillow', 'sqft', 'price', 'estimate'],
                    lambda p_z, sqft, p, e: SafeDivide(
@@ -136,6 +392,27 @@ ATTRIBUTES_RANKED = sorted(ALL_ATTRIBUTES, key=lambda x: x.rank)
 NAME_TO_ATTRIBUTE = dict(
   [(attr.name, attr) for attr in ATTRIBUTES_RANKED])
 
+for i, attr in enumerate(ATTRIBUTES_RANKED):
+  attr.index = i
+
+NAME_TO_INDEX = dict(
+  [(attr.name, attr.index) for attr in ATTRIBUTES_RANKED])
+
+for dp in ALL_DERIVED_ATTRIBUTES:
+  for name in dp.attrs:
+    if name not in NAME_TO_INDEX:
+      raise ValueError('Derived attribute %s reads unknown attribute %s' %
+                       (dp.name, name))
+  dp.input_indices = [NAME_TO_INDEX[name] for name in dp.attrs]
+  dp.index = NAME_TO_INDEX[dp.name]
+
+# The derived attributes in the order in which they're evaluated.
+DERIVED_ATTRIBUTES_ORDERED = _OrderDerivedAttributes(ALL_DERIVED_ATTRIBUTES)
+
+# Attribute name -> names of the derived attributes to reevaluate when it
+# changes.
+DERIVED_DEPENDENTS = _DerivedDependents(DERIVED_ATTRIBUTES_ORDERED)
+
 def FromName(attr_name, attr_value):
   """Creates an attribute from the name and value.
 
@@ -146,6 +423,16 @@ def FromName(attr_name, attr_value):
   return PropertyAttributeWithValue(NAME_TO_ATTRIBUTE[attr_name], attr_value) \
       if attr_name in NAME_TO_ATTRIBUTE else None
 
+def FromDict(attr_values):
+  """Creates a PropertyAttributes from a dict of name -> value, ignoring names
+  that aren't known attributes.
+  """
+  property_attributes = PropertyAttributes()
+  for name, value in attr_values.iteritems():
+    if name in NAME_TO_INDEX:
+      property_attributes.values[NAME_TO_INDEX[name]] = value
+  return property_attributes
+
 def RenderHeaderToSpreadsheet(header_cells):
   for h in header_cells.values():
     h.value = ''
@@ -0,0 +1,14 @@
+"""Offline benchmarks for the data updater.
+
+Run them from the data_updater directory, e.g.:
+
+  python -m benchmarks.bench_facts
+
+or run all of them and save the results, to compare them across commits:
+
+  python -m benchmarks.run_all --output new.json
+  python -m benchmarks.compare base.json new.json
+
+The listing pages come from the corpus/ directory and the sheets from
+fake_gspread, so no network access or credentials are needed.
+"""
@@ -0,0 +1,179 @@
+"""Benchmarks for extracting the property attributes from listing pages,
+with the full parse tree and with the partial one, and from the responses of
+the Zillow API, and of the pages on the fetch threads and on an
+ExtractPool.
+
+  python -m benchmarks.bench_extract               # Check parity, then time.
+  python -m benchmarks.bench_extract --check_only  # Only check parity.
+
+The parity of the partial parse is checked on the corpus and on the recorded
+Zillow pages in corpus/recorded/ (see benchmarks.record_corpus).
+"""
+
+import multiprocessing
+from multiprocessing import pool as thread_pool
+import optparse
+
+from benchmarks import bench_util
+from benchmarks import pages
+import attributes
+import extract_pool
+import zillow_api_wrapper as zaw
+import zillow_xml_api
+
+def CheckParity(corpus):
+  """Checks, attribute by attribute, that the partial parse extracts the same
+  value as the full parse from every page of the corpus.
+
+  Returns:
+    A dict from the name of each attribute to the number of pages from which
+    the full parse extracted a value for it, i.e. on which the attribute was
+    checked.
+
+  Raises:
+    AssertionError listing every page and attribute with a different value.
+  """
+  covered = dict((a.name, 0) for a in attributes.ATTRIBUTES_RANKED)
+  mismatches = []
+  for zpid, body in corpus:
+    full = _ParseToDict(body, partial_parse=False)
+    partial = _ParseToDict(body, partial_parse=True)
+    if 'error' in full or 'error' in partial:
+      if full != partial:
+        mismatches.append('%s: %s != %s' % (
+          zpid, partial.get('error', 'extracted'),
+          full.get('error', 'extracted')))
+      continue
+    for name in sorted(set(full) | set(partial)):
+      if full.get(name) != partial.get(name):
+        mismatches.append('%s %s: %r != %r' % (
+          zpid, name, partial.get(name), full.get(name)))
+      if full.get(name):
+        covered[name] = covered.get(name, 0) + 1
+  if mismatches:
+    raise AssertionError('Partial parse mismatches (partial != full):\n  ' +
+                         '\n  '.join(mismatches))
+  return covered
+
+def _ParseToDict(body, partial_parse):
+  """Returns the attribute values extracted from a page, or a dict with the
+  error under 'error' if none could be.
+  """
+  try:
+    return zaw.ParseZillowPage(body, partial_parse=partial_parse).ToDict()
+  except zaw.ZillowParseError, e:
+    return {'error': str(e)}
+
+def CheckXmlKeepsSheetValues(corpus, responses):
+  """Checks that when the deep search of the XML API fails, merging the
+  property details into a sheet row keeps the row's values for the
+  attributes that the details lack, such as the Zestimate.  The values that
+  the home details page of each listing has stand in for the sheet row.
+
+  Returns:
+    The number of listings checked.
+  """
+  pages_by_zpid = dict(corpus)
+  for zpid, details_xml, _ in responses:
+    sheet_values = zaw.ParseZillowPage(pages_by_zpid[zpid]).ToDict()
+    _, _, details = zillow_xml_api._ParseResponse(details_xml, 'response')
+    # The attributes that the response has no element for; the details never
+    # have the Zestimate or the last sale.
+    lacking = ['estimate', 'last_sold'] + [
+      name for name, path, _ in zillow_xml_api._DETAILS_FIELDS
+      if not details[0].get(path)]
+
+    merged = attributes.FromDict(sheet_values)
+    merged.Merge(attributes.FromDict(
+      zillow_xml_api._DetailsValues(details[0])))
+    merged_values = merged.ToDict()
+    for name in lacking:
+      if merged_values.get(name) != sheet_values.get(name):
+        raise AssertionError('%s of %s not kept: %r != %r' % (
+          name, zpid, merged_values.get(name), sheet_values.get(name)))
+  return len(responses)
+
+# The number of threads that hand pages to be parsed, like fetch threads.
+_NUM_THREADS = 8
+
+def Run(n=5):
+  corpus = pages.LoadCorpus()
+  CheckParity(corpus + pages.LoadRecordedCorpus())
+  responses = pages.LoadApiResponses()
+  CheckXmlKeepsSheetValues(corpus, responses)
+
+  def _ParseAll(partial_parse):
+    for _, body in corpus:
+      zaw.ParseZillowPage(body, partial_parse=partial_parse)
+
+  def _ParseAllXml():
+    for _, details_xml, search_xml in responses:
+      _, _, details = zillow_xml_api._ParseResponse(details_xml, 'response')
+      values = zillow_xml_api._DetailsValues(details[0])
+      _, _, results = zillow_xml_api._ParseResponse(
+        search_xml, 'response/results/result')
+      zillow_xml_api._AddSearchValues(results[0], values)
+
+  # Enough pages to keep every process busy.
+  bodies = [body for _, body in corpus] * max(
+    2, 2 * multiprocessing.cpu_count() // len(corpus))
+  pool = extract_pool.ExtractPool()
+  threads = thread_pool.ThreadPool(_NUM_THREADS)
+  try:
+    extract_results = [
+      bench_util.Time('extract.threads',
+                      lambda: threads.map(zaw.ParseZillowPage, bodies), n,
+                      items_per_call=len(bodies)),
+      bench_util.Time('extract.pool',
+                      lambda: threads.map(pool.Extract, bodies), n,
+                      items_per_call=len(bodies)),
+    ]
+    extract_results[-1]['processes'] = pool.num_processes
+  finally:
+    threads.close()
+    pool.Close()
+
+  parse_results = [
+    bench_util.Time('extract.full_parse', lambda: _ParseAll(False), n,
+                    items_per_call=len(corpus)),
+    bench_util.Time('extract.partial_parse', lambda: _ParseAll(True), n,
+                    items_per_call=len(corpus)),
+  ]
+  for result in parse_results:
+    result['pages_per_sec'] = 1e6 / result['us_per_op']
+  return extract_results + parse_results + [
+    bench_util.Time('extract.xml_api', _ParseAllXml, n,
+                    items_per_call=len(responses)),
+  ]
+
+def _ParseArgs():
+  parser = optparse.OptionParser()
+  parser.add_option('--check_only', action='store_true', default=False,
+                    help='Only check that the partial parse extracts the '
+                         'same attributes as the full parse, and that the '
+                         'XML API backend keeps the sheet values that it '
+                         'lacks.')
+  options, _ = parser.parse_args()
+  return options
+
+if __name__ == '__main__':
+  options = _ParseArgs()
+  if options.check_only:
+    corpus = pages.LoadCorpus()
+    recorded = pages.LoadRecordedCorpus()
+    covered = CheckParity(corpus + recorded)
+    print ('Partial parse matches the full parse on %d pages (%d recorded)' %
+           (len(corpus) + len(recorded), len(recorded)))
+    unchecked = sorted(name for name, count in covered.iteritems()
+                       if not count)
+    if unchecked:
+      print 'Attributes without a value on any page: %s' % (
+        ', '.join(unchecked))
+    print 'XML API details keep the sheet values on %d listings' % (
+      CheckXmlKeepsSheetValues(corpus, pages.LoadApiResponses()))
+  else:
+    results = Run()
+    bench_util.PrintResults(results)
+    for r in results:
+      if 'pages_per_sec' in r:
+        print '%-40s %10.1f pages/s' % (r['name'], r['pages_per_sec'])
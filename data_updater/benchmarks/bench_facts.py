@@ -0,0 +1,52 @@
+"""Microbenchmarks for classifying the facts list of a listing page.
+"""
+
+import attributes
+from benchmarks import bench_util
+
+# The facts list of a typical listing, as scraped from the page.
+SAMPLE_FACTS = [
+  'Single Family',
+  'Built in 1923',
+  'Lot: 5,544 sqft',
+  '111 days on Zillow',
+  'Views: 1,260',
+  '12 shoppers saved this home',
+  'Price/sqft: $601',
+  'MLS # 214563',
+  'Parking: Garage - Attached',
+  'Stories: 2',
+  'Floor size: 1,800 sqft',
+  'Cooling: Central',
+  'Heating: Forced air',
+  'Last remodel year: 2004',
+  'Room count: 7',
+  'Last sold: Jun 2010 for $500,000',
+]
+
+def _MatchAllParsers(facts_list):
+  """The reference classification: every parser against every fact.
+  """
+  values = {}
+  for fact in facts_list:
+    for parser in attributes.ALL_FACT_PARSERS:
+      x = parser.Parse(fact)
+      if x:
+        values[parser.name] = x
+  return values
+
+def Run(n=2000):
+  expected = _MatchAllParsers(SAMPLE_FACTS)
+  actual = attributes.FACT_MATCHER.MatchAll(SAMPLE_FACTS)
+  if actual != expected:
+    raise AssertionError('FactMatcher mismatch: %r != %r' % (actual, expected))
+
+  return [
+    bench_util.Time('facts.all_parsers', lambda: _MatchAllParsers(SAMPLE_FACTS),
+                    n),
+    bench_util.Time('facts.fact_matcher',
+                    lambda: attributes.FACT_MATCHER.MatchAll(SAMPLE_FACTS), n),
+  ]
+
+if __name__ == '__main__':
+  bench_util.PrintResults(Run())
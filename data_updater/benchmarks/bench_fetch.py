@@ -0,0 +1,80 @@
+"""Benchmarks of the fetch path against a local fake_listing_server.
+
+The server runs in its own process, so that it doesn't compete with the
+fetches for the interpreter lock.  Each scenario fetches the same number of
+pages with the updater's worker pool, and reports the throughput along with
+the latency percentiles and status counts recorded by the tracing module.
+"""
+
+import contextlib
+import os
+import subprocess
+import sys
+
+from benchmarks import bench_util
+import net_util
+import tracing
+import updater
+
+_SERVER_PATH = os.path.join(
+  os.path.dirname(os.path.dirname(os.path.abspath(__file__))),
+  'fake_listing_server.py')
+
+# Scenario name -> extra fake_listing_server arguments.
+_SCENARIOS = [
+  ('fetch.clean', []),
+  ('fetch.faults', ['--error_rate', '0.05', '--throttle_rate', '0.02',
+                    '--reset_rate', '0.01', '--drip_rate', '0.02']),
+]
+
+@contextlib.contextmanager
+def RunServer(args):
+  """Runs a fake_listing_server with the given arguments within the block.
+
+  Yields:
+    The base URL of the server.
+  """
+  server = subprocess.Popen(
+    [sys.executable, _SERVER_PATH, '--port', '0'] + list(args),
+    stdout=subprocess.PIPE)
+  try:
+    line = server.stdout.readline()
+    if not line.startswith('Serving on '):
+      raise RuntimeError('fake_listing_server failed to start')
+    yield line.split()[-1]
+  finally:
+    server.terminate()
+    server.wait()
+
+def Run(num_fetches=500, num_workers=8, latency='lognormal:50,0.5',
+        timeout_secs=10):
+  results = []
+  for name, args in _SCENARIOS:
+    with RunServer(['--latency', latency, '--seed', '1'] + args) as base_url:
+      zpids = [str(zpid) for zpid in xrange(num_fetches)]
+
+      def _Fetch(zpid):
+        return net_util.GenericFetchFromUrlToString(
+          '%s/homedetails/%s_zpid/' % (base_url, zpid),
+          timeout_secs=timeout_secs)
+
+      tracing.Enable()
+      try:
+        result = bench_util.Time(
+          name,
+          lambda: updater._FetchConcurrently(zpids, _Fetch, num_workers),
+          1, repeat=1, items_per_call=num_fetches)
+        for p in (50, 90, 99):
+          result['p%d_ms' % p] = tracing.Percentile('http.latency_ms', p)
+        result['counters'] = tracing.Counters()
+      finally:
+        tracing.Disable()
+    results.append(result)
+  return results
+
+if __name__ == '__main__':
+  results = Run()
+  bench_util.PrintResults(results)
+  for r in results:
+    print '%-40s p50 %.1f ms, p90 %.1f ms, p99 %.1f ms' % (
+      r['name'], r['p50_ms'], r['p90_ms'], r['p99_ms'])
@@ -0,0 +1,97 @@
+"""Benchmarks of the time to import the updater's modules, each in a fresh
+interpreter, and a check that the slow dependencies are only imported when
+they're first used.
+"""
+
+import json
+import optparse
+import os
+import subprocess
+import sys
+
+# The modules whose import time is measured.
+_MODULES = ['updater', 'zillow_api_wrapper', 'net_util']
+
+# The modules that importing any of _MODULES must not import, as they're slow
+# to import and are imported by the code that needs them.
+_DEFERRED_MODULES = [
+  'BaseHTTPServer',
+  'SimpleHTTPServer',
+  'SocketServer',
+  'bs4',
+  'email.utils',
+  'gspread',
+  'mimetypes',
+  'multiprocessing',
+  'oauth2client',
+  'subprocess',
+  'xml.etree.cElementTree',
+]
+
+# Run in the child interpreter; prints the import time and the loaded modules.
+_CHILD_SCRIPT = '''
+import json, sys, time
+start = time.time()
+__import__(%r)
+secs = time.time() - start
+print json.dumps({'secs': secs,
+                  'modules': sorted(m for m, v in sys.modules.items() if v)})
+'''
+
+_DATA_UPDATER_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+def _ImportInChild(module):
+  """Imports module in a new interpreter.
+
+  Returns:
+    A (seconds, list of loaded module names) tuple.
+  """
+  output = subprocess.check_output(
+    [sys.executable, '-c', _CHILD_SCRIPT % module], cwd=_DATA_UPDATER_DIR)
+  result = json.loads(output.strip().splitlines()[-1])
+  return result['secs'], result['modules']
+
+def Run(modules=_MODULES, repeat=5):
+  """
+  Args:
+    modules - The names of the modules to import.
+    repeat - The number of fresh interpreters in which each module is
+             imported; the fastest import is kept.
+
+  Raises:
+    AssertionError if importing a module imports any of _DEFERRED_MODULES.
+  """
+  results = []
+  for module in modules:
+    best_secs = None
+    for _ in xrange(repeat):
+      secs, loaded = _ImportInChild(module)
+      best_secs = secs if best_secs is None else min(best_secs, secs)
+
+    deferred = sorted(set(loaded) & set(_DEFERRED_MODULES))
+    if deferred:
+      raise AssertionError('Importing %s imports %s' %
+                           (module, ', '.join(deferred)))
+    results.append({
+      'name': 'import.%s' % module,
+      'n': 1,
+      'secs': best_secs,
+      'us_per_op': best_secs * 1e6,
+      'modules_loaded': len(loaded),
+    })
+  return results
+
+def _ParseArgs():
+  parser = optparse.OptionParser()
+  parser.add_option('--modules', default=','.join(_MODULES),
+                    help='Comma-separated names of the modules to import.')
+  parser.add_option('--repeat', type='int', default=5,
+                    help='Fresh interpreters per module.')
+  options, _ = parser.parse_args()
+  return options
+
+if __name__ == '__main__':
+  from benchmarks import bench_util
+  options = _ParseArgs()
+  bench_util.PrintResults(Run(modules=options.modules.split(','),
+                              repeat=options.repeat))
@@ -0,0 +1,56 @@
+"""Benchmarks for converting between sheet cells and Property objects.
+"""
+
+from benchmarks import bench_util
+from benchmarks import fake_gspread
+from benchmarks import pages
+import google_sheets_wrapper as gsw
+import property
+
+def CheckLoadsEveryRow(max_rows_per_read=4):
+  """Checks that LoadSpreadsheet() and IterRows() return every non-empty row
+  of a sheet whose first column has an empty cell, and whose grid has empty
+  rows after the last row with values.
+
+  Returns:
+    The number of rows checked.
+  """
+  rows = pages.SheetRows(10)
+  rows[3][0] = ''
+  worksheet = fake_gspread.FakeWorksheet('Buy', rows,
+                                         row_count=len(rows) + 5)
+  gsw.UseClient(fake_gspread.FakeClient([
+    fake_gspread.FakeSpreadsheet('Real Estate', [worksheet])]))
+
+  expected = range(len(rows))
+  loaded = sorted(gsw.LoadSpreadsheet('Real Estate', 'Buy',
+                                      max_rows_per_read=max_rows_per_read))
+  iterated = [row for row, _ in gsw.IterRows(worksheet, max_rows_per_read)]
+  for name, actual in (('LoadSpreadsheet', loaded), ('IterRows', iterated)):
+    if actual != expected:
+      raise AssertionError('%s returned rows %r instead of %r' %
+                           (name, actual, expected))
+  return len(rows)
+
+def Run(sizes=(100, 1000, 10000)):
+  CheckLoadsEveryRow()
+  corpus = pages.LoadCorpus()
+  results = []
+  for num_rows in sizes:
+    rows = pages.SheetRows(num_rows, corpus)
+    worksheet = fake_gspread.FakeWorksheet('Buy', rows)
+    all_cells = gsw.ReadCells(worksheet, 1, len(rows) + 1)
+    properties = property.ParseFromSpreadsheet(all_cells)
+
+    results.append(bench_util.Time(
+      'sheets.parse.%d' % num_rows,
+      lambda: property.ParseFromSpreadsheet(all_cells), 1,
+      items_per_call=num_rows))
+    results.append(bench_util.Time(
+      'sheets.render.%d' % num_rows,
+      lambda: property.RenderToSpreadsheet(properties, all_cells), 1,
+      items_per_call=num_rows))
+  return results
+
+if __name__ == '__main__':
+  bench_util.PrintResults(Run())
@@ -0,0 +1,156 @@
+"""End-to-end benchmarks of updater.UpdateSheet() and
+updater.StreamUpdateSheet() against fake sheets, with the listing pages served
+from the corpus instead of Zillow.
+
+Besides the time of each update, the time until its first cells were written
+is reported as a '<name>.first_write' result: the streaming update writes its
+first batch long before the batch update, which writes once every property
+is fetched, even though both take about as long overall.  Parsing the fetched
+pages dominates both, so each update runs once.
+"""
+
+import contextlib
+import optparse
+import re
+import time
+
+from benchmarks import bench_util
+from benchmarks import fake_gspread
+from benchmarks import pages
+import google_sheets_wrapper as gsw
+from misc_util import Bunch
+import net_util
+import updater
+import zillow_api_wrapper as zaw
+
+# The number of properties fetched per run, like a refresh budget.
+_MAX_FETCHES = 100
+
+# The number of rows of the extra run in which every property is fetched.
+_ALL_FETCHED_ROWS = 200
+
+_ZPID_RE = re.compile(r'/homedetails/(\d+)_zpid/')
+
+@contextlib.contextmanager
+def ServeCorpus(corpus):
+  """Serves the home details pages from the corpus within the block, in place
+  of fetching them.
+  """
+  def _Fetch(url, **kwargs):
+    body = pages.CorpusPageForZpid(_ZPID_RE.search(url).group(1), corpus)
+    return Bunch(status_code=200, final_url=url, headers=None, body=body,
+                 cache_status=None)
+
+  fetch = net_util.GenericFetchFromUrlToString
+  net_util.GenericFetchFromUrlToString = _Fetch
+  try:
+    yield
+  finally:
+    net_util.GenericFetchFromUrlToString = fetch
+
+def _InstallSheets(rows):
+  """Installs a fake client whose spreadsheet splits rows over the sheets
+  that the updater writes.
+
+  Returns:
+    A (FakeClient, list of FakeWorksheets) tuple.
+  """
+  header, properties = rows[0], rows[1:]
+  num_sheets = len(updater._SHEET_NAMES)
+  worksheets = [
+    fake_gspread.FakeWorksheet(name, [header] + properties[i::num_sheets])
+    for i, name in enumerate(updater._SHEET_NAMES)]
+  client = fake_gspread.FakeClient([
+    fake_gspread.FakeSpreadsheet(updater._SPREADSHEET_NAME, worksheets)])
+  gsw.UseClient(client)
+  return client, worksheets
+
+def Run(sizes=(100, 1000, 10000), max_fetches=_MAX_FETCHES,
+        modes=('batch', 'stream'), all_fetched_rows=_ALL_FETCHED_ROWS,
+        repeat=1):
+  """
+  Args:
+    sizes - The numbers of sheet rows to update.
+    max_fetches - The number of properties fetched per run, or None to fetch
+                  all of them.
+    modes - 'batch' to run UpdateSheet() and 'stream' to run
+            StreamUpdateSheet().
+    all_fetched_rows - If present, the number of rows of an extra run, named
+                       '<mode>.<rows>.all', in which every property is
+                       fetched.
+    repeat - The number of times each update runs; the fastest run is kept.
+  """
+  corpus = pages.LoadCorpus()
+  zaw.Initialize()
+  runs = [(num_rows, max_fetches, '') for num_rows in sizes]
+  if all_fetched_rows:
+    runs.append((all_fetched_rows, None, '.all'))
+
+  results = []
+  for mode in modes:
+    update_fn = (updater.StreamUpdateSheet if mode == 'stream'
+                 else updater.UpdateSheet)
+    prefix = 'update_stream' if mode == 'stream' else 'update'
+    for num_rows, run_max_fetches, suffix in runs:
+      name = '%s.%d%s' % (prefix, num_rows, suffix)
+      rows = pages.SheetRows(num_rows, corpus)
+      clients = []
+      worksheets = []
+      first_write_secs = []
+
+      def _Setup():
+        client, worksheets[:] = _InstallSheets(rows)
+        clients[:] = [client]
+
+      def _Update():
+        start = time.time()
+        with bench_util.Quiet():
+          update_fn(max_requests_per_sec=None, max_fetches=run_max_fetches)
+        write_times = [w.first_write_time for w in worksheets
+                       if w.first_write_time is not None]
+        if write_times:
+          first_write_secs.append(min(write_times) - start)
+
+      with ServeCorpus(corpus):
+        result = bench_util.Time(name, _Update, 1, repeat=repeat,
+                                 items_per_call=num_rows, setup=_Setup)
+      result['fetches'] = min(num_rows, run_max_fetches or num_rows)
+      result['sheet_requests'] = (clients[0].NumRequests() +
+                                  sum(w.num_requests for w in worksheets))
+      result['cells_written'] = sum(w.num_cells_written for w in worksheets)
+      results.append(result)
+      if first_write_secs:
+        secs = min(first_write_secs)
+        results.append({
+          'name': name + '.first_write',
+          'n': 1,
+          'secs': secs,
+          'us_per_op': secs * 1e6,
+        })
+  return results
+
+def _ParseArgs():
+  parser = optparse.OptionParser()
+  parser.add_option('--sizes', default='100,1000,10000',
+                    help='Comma-separated numbers of sheet rows.')
+  parser.add_option('--max_fetches', type='int', default=_MAX_FETCHES,
+                    help='Properties fetched per run (0 to fetch all).')
+  parser.add_option('--modes', default='batch,stream',
+                    help='Comma-separated update modes: batch and stream.')
+  parser.add_option('--all_fetched_rows', type='int',
+                    default=_ALL_FETCHED_ROWS,
+                    help='Rows of the extra run that fetches every property '
+                         '(0 to skip it).')
+  parser.add_option('--repeat', type='int', default=1,
+                    help='Runs per update; the fastest is kept.')
+  options, _ = parser.parse_args()
+  return options
+
+if __name__ == '__main__':
+  options = _ParseArgs()
+  bench_util.PrintResults(Run(
+    sizes=[int(s) for s in options.sizes.split(',')],
+    max_fetches=options.max_fetches or None,
+    modes=options.modes.split(','),
+    all_fetched_rows=options.all_fetched_rows,
+    repeat=options.repeat))
@@ -0,0 +1,57 @@
+"""Helpers shared by the benchmarks.
+"""
+
+import contextlib
+import os
+import sys
+import time
+
+def Time(name, fn, n, repeat=3, items_per_call=1, setup=None):
+  """Times n calls of fn, keeping the best of repeat rounds.
+
+  Args:
+    name - The name of the benchmark.
+    fn - The function to time.
+    n - The number of calls per round.
+    repeat - The number of rounds.
+    items_per_call - The number of items (e.g. rows) that each call processes.
+    setup - If present, a function that is called, untimed, before each round.
+
+  Returns:
+    A dict with the benchmark name, n, the total seconds and the microseconds
+    per item.
+  """
+  best_secs = None
+  for _ in xrange(repeat):
+    if setup:
+      setup()
+    start = time.time()
+    for _ in xrange(n):
+      fn()
+    secs = time.time() - start
+    if best_secs is None or secs < best_secs:
+      best_secs = secs
+  return {
+    'name': name,
+    'n': n * items_per_call,
+    'secs': best_secs,
+    'us_per_op': best_secs * 1e6 / (n * items_per_call),
+  }
+
+@contextlib.contextmanager
+def Quiet():
+  """Discards what is printed to stdout within the block, e.g. the progress
+  messages of the code under test.
+  """
+  stdout = sys.stdout
+  sys.stdout = open(os.devnull, 'w')
+  try:
+    yield
+  finally:
+    sys.stdout.close()
+    sys.stdout = stdout
+
+def PrintResults(results):
+  for r in results:
+    print '%-40s n=%-8d %10.3fs %12.2f us/op' % (
+      r['name'], r['n'], r['secs'], r['us_per_op'])
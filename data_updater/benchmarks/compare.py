@@ -0,0 +1,56 @@
+"""Compares two result files written by benchmarks.run_all.
+
+  python -m benchmarks.compare base.json new.json
+
+Exits with status 1 if any benchmark got slower by more than the threshold.
+"""
+
+import json
+import optparse
+import sys
+
+def Compare(base_run, new_run, threshold=1.1):
+  """Prints the change of each benchmark that is in both runs.
+
+  Returns:
+    The list of names of the benchmarks that got slower by more than the
+    threshold ratio.
+  """
+  base = dict((r['name'], r) for r in base_run['results'])
+  regressions = []
+  print '%-40s %12s %12s %8s' % ('benchmark', 'base us/op', 'new us/op',
+                                 'ratio')
+  for r in new_run['results']:
+    if r['name'] not in base:
+      continue
+    base_us = base[r['name']]['us_per_op']
+    ratio = r['us_per_op'] / base_us if base_us else float('inf')
+    if ratio > threshold:
+      regressions.append(r['name'])
+      mark = ' slower'
+    elif ratio < 1.0 / threshold:
+      mark = ' faster'
+    else:
+      mark = ''
+    print '%-40s %12.2f %12.2f %7.2fx%s' % (
+      r['name'], base_us, r['us_per_op'], ratio, mark)
+  return regressions
+
+def _ParseArgs():
+  parser = optparse.OptionParser(usage='%prog [options] BASE_JSON NEW_JSON')
+  parser.add_option('--threshold', type='float', default=1.1,
+                    help='Ratio of new to base time above which a benchmark '
+                         'counts as slower.')
+  options, args = parser.parse_args()
+  if len(args) != 2:
+    parser.error('Expected two result files.')
+  return options, args
+
+if __name__ == '__main__':
+  options, (base_path, new_path) = _ParseArgs()
+  with open(base_path) as f:
+    base_run = json.load(f)
+  with open(new_path) as f:
+    new_run = json.load(f)
+  if Compare(base_run, new_run, options.threshold):
+    sys.exit(1)
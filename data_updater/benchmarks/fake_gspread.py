@@ -0,0 +1,157 @@
+"""An in-memory stand-in for the parts of the gspread API that
+google_sheets_wrapper uses, so that sheets can be loaded and written without
+credentials or network access.
+
+Install it with:
+
+  google_sheets_wrapper.UseClient(FakeClient([FakeSpreadsheet(...)]))
+"""
+
+import re
+import threading
+import time
+
+_LABEL_RE = re.compile(r'^([A-Z]+)(\d+)$')
+
+class FakeCell(object):
+  """A cell, as returned by Worksheet.range().
+  """
+  def __init__(self, row, col, value):
+    self.row = row
+    self.col = col
+    self.value = value
+
+  def __repr__(self):
+    return '<FakeCell R%sC%s %r>' % (self.row, self.col, self.value)
+
+class FakeWorksheet(object):
+  """A worksheet whose cell values are kept in a dict.
+
+  The number of requests and of cells read and written are counted, as is the
+  time of the first write, and each request can be made to take latency_secs,
+  like a round trip to the API.
+  """
+
+  def __init__(self, title, rows=(), latency_secs=0, row_count=None):
+    """
+    Args:
+      title - The name of the worksheet.
+      rows - The initial values, as a list of rows of values, starting with
+             row 1.
+      latency_secs - The time that each request takes.
+      row_count - The number of rows of the sheet's grid, which can be more
+                  than the rows with values.  Defaults to len(rows).
+    """
+    self.title = title
+    self.latency_secs = latency_secs
+    self.row_count = len(rows) if row_count is None else row_count
+    # (row, col) -> value, both 1-based.
+    self._values = {}
+    self._lock = threading.Lock()
+    for r, row in enumerate(rows):
+      for c, value in enumerate(row):
+        if value not in (None, ''):
+          self._values[(r + 1, c + 1)] = value
+    self.ResetCounters()
+
+  def ResetCounters(self):
+    self.num_requests = 0
+    self.num_cells_read = 0
+    self.num_cells_written = 0
+    # The time at which update_cells() was first called.
+    self.first_write_time = None
+
+  def range(self, label):
+    """Returns the cells of an 'A1:Z10' style range, row by row.
+    """
+    start, end = label.split(':')
+    start_row, start_col = _ParseLabel(start)
+    end_row, end_col = _ParseLabel(end)
+    self._Request()
+    cells = [FakeCell(r, c, self._values.get((r, c), ''))
+             for r in xrange(start_row, end_row + 1)
+             for c in xrange(start_col, end_col + 1)]
+    self.num_cells_read += len(cells)
+    return cells
+
+  def col_values(self, col):
+    """Returns the values of the non-empty cells of a column, in row order.
+    Like gspread 0.2.x, which reads the column from the cells feed that only
+    lists non-empty cells, the empty cells are left out rather than returned
+    as None, so the length isn't the extent of the column.
+    """
+    self._Request()
+    return [self._values[(r, c)] for (r, c) in sorted(self._values)
+            if c == col]
+
+  def update_cells(self, cells):
+    self._Request()
+    with self._lock:
+      if self.first_write_time is None:
+        self.first_write_time = time.time()
+      for c in cells:
+        if c.value in (None, ''):
+          self._values.pop((c.row, c.col), None)
+        else:
+          self._values[(c.row, c.col)] = c.value
+      self.num_cells_written += len(cells)
+
+  def Value(self, row, col):
+    """Returns the current value of a cell, '' if it's empty.
+    """
+    return self._values.get((row, col), '')
+
+  def _Request(self):
+    with self._lock:
+      self.num_requests += 1
+    if self.latency_secs:
+      time.sleep(self.latency_secs)
+
+class FakeSpreadsheet(object):
+  """A spreadsheet that counts its worksheet listings as requests.
+  """
+
+  def __init__(self, title, worksheets):
+    self.title = title
+    self._worksheets = list(worksheets)
+    self.num_requests = 0
+
+  @property
+  def sheet1(self):
+    return self._worksheets[0]
+
+  def worksheets(self):
+    self.num_requests += 1
+    return list(self._worksheets)
+
+  def worksheet(self, title):
+    return [w for w in self._worksheets if w.title == title][0]
+
+class FakeClient(object):
+  """A client that counts its opens as requests.
+  """
+
+  def __init__(self, spreadsheets):
+    self._spreadsheets = dict((s.title, s) for s in spreadsheets)
+    self.num_requests = 0
+
+  def open(self, title):
+    self.num_requests += 1
+    return self._spreadsheets[title]
+
+  def NumRequests(self):
+    """Returns the number of opens and of worksheet listings.
+    """
+    return self.num_requests + sum(
+      s.num_requests for s in self._spreadsheets.values())
+
+def _ParseLabel(label):
+  """Returns the 1-based (row, col) of an 'A1' style cell label.
+  """
+  match = _LABEL_RE.match(label)
+  if not match:
+    raise ValueError('Bad cell label: %s' % label)
+  col = 0
+  for ch in match.group(1):
+    col = col * 26 + ord(ch) - ord('A') + 1
+  return int(match.group(2)), col
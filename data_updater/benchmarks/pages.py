@@ -0,0 +1,81 @@
+"""The corpus of listing pages used by the benchmarks.
+
+The pages in corpus/ follow the markup of the Zillow home details pages that
+zillow_api_wrapper reads: the Facebook meta tags, the main content div with
+the address bar, price, Zestimate and facts, and the page chrome around it.
+Each file is named after the Zillow id of the listing.  Next to each page,
+<zpid>.details.xml and <zpid>.search.xml are the responses of the Zillow API
+(see zillow_xml_api) for the same listing.
+
+The pages in corpus/recorded/ are home details pages as served by Zillow,
+saved by benchmarks.record_corpus.  They're only used to check that the
+partial parse extracts the same attributes as the full parse, since their
+markup changes with every recording.
+"""
+
+import glob
+import os
+
+import attributes
+import zillow_api_wrapper as zaw
+
+CORPUS_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'corpus')
+RECORDED_DIR = os.path.join(CORPUS_DIR, 'recorded')
+
+def LoadCorpus(corpus_dir=CORPUS_DIR):
+  """Returns the list of (zpid, page HTML) pairs of the corpus, ordered by
+  zpid.
+  """
+  pages = []
+  for path in sorted(glob.glob(os.path.join(corpus_dir, '*.html'))):
+    zpid = os.path.splitext(os.path.basename(path))[0]
+    with open(path, 'rb') as f:
+      pages.append((zpid, f.read()))
+  return pages
+
+def LoadRecordedCorpus():
+  """Returns the list of (zpid, page HTML) pairs of the recorded pages,
+  ordered by zpid.
+  """
+  return LoadCorpus(RECORDED_DIR)
+
+def LoadApiResponses():
+  """Returns the list of (zpid, details XML, search XML) of the corpus
+  listings, ordered by zpid.
+  """
+  responses = []
+  for zpid, _ in LoadCorpus():
+    xml = []
+    for kind in ('details', 'search'):
+      with open(os.path.join(CORPUS_DIR, '%s.%s.xml' % (zpid, kind)),
+                'rb') as f:
+        xml.append(f.read())
+    responses.append((zpid,) + tuple(xml))
+  return responses
+
+def SheetRows(num_rows, corpus=None):
+  """Returns the rows of a sheet with num_rows properties, header first, as
+  they would be after an earlier update.
+
+  The properties cycle through the corpus listings, each with its own Zillow
+  id, from which CorpusPageForZpid() finds the listing again.  The
+  views and saved counts are left empty, so that refreshing a property
+  changes some of its cells.
+  """
+  corpus = corpus or LoadCorpus()
+  listings = [zaw.ParseZillowPage(body).ToDict() for _, body in corpus]
+  names = [a.name for a in attributes.ATTRIBUTES_RANKED]
+  rows = [names]
+  for i in xrange(num_rows):
+    values = dict(listings[i % len(listings)],
+                  zillow_id=str(_BASE_ZPID + i), views='', saved='')
+    rows.append([values.get(name, '') for name in names])
+  return rows
+
+def CorpusPageForZpid(zpid, corpus):
+  """Returns the corpus page of a property of SheetRows().
+  """
+  return corpus[(int(zpid) - _BASE_ZPID) % len(corpus)][1]
+
+# The Zillow id of the first property of SheetRows().
+_BASE_ZPID = 10000000
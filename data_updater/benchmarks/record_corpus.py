@@ -0,0 +1,63 @@
+"""Records home details pages from Zillow into corpus/recorded/, for the
+parity check of the partial parse in benchmarks.bench_extract.
+
+  python -m benchmarks.record_corpus --zpids 24838363,19557215
+
+Pages from which the full parse can't extract a property, e.g. captcha pages,
+are reported and not saved.
+"""
+
+import optparse
+import os
+
+from benchmarks import pages
+import net_util
+import zillow_api_wrapper as zaw
+
+def Record(zpids, output_dir=pages.RECORDED_DIR, max_requests_per_sec=1):
+  """Fetches the home details page of each of zpids and saves it as
+  <zpid>.html in output_dir.
+
+  Returns:
+    The list of zpids whose pages were saved.
+  """
+  if not os.path.isdir(output_dir):
+    os.makedirs(output_dir)
+  rate_limiter = net_util.HostRateLimiter(max_requests_per_sec)
+
+  recorded = []
+  for zpid in zpids:
+    zpid = zaw.NormalizeZpid(zpid)
+    c = zaw.FetchUrl(zaw._PropertyUrl(zpid), rate_limiter)
+    if c.status_code != 200:
+      print 'Not recording %s: HTTP %s (%r)' % (zpid, c.status_code, c.exc)
+      continue
+    try:
+      zaw.ParseZillowPage(c.body, partial_parse=False)
+    except zaw.ZillowParseError, e:
+      print 'Not recording %s: %s' % (zpid, e)
+      continue
+    with open(os.path.join(output_dir, '%s.html' % zpid), 'wb') as f:
+      f.write(c.body)
+    print 'Recorded %s (%d bytes)' % (zpid, len(c.body))
+    recorded.append(zpid)
+  return recorded
+
+def _ParseArgs():
+  parser = optparse.OptionParser()
+  parser.add_option('--zpids', default='',
+                    help='Comma-separated Zillow ids of the listings.')
+  parser.add_option('--output_dir', default=pages.RECORDED_DIR,
+                    help='Directory in which the pages are saved.')
+  parser.add_option('--max_requests_per_sec', type='float', default=1,
+                    help='Maximum request rate to Zillow.')
+  options, _ = parser.parse_args()
+  if not options.zpids:
+    parser.error('--zpids is required.')
+  return options
+
+if __name__ == '__main__':
+  options = _ParseArgs()
+  zaw.Initialize()
+  Record(options.zpids.split(','), options.output_dir,
+         options.max_requests_per_sec)
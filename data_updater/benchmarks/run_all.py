@@ -0,0 +1,75 @@
+"""Runs the benchmarks and writes their results as JSON, so that runs at
+different commits can be compared with benchmarks.compare.
+
+  python -m benchmarks.run_all --output results.json
+"""
+
+import json
+import optparse
+import platform
+import subprocess
+import time
+
+from benchmarks import bench_extract
+from benchmarks import bench_facts
+from benchmarks import bench_fetch
+from benchmarks import bench_import
+from benchmarks import bench_sheets
+from benchmarks import bench_update
+from benchmarks import bench_util
+
+# Benchmark name -> module with a Run() function.
+BENCHMARKS = [
+  ('facts', bench_facts),
+  ('extract', bench_extract),
+  ('sheets', bench_sheets),
+  ('update', bench_update),
+  ('fetch', bench_fetch),
+  ('import', bench_import),
+]
+
+def RunAll(names=None):
+  """Runs the named benchmarks, or all of them.
+
+  Returns:
+    A dict with the commit, the Python version, the time of the run and the
+    list of results.
+  """
+  results = []
+  for name, module in BENCHMARKS:
+    if names is None or name in names:
+      results.extend(module.Run())
+  return {
+    'commit': _GitCommit(),
+    'python': platform.python_version(),
+    'timestamp': int(time.time()),
+    'results': results,
+  }
+
+def _GitCommit():
+  """Returns the current git commit, or None if it can't be found.
+  """
+  try:
+    return subprocess.check_output(
+      ['git', 'rev-parse', 'HEAD'], stderr=subprocess.STDOUT).strip()
+  except (OSError, subprocess.CalledProcessError):
+    return None
+
+def _ParseArgs():
+  parser = optparse.OptionParser()
+  parser.add_option('--benchmarks', default=None,
+                    help='Comma-separated names of the benchmarks to run '
+                         '(default: all of %s).' %
+                         ', '.join(name for name, _ in BENCHMARKS))
+  parser.add_option('--output', default=None,
+                    help='File to which the results are written as JSON.')
+  options, _ = parser.parse_args()
+  return options
+
+if __name__ == '__main__':
+  options = _ParseArgs()
+  run = RunAll(options.benchmarks and options.benchmarks.split(','))
+  bench_util.PrintResults(run['results'])
+  if options.output:
+    with open(options.output, 'w') as f:
+      json.dump(run, f, indent=2, sort_keys=True)
@@ -0,0 +1,100 @@
+"""Extracts the property attributes from fetched pages on a pool of
+processes.
+
+Parsing a page with BeautifulSoup is CPU-bound and holds the GIL, so the
+fetch threads of a run can only parse about one page at a time between them.
+With an ExtractPool, the fetch threads only download the pages and hand the
+bodies to worker processes, which return the extracted attributes as plain
+dicts.  Those are turned back into PropertyAttributes in the parent, which
+evaluates the derived attributes, so that they're only evaluated once:
+
+  pool = extract_pool.ExtractPool(num_processes=16)
+  property_attributes = pool.Extract(body)   # From any thread.
+  pool.Close()
+
+The pool must be created before the fetch threads are started, since the
+worker processes are forked from the parent.
+"""
+
+import signal
+import threading
+
+import attributes
+import tracing
+import zillow_api_wrapper as zaw
+
+# The time after which an extraction is abandoned, e.g. if a worker process
+# died.
+_EXTRACT_TIMEOUT_SECS = 120
+
+class ExtractPool(object):
+  """A pool of processes that parse home details pages.  Thread-safe.
+  """
+
+  def __init__(self, num_processes=None, max_pending=None,
+               partial_parse=None):
+    """
+    Args:
+      num_processes - The number of worker processes; by default one per core.
+      max_pending - The maximum number of bodies queued for or being
+                    extracted; Extract() blocks while the queue is full, so
+                    that fetching doesn't run far ahead of extraction.  By
+                    default twice the number of processes.
+      partial_parse - The zaw.ParseZillowPage() parse mode; by default the
+                      mode set by zaw.Initialize().
+    """
+    # Imported here rather than by every run that imports the updater.
+    import multiprocessing
+
+    self.num_processes = num_processes or multiprocessing.cpu_count()
+    self.max_pending = max_pending or 2 * self.num_processes
+    self._partial_parse = partial_parse
+    self._pending = threading.BoundedSemaphore(self.max_pending)
+    self._pool = multiprocessing.Pool(self.num_processes,
+                                      initializer=_InitializeWorker)
+
+  def Extract(self, body):
+    """Extracts the property attributes from the HTML of a home details page
+    on a worker process, like zaw.ParseZillowPage().
+
+    Returns:
+      The PropertyAttributes of the property.
+
+    Raises:
+      ZillowParseError if the page could not be parsed.
+    """
+    with tracing.Span('extract.queue_wait'):
+      self._pending.acquire()
+    try:
+      result = self._pool.apply_async(_ExtractAttributeDict,
+                                      (body, self._partial_parse))
+      # With a timeout, so that the wait can be interrupted.
+      attr_values = result.get(_EXTRACT_TIMEOUT_SECS)
+    finally:
+      self._pending.release()
+
+    property_attributes = attributes.FromDict(attr_values)
+    with tracing.Span('parse.derive'):
+      property_attributes.UpdateDerivedAttributes()
+    return property_attributes
+
+  def Close(self):
+    """Stops the worker processes once the pending extractions are done.
+    """
+    self._pool.close()
+    self._pool.join()
+
+def _InitializeWorker():
+  # The parent handles interrupts, and the spans of the workers would be lost.
+  signal.signal(signal.SIGINT, signal.SIG_IGN)
+  tracing.Disable()
+
+def _ExtractAttributeDict(body, partial_parse):
+  """Runs on a worker process.
+
+  Returns:
+    The attribute values extracted from the page, without the derived
+    attributes, as a dict of name -> value.
+  """
+  return zaw.ParseZillowPage(body, partial_parse=partial_parse,
+                             derive=False).ToDict()
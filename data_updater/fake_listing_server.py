@@ -0,0 +1,374 @@
+"""A local stand-in for the Zillow home details pages and API, for load and
+fault-injection testing of the fetch path without network access.
+
+  python fake_listing_server.py --port 8080 --latency lognormal:80,0.6 \
+      --error_rate 0.02 --throttle_rate 0.01
+
+serves http://localhost:8080/homedetails/<zpid>_zpid/ from the pages of a
+corpus directory (by default the benchmark corpus).  A zpid without a page of
+its own is served one of the corpus pages, so any sheet can be pointed at the
+server with updater.py --zillow_base_url http://localhost:8080.
+
+The API endpoints that zillow_xml_api calls are served from the canned
+responses next to the pages: GET /webservice/GetUpdatedPropertyDetails.htm
+?zpid=<zpid> returns <zpid>.details.xml (of the same corpus listing as the
+page), and GET /webservice/GetDeepSearchResults.htm?address=<street> returns
+the <zpid>.search.xml whose request has that street.  Unknown properties get
+an API error, as from Zillow.
+
+Every response waits for a latency drawn from the configured distribution,
+and a configurable fraction of the requests fail with a 5xx, are throttled
+with a 429 and a Retry-After header, have their body dripped out slowly, or
+have their connection reset.  GET /_stats returns the number of responses of
+each kind as JSON.
+"""
+
+from BaseHTTPServer import BaseHTTPRequestHandler, HTTPServer
+from SocketServer import ThreadingMixIn
+import glob
+import json
+import math
+import optparse
+import os
+import random
+import re
+import socket
+import struct
+import sys
+import threading
+import time
+import urlparse
+import zlib
+
+_DEFAULT_CORPUS_DIR = os.path.join(
+  os.path.dirname(os.path.abspath(__file__)), 'benchmarks', 'corpus')
+
+_PATH_RE = re.compile(r'^/homedetails/(\d+)_zpid/?$')
+_API_PATH_RE = re.compile(r'^/webservice/(\w+)\.htm$')
+_SEARCH_ADDRESS_RE = re.compile(r'<request><address>(.*?)</address>')
+
+# The API error codes and messages of the failed requests.
+_API_NO_ZWS_ID = (2, 'Error: invalid or missing ZWSID parameter')
+_API_NO_MATCH = (508, 'Error: no exact match found for input address')
+_API_NO_DATA = (501, 'Error: no updated data found for the property')
+_API_UNKNOWN = (1, 'Error: unknown web service')
+
+_SERVER_ERROR_CODES = (500, 502, 503)
+
+# The size of the pieces of a dripped body.
+_DRIP_CHUNK_BYTES = 1024
+
+def ParseLatency(spec):
+  """Parses a latency distribution.
+
+  Args:
+    spec - One of 'fixed:MS', 'uniform:MIN_MS,MAX_MS', 'exponential:MEAN_MS'
+           or 'lognormal:MEDIAN_MS,SIGMA'.
+
+  Returns:
+    A function that takes a random.Random and returns a latency in seconds.
+
+  Raises:
+    ValueError if the spec is malformed.
+  """
+  kind, _, params = spec.partition(':')
+  try:
+    params = [float(p) for p in params.split(',')] if params else []
+  except ValueError:
+    raise ValueError('Bad latency spec: %s' % spec)
+
+  if kind == 'fixed' and len(params) == 1:
+    return lambda rng: params[0] / 1e3
+  if kind == 'uniform' and len(params) == 2:
+    return lambda rng: rng.uniform(params[0], params[1]) / 1e3
+  if kind == 'exponential' and len(params) == 1 and params[0] > 0:
+    return lambda rng: rng.expovariate(1.0 / params[0]) / 1e3
+  if kind == 'lognormal' and len(params) == 2 and params[0] > 0:
+    mu = math.log(params[0])
+    return lambda rng: rng.lognormvariate(mu, params[1]) / 1e3
+  raise ValueError('Bad latency spec: %s' % spec)
+
+class FakeListingServer(ThreadingMixIn, HTTPServer):
+  """Serves the corpus pages, injecting latency and faults.
+  """
+  daemon_threads = True
+  allow_reuse_address = True
+  request_queue_size = 128
+
+  def __init__(self, port=0, corpus_dir=_DEFAULT_CORPUS_DIR,
+               latency='fixed:0', error_rate=0, throttle_rate=0,
+               retry_after_secs=1, drip_rate=0, drip_bytes_per_sec=16384,
+               reset_rate=0, seed=None):
+    """
+    Args:
+      port - The port to listen on, or 0 for any free port (see self.port).
+      corpus_dir - The directory of <zpid>.html pages, and of the
+                   <zpid>.details.xml and <zpid>.search.xml API responses, to
+                   serve.
+      latency - The latency distribution of the responses (see
+                ParseLatency()).
+      error_rate - The fraction of requests that fail with a 500, 502 or 503.
+      throttle_rate - The fraction of requests that get a 429.
+      retry_after_secs - The Retry-After of the 429 responses.
+      drip_rate - The fraction of pages whose body is sent slowly.
+      drip_bytes_per_sec - The rate at which dripped bodies are sent.
+      reset_rate - The fraction of requests whose connection is reset
+                   without a response.
+      seed - If present, the seed of the random faults and latencies.
+    """
+    HTTPServer.__init__(self, ('127.0.0.1', port), _ListingRequestHandler)
+    self.port = self.server_address[1]
+    self.latency = ParseLatency(latency)
+    self.error_rate = error_rate
+    self.throttle_rate = throttle_rate
+    self.retry_after_secs = retry_after_secs
+    self.drip_rate = drip_rate
+    self.drip_bytes_per_sec = drip_bytes_per_sec
+    self.reset_rate = reset_rate
+
+    # zpid -> (page, gzipped page)
+    self._pages = {}
+    for path in sorted(glob.glob(os.path.join(corpus_dir, '*.html'))):
+      with open(path, 'rb') as f:
+        page = f.read()
+      zpid = os.path.splitext(os.path.basename(path))[0]
+      self._pages[zpid] = (page, _Gzip(page))
+    if not self._pages:
+      raise ValueError('No pages in %s' % corpus_dir)
+    self._zpids = sorted(self._pages)
+
+    # zpid -> (details XML, gzipped details XML)
+    self._details = {}
+    # lowercased street -> (search XML, gzipped search XML)
+    self._searches = {}
+    for zpid in self._zpids:
+      details_path = os.path.join(corpus_dir, '%s.details.xml' % zpid)
+      if os.path.exists(details_path):
+        with open(details_path, 'rb') as f:
+          details = f.read()
+        self._details[zpid] = (details, _Gzip(details))
+      search_path = os.path.join(corpus_dir, '%s.search.xml' % zpid)
+      if os.path.exists(search_path):
+        with open(search_path, 'rb') as f:
+          search = f.read()
+        match = _SEARCH_ADDRESS_RE.search(search)
+        if match:
+          self._searches[match.group(1).lower()] = (search, _Gzip(search))
+
+    self._random = random.Random(seed)
+    self._lock = threading.Lock()
+    # Kind of response -> count
+    self.stats = {}
+
+  def Page(self, zpid):
+    """Returns the (page, gzipped page) served for zpid.
+    """
+    if zpid in self._pages:
+      return self._pages[zpid]
+    return self._pages[self._zpids[int(zpid) % len(self._zpids)]]
+
+  def ApiResponse(self, name, params):
+    """Returns the (XML, gzipped XML) served for an API request.
+
+    Args:
+      name - The name of the endpoint, e.g. 'GetUpdatedPropertyDetails'.
+      params - The query parameters, as returned by urlparse.parse_qs().
+    """
+    param = lambda key: params.get(key, [''])[0]
+    if not param('zws-id'):
+      return _ApiError(*_API_NO_ZWS_ID)
+    if name == 'GetUpdatedPropertyDetails':
+      zpid = param('zpid')
+      if not zpid.isdigit():
+        return _ApiError(*_API_NO_DATA)
+      if zpid not in self._details:
+        zpid = self._zpids[int(zpid) % len(self._zpids)]
+      return self._details.get(zpid) or _ApiError(*_API_NO_DATA)
+    if name == 'GetDeepSearchResults':
+      return (self._searches.get(param('address').lower()) or
+              _ApiError(*_API_NO_MATCH))
+    return _ApiError(*_API_UNKNOWN)
+
+  def Draw(self):
+    """Draws the fate of a request.
+
+    Returns:
+      A (latency secs, fault) tuple, where fault is None or one of 'error',
+      'throttle', 'reset' or 'drip'.
+    """
+    with self._lock:
+      latency_secs = max(0, self.latency(self._random))
+      x = self._random.random()
+      fault = None
+      for name, rate in (('error', self.error_rate),
+                         ('throttle', self.throttle_rate),
+                         ('reset', self.reset_rate),
+                         ('drip', self.drip_rate)):
+        if x < rate:
+          fault = name
+          break
+        x -= rate
+      return latency_secs, fault
+
+  def RandomErrorCode(self):
+    with self._lock:
+      return self._random.choice(_SERVER_ERROR_CODES)
+
+  def Record(self, kind):
+    with self._lock:
+      self.stats[kind] = self.stats.get(kind, 0) + 1
+
+class _ListingRequestHandler(BaseHTTPRequestHandler):
+  protocol_version = 'HTTP/1.1'
+  # Buffer the writes, so that the headers and a small body go out together.
+  wbufsize = -1
+
+  def do_GET(self):
+    server = self.server
+    if self.path == '/_stats':
+      self._Respond(200, json.dumps(server.stats), 'application/json')
+      return
+
+    path, _, query = self.path.partition('?')
+    match = _PATH_RE.match(path)
+    api_match = _API_PATH_RE.match(path)
+    if not match and not api_match:
+      server.Record('not_found')
+      self._Respond(404, 'Not found', 'text/plain')
+      return
+
+    latency_secs, fault = server.Draw()
+    time.sleep(latency_secs)
+    server.Record(fault or 'ok')
+
+    if fault == 'error':
+      self._Respond(server.RandomErrorCode(), 'Server error', 'text/plain')
+    elif fault == 'throttle':
+      self._Respond(429, 'Too many requests', 'text/plain',
+                    {'Retry-After': str(server.retry_after_secs)})
+    elif fault == 'reset':
+      self._Reset()
+    else:
+      if match:
+        page, gzipped_page = server.Page(match.group(1))
+        content_type = 'text/html; charset=utf-8'
+      else:
+        page, gzipped_page = server.ApiResponse(api_match.group(1),
+                                                urlparse.parse_qs(query))
+        content_type = 'text/xml; charset=utf-8'
+      headers = {}
+      if 'gzip' in (self.headers.getheader('accept-encoding') or ''):
+        page = gzipped_page
+        headers['Content-Encoding'] = 'gzip'
+      drip_bytes_per_sec = server.drip_bytes_per_sec if fault == 'drip' \
+          else None
+      self._Respond(200, page, content_type, headers, drip_bytes_per_sec)
+
+  def _Respond(self, status_code, body, content_type, headers=None,
+               drip_bytes_per_sec=None):
+    self.send_response(status_code)
+    self.send_header('Content-Type', content_type)
+    self.send_header('Content-Length', str(len(body)))
+    for name, value in (headers or {}).iteritems():
+      self.send_header(name, value)
+    self.end_headers()
+    if not drip_bytes_per_sec:
+      self.wfile.write(body)
+      return
+
+    self.wfile.flush()
+    for i in xrange(0, len(body), _DRIP_CHUNK_BYTES):
+      self.wfile.write(body[i:i + _DRIP_CHUNK_BYTES])
+      self.wfile.flush()
+      time.sleep(float(_DRIP_CHUNK_BYTES) / drip_bytes_per_sec)
+
+  def _Reset(self):
+    """Closes the connection with a TCP reset instead of a response.
+    """
+    self.connection.setsockopt(socket.SOL_SOCKET, socket.SO_LINGER,
+                               struct.pack('ii', 1, 0))
+    self.close_connection = 1
+    self.connection.close()
+
+  def finish(self):
+    try:
+      BaseHTTPRequestHandler.finish(self)
+    except socket.error:
+      pass
+
+  def log_message(self, format, *args):
+    pass
+
+def _ApiError(code, text):
+  """Returns the (XML, gzipped XML) of an API error response.
+  """
+  error = ('<?xml version="1.0" encoding="utf-8"?>\n'
+           '<Error><message><text>%s</text><code>%d</code></message></Error>\n'
+           % (text, code))
+  return error, _Gzip(error)
+
+def _Gzip(data):
+  compressor = zlib.compressobj(6, zlib.DEFLATED, 16 + zlib.MAX_WBITS)
+  return compressor.compress(data) + compressor.flush()
+
+def Start(**kwargs):
+  """Starts a FakeListingServer on a background thread.
+
+  Args:
+    The FakeListingServer arguments.
+
+  Returns:
+    The server.  Its base URL is 'http://127.0.0.1:%d' % server.port, and it
+    is stopped with server.shutdown().
+  """
+  server = FakeListingServer(**kwargs)
+  thread = threading.Thread(target=server.serve_forever)
+  thread.setDaemon(True)
+  thread.start()
+  return server
+
+def _ParseArgs():
+  parser = optparse.OptionParser()
+  parser.add_option('--port', type='int', default=8080,
+                    help='Port to listen on (0 for any free port).')
+  parser.add_option('--corpus_dir', default=_DEFAULT_CORPUS_DIR,
+                    help='Directory of the <zpid>.html pages to serve.')
+  parser.add_option('--latency', default='fixed:0',
+                    help='Latency distribution: fixed:MS, uniform:MIN,MAX, '
+                         'exponential:MEAN or lognormal:MEDIAN,SIGMA.')
+  parser.add_option('--error_rate', type='float', default=0,
+                    help='Fraction of requests that fail with a 5xx.')
+  parser.add_option('--throttle_rate', type='float', default=0,
+                    help='Fraction of requests that get a 429.')
+  parser.add_option('--retry_after_secs', type='int', default=1,
+                    help='Retry-After of the 429 responses.')
+  parser.add_option('--drip_rate', type='float', default=0,
+                    help='Fraction of pages whose body is sent slowly.')
+  parser.add_option('--drip_bytes_per_sec', type='int', default=16384,
+                    help='Rate at which dripped bodies are sent.')
+  parser.add_option('--reset_rate', type='float', default=0,
+                    help='Fraction of requests whose connection is reset.')
+  parser.add_option('--seed', type='int', default=None,
+                    help='Seed of the random latencies and faults.')
+  options, _ = parser.parse_args()
+  return options
+
+if __name__ == '__main__':
+  options = _ParseArgs()
+  server = FakeListingServer(
+    port=options.port,
+    corpus_dir=options.corpus_dir,
+    latency=options.latency,
+    error_rate=options.error_rate,
+    throttle_rate=options.throttle_rate,
+    retry_after_secs=options.retry_after_secs,
+    drip_rate=options.drip_rate,
+    drip_bytes_per_sec=options.drip_bytes_per_sec,
+    reset_rate=options.reset_rate,
+    seed=options.seed)
+  print 'Serving on http://127.0.0.1:%d' % server.port
+  sys.stdout.flush()
+  try:
+    server.serve_forever()
+  except KeyboardInterrupt:
+    pass
@@ -0,0 +1,281 @@
+"""Retries and concurrency control for fetching many pages from one site.
+
+A FetchController wraps each fetch:
+
+  * Failed fetches (429, 5xx and connection errors) are retried with
+    exponential backoff and full jitter, or after the delay that the server
+    asks for with Retry-After.
+  * The number of fetches in flight is adapted AIMD-style: it grows by about
+    one per round trip while responses are fast, and is halved when the server
+    throttles (429 / 503), so that the fetches settle at the highest rate the
+    site sustains.
+  * A per-host circuit breaker stops fetching from a host after many failures
+    in a row, and lets a single probe through once it has cooled down.
+"""
+
+import random
+import threading
+import time
+import urlparse
+
+import tracing
+
+# The status codes after which a fetch is retried.
+_RETRY_STATUS_CODES = frozenset([429, 500, 502, 503, 504])
+
+# The status codes with which a server signals that it's overloaded.
+_THROTTLE_STATUS_CODES = frozenset([429, 503])
+
+class CircuitOpenError(IOError):
+  """Raised instead of fetching from a host whose circuit breaker is open.
+  """
+
+class FetchController(object):
+  """Retries fetches and limits their concurrency.  Thread-safe.
+  """
+
+  def __init__(self,
+               initial_concurrency=4,
+               min_concurrency=1,
+               max_concurrency=32,
+               max_tries=4,
+               base_backoff_secs=0.5,
+               max_backoff_secs=30.0,
+               latency_target_secs=2.0,
+               breaker_failure_threshold=10,
+               breaker_reset_secs=30.0):
+    """
+    Args:
+      initial_concurrency - The number of fetches allowed in flight at first.
+      min_concurrency, max_concurrency - The bounds of the number of fetches
+                                         in flight.
+      max_tries - The number of times a fetch is tried before its last result
+                  is returned.  At least 1.
+      base_backoff_secs - The backoff before the first retry; it doubles with
+                          every retry.
+      max_backoff_secs - The bound on the backoff, including Retry-After.
+      latency_target_secs - Concurrency only grows while fetches complete
+                            faster than this.
+      breaker_failure_threshold - The number of failed tries in a row after
+                                  which a host's circuit breaker opens.
+      breaker_reset_secs - The time after which an open breaker lets a probe
+                           through.
+
+    Raises:
+      ValueError if max_tries is less than 1.
+    """
+    if max_tries < 1:
+      raise ValueError('max_tries must be at least 1: %s' % max_tries)
+    self.min_concurrency = min_concurrency
+    self.max_concurrency = max_concurrency
+    self.max_tries = max_tries
+    self.base_backoff_secs = base_backoff_secs
+    self.max_backoff_secs = max_backoff_secs
+    self.latency_target_secs = latency_target_secs
+    self.breaker_failure_threshold = breaker_failure_threshold
+    self.breaker_reset_secs = breaker_reset_secs
+
+    self._condition = threading.Condition()
+    self._concurrency = float(
+      max(min_concurrency, min(initial_concurrency, max_concurrency)))
+    self._in_flight = 0
+    self._last_decrease_time = 0
+    # host -> _Breaker
+    self._breakers = {}
+    self._num_retries = 0
+    self._num_throttled = 0
+
+  def Fetch(self, url, fetch_fn, rate_limiter=None):
+    """Fetches url with fetch_fn, retrying as needed.
+
+    Args:
+      url - The URL that fetch_fn fetches; its host selects the breaker.
+      fetch_fn - A function that does the fetch and returns a result with a
+                 status_code and headers, like
+                 net_util.GenericFetchFromUrlToString().
+      rate_limiter - If present, a net_util.HostRateLimiter that is waited on
+                     before each try, before it takes a slot, so that the
+                     wait doesn't count towards the latency of the try.
+
+    Returns:
+      The result of the last try.
+
+    Raises:
+      CircuitOpenError if the host's circuit breaker is open.
+    """
+    host = urlparse.urlsplit(url).netloc
+    for attempt in xrange(self.max_tries):
+      self._CheckBreaker(host)
+      if rate_limiter:
+        with tracing.Span('fetch.rate_limit_wait'):
+          rate_limiter.Wait(url)
+      try:
+        result, start_time, latency_secs = self._TimedFetch(fetch_fn)
+      except Exception:
+        with self._condition:
+          self._RecordFailure(host)
+        raise
+      self._OnResult(host, result, start_time, latency_secs)
+
+      if (result.status_code not in _RETRY_STATUS_CODES or
+          attempt == self.max_tries - 1):
+        return result
+
+      with self._condition:
+        self._num_retries += 1
+      tracing.Count('fetch.retries')
+      time.sleep(self._BackoffSecs(attempt, result))
+
+  def Concurrency(self):
+    """Returns the current number of fetches allowed in flight.
+    """
+    with self._condition:
+      return int(self._concurrency)
+
+  def Stats(self):
+    """Returns a dict with the current concurrency and the numbers of retries,
+    throttled responses and open breakers.
+    """
+    with self._condition:
+      return {
+        'concurrency': int(self._concurrency),
+        'retries': self._num_retries,
+        'throttled': self._num_throttled,
+        'open_breakers': sorted(host for host, b in self._breakers.iteritems()
+                                if b.open_until),
+      }
+
+  def _TimedFetch(self, fetch_fn):
+    """Runs fetch_fn once a slot is free.
+
+    Returns:
+      A (result, start time, latency secs) tuple.
+    """
+    with self._condition:
+      while self._in_flight >= int(self._concurrency):
+        self._condition.wait()
+      self._in_flight += 1
+
+    start_time = time.time()
+    try:
+      result = fetch_fn()
+    finally:
+      with self._condition:
+        self._in_flight -= 1
+        self._condition.notify()
+    return result, start_time, time.time() - start_time
+
+  def _OnResult(self, host, result, start_time, latency_secs):
+    """Adapts the concurrency and the host's breaker to the result of a try.
+    Responses served from a cache without a request say nothing about the
+    host, so they're left out.
+    """
+    if getattr(result, 'cache_status', None) == 'hit':
+      return
+    failed = result.status_code in _RETRY_STATUS_CODES
+    with self._condition:
+      if failed:
+        self._RecordFailure(host)
+      else:
+        self._breakers.setdefault(host, _Breaker()).RecordSuccess()
+
+      if _IsThrottled(result):
+        self._num_throttled += 1
+        # Only the first of the responses to the fetches that were already in
+        # flight when the concurrency was cut counts.
+        if start_time > self._last_decrease_time:
+          self._concurrency = max(self.min_concurrency,
+                                  self._concurrency / 2)
+          self._last_decrease_time = time.time()
+          tracing.Count('fetch.concurrency_decreases')
+      elif not failed and latency_secs < self.latency_target_secs:
+        # About +1 per round trip of all the fetches in flight.
+        self._concurrency = min(self.max_concurrency,
+                                self._concurrency + 1.0 / self._concurrency)
+      self._condition.notify_all()
+
+  def _RecordFailure(self, host):
+    """Records a failed try with the host's breaker.  Must be called with the
+    lock held.
+    """
+    breaker = self._breakers.setdefault(host, _Breaker())
+    if breaker.RecordFailure(self.breaker_failure_threshold,
+                             self.breaker_reset_secs):
+      print 'Circuit breaker for %s opened after %d failures' % (
+        host, breaker.consecutive_failures)
+
+  def _CheckBreaker(self, host):
+    with self._condition:
+      breaker = self._breakers.get(host)
+      if breaker and not breaker.Allow():
+        tracing.Count('fetch.circuit_open')
+        raise CircuitOpenError('Circuit breaker open for %s' % host)
+
+  def _BackoffSecs(self, attempt, result):
+    """Returns the delay before retrying after a failed try.
+    """
+    retry_after_secs = _RetryAfterSecs(result)
+    if retry_after_secs is not None:
+      return min(self.max_backoff_secs, retry_after_secs)
+    backoff_secs = min(self.max_backoff_secs,
+                       self.base_backoff_secs * 2 ** attempt)
+    return random.uniform(0, backoff_secs)
+
+class _Breaker(object):
+  """The circuit breaker state of one host.  Used with the controller's lock
+  held.
+  """
+
+  def __init__(self):
+    self.consecutive_failures = 0
+    # While set, tries are refused until this time, after which one probe is
+    # let through.
+    self.open_until = None
+    self.probing = False
+
+  def Allow(self):
+    if self.open_until is None:
+      return True
+    if self.probing or time.time() < self.open_until:
+      return False
+    self.probing = True
+    return True
+
+  def RecordFailure(self, failure_threshold, reset_secs):
+    """Returns whether the breaker went from closed to open.
+    """
+    self.consecutive_failures += 1
+    if not self.probing and self.consecutive_failures < failure_threshold:
+      return False
+    opened = self.open_until is None
+    self.open_until = time.time() + reset_secs
+    self.probing = False
+    return opened
+
+  def RecordSuccess(self):
+    self.consecutive_failures = 0
+    self.open_until = None
+    self.probing = False
+
+def _IsThrottled(result):
+  """Returns whether the server responded that it's overloaded, as opposed to
+  the fetch failing without a response.
+  """
+  return (result.status_code in _THROTTLE_STATUS_CODES and
+          result.headers is not None)
+
+def _RetryAfterSecs(result):
+  """Returns the delay requested by the Retry-After header of result, or None.
+  """
+  value = result.headers and result.headers.getheader('retry-after')
+  if not value:
+    return None
+  value = value.strip()
+  if value.isdigit():
+    return int(value)
+  # Dates are rare, and email.utils is slow to import.
+  import email.utils
+  parsed = email.utils.parsedate_tz(value)
+  if parsed is None:
+    return None
+  return max(0, email.utils.mktime_tz(parsed) - time.time())
@@ -1,26 +1,243 @@
 """Wraps the basic Google Spreadsheets API with Pythonic functions.
 """
 
+import datetime
+import errno
 import json
-import gspread
-from oauth2client.client import SignedJwtAssertionCredentials
+import os
+import tempfile
+import threading
+import time
+import tracing
 from collections import defaultdict as dd
+from misc_util import RunInThreads
 
-GSPREAD_CLIENT = None
+# The SheetsSession through which the spreadsheets are opened, set by
+# Initialize() or UseClient().
+SESSION = None
 
-def Initialize():
-  json_key = json.load(open('/Users/sjeyakumar/sanjay/personal/realestate/data_updater/RealEstate_Data_Consume-2f5691622669.json'))
-  scope = ['https://spreadsheets.google.com/feeds']
+_KEY_PATH = '/Users/sjeyakumar/sanjay/personal/realestate/data_updater/RealEstate_Data_Consume-2f5691622669.json'
+_SCOPE = ['https://spreadsheets.google.com/feeds']
 
-  credentials = SignedJwtAssertionCredentials(json_key['client_email'], json_key['private_key'], scope)
+# A cached access token that expires within this time isn't reused.
+_MIN_TOKEN_TTL_SECS = 10 * 60
 
-  global GSPREAD_CLIENT
-  GSPREAD_CLIENT = gspread.authorize(credentials)
+# The access token is refreshed before the next request once it expires
+# within this time, so that a run that outlives its token doesn't fail
+# partway through.
+_TOKEN_REFRESH_MARGIN_SECS = 5 * 60
+
+# The maximum number of cells sent in a single update_cells() request.
+_MAX_CELLS_PER_BATCH = 1000
+
+# The maximum number of rows read in a single range() request.
+_MAX_ROWS_PER_READ = 2000
+
+class SheetsSession(object):
+  """An authorized client, and the spreadsheets and worksheets opened through
+  it, which are kept for the length of the run instead of being looked up
+  through the API for each sheet operation.  Thread-safe.
+  """
+
+  def __init__(self, client, credentials=None, token_cache_path=None,
+               token_key=None):
+    """
+    Args:
+      client - The authorized gspread client.
+      credentials - If present, the OAuth credentials of the client, whose
+                    access token is refreshed as it nears its expiry.
+      token_cache_path - If present, the file to which a refreshed access
+                         token is written (see Initialize()).
+      token_key - The _TokenKey() of the credentials.
+    """
+    self.client = client
+    self._credentials = credentials
+    self._token_cache_path = token_cache_path
+    self._token_key = token_key
+    self._token_lock = threading.Lock()
+    # Whether the token was refreshed and its expiry is still unknown.
+    self._expiry_unknown = False
+    self._lock = threading.Lock()
+    # Spreadsheet name -> spreadsheet
+    self._spreadsheets = {}
+    # (spreadsheet name, sheet name) -> worksheet
+    self._worksheets = {}
+
+  def RefreshTokenIfExpiring(self):
+    """Refreshes the access token if it expires within
+    _TOKEN_REFRESH_MARGIN_SECS, and authorizes the client's requests with
+    the new one.
+
+    A token whose expiry is unknown is refreshed once, to learn the expiry of
+    the new token.  If that is still unknown, the token is used as is.
+    """
+    if not self._credentials:
+      return
+    with self._token_lock:
+      expiry = self._credentials.token_expiry
+      if expiry is None:
+        if self._expiry_unknown and self._credentials.access_token:
+          return
+      elif _EpochSecs(expiry) - time.time() > _TOKEN_REFRESH_MARGIN_SECS:
+        return
+      import httplib2
+      with tracing.Span('sheets.refresh_token'):
+        self._credentials.refresh(httplib2.Http())
+        # Sets the Authorization header of the client's requests.
+        self.client.login()
+      self._expiry_unknown = self._credentials.token_expiry is None
+      if self._token_cache_path:
+        _SaveToken(self._token_cache_path, self._token_key, self._credentials)
+
+  def OpenSpreadsheet(self, name):
+    """Opens the named spreadsheet, or returns it if it's already open.
+    """
+    self.RefreshTokenIfExpiring()
+    with self._lock:
+      return self._OpenSpreadsheet(name)
+
+  def OpenWorksheet(self, name, sheet_name):
+    """Returns the named worksheet of the named spreadsheet.  The worksheets
+    of a spreadsheet are all listed the first time one of them is opened.
+
+    Raises:
+      ValueError if the spreadsheet has no such worksheet.
+    """
+    self.RefreshTokenIfExpiring()
+    with self._lock:
+      key = (name, sheet_name)
+      if key not in self._worksheets:
+        spreadsheet = self._OpenSpreadsheet(name)
+        with tracing.Span('sheets.list_worksheets', spreadsheet=name):
+          worksheets = spreadsheet.worksheets()
+        for worksheet in worksheets:
+          self._worksheets.setdefault((name, worksheet.title), worksheet)
+      if key not in self._worksheets:
+        raise ValueError('No worksheet %s in %s' % (sheet_name, name))
+      return self._worksheets[key]
+
+  def _OpenSpreadsheet(self, name):
+    if name not in self._spreadsheets:
+      with tracing.Span('sheets.open', spreadsheet=name):
+        self._spreadsheets[name] = self.client.open(name)
+    return self._spreadsheets[name]
+
+def Initialize(key_path=_KEY_PATH, token_cache_path=None):
+  """Authorizes a client with the service account key and starts the
+  session.
+
+  Args:
+    key_path - The JSON key file of the service account.
+    token_cache_path - If present, the file in which the access token is kept
+                       between runs, so that a run that starts before it
+                       expires doesn't request a new one.
+  """
+  # The client libraries are only imported when the sheets are opened, since
+  # importing them is slow.
+  import gspread
+  from oauth2client.client import SignedJwtAssertionCredentials
+
+  with open(key_path) as f:
+    json_key = json.load(f)
+  credentials = SignedJwtAssertionCredentials(
+    json_key['client_email'], json_key['private_key'], _SCOPE)
+
+  token_key = _TokenKey(json_key['client_email'])
+  cached_token = None
+  if token_cache_path:
+    cached_token = _LoadToken(token_cache_path, token_key, credentials)
+  # Only requests a token if there's no unexpired one on the credentials.
+  with tracing.Span('sheets.authorize', cached_token=bool(cached_token)):
+    client = gspread.authorize(credentials)
+  if token_cache_path and credentials.access_token != cached_token:
+    _SaveToken(token_cache_path, token_key, credentials)
+
+  global SESSION
+  SESSION = SheetsSession(client, credentials, token_cache_path, token_key)
+
+def UseClient(client):
+  """Starts a session with an already authorized client, e.g. a fake one.
+  """
+  global SESSION
+  SESSION = SheetsSession(client)
+
+def _RefreshToken():
+  """Refreshes the session's access token before a request, if it's about to
+  expire.
+  """
+  if SESSION:
+    SESSION.RefreshTokenIfExpiring()
+
+def _TokenKey(client_email):
+  """Identifies the account and scope for which a token was issued.
+  """
+  return '%s %s' % (client_email, ' '.join(sorted(_SCOPE)))
+
+def _LoadToken(path, token_key, credentials):
+  """Sets the access token cached in path on the credentials, if it was
+  issued for token_key (see _TokenKey()) and doesn't expire soon.
+
+  Returns:
+    The access token, or None if there is no usable one.
+  """
+  try:
+    with open(path) as f:
+      cached = json.load(f)
+  except IOError, e:
+    if e.errno != errno.ENOENT:
+      raise
+    return None
+  except ValueError:
+    print 'Ignoring a malformed token cache: %s' % path
+    return None
+
+  if (cached.get('key') != token_key or
+      not cached.get('access_token') or
+      cached.get('expires_at', 0) - time.time() < _MIN_TOKEN_TTL_SECS):
+    return None
+  credentials.access_token = cached['access_token']
+  credentials.token_expiry = datetime.datetime.utcfromtimestamp(
+    cached['expires_at'])
+  return credentials.access_token
+
+def _SaveToken(path, token_key, credentials):
+  """Writes the access token of the credentials and its expiry to path,
+  readable only by the user.
+  """
+  if not credentials.access_token or not credentials.token_expiry:
+    return
+  token_dir = os.path.dirname(path) or '.'
+  try:
+    os.makedirs(token_dir)
+  except OSError, e:
+    if e.errno != errno.EEXIST:
+      raise
+
+  # mkstemp() creates the file with mode 0600.
+  fd, temp_path = tempfile.mkstemp(dir=token_dir, suffix='.tmp')
+  with os.fdopen(fd, 'w') as f:
+    json.dump({
+      'key': token_key,
+      'access_token': credentials.access_token,
+      'expires_at': int(_EpochSecs(credentials.token_expiry)),
+    }, f)
+  os.rename(temp_path, path)
+
+def _EpochSecs(utc_datetime):
+  """Returns the seconds since the epoch of a naive UTC datetime, such as the
+  token_expiry of OAuth credentials.
+  """
+  return (utc_datetime - datetime.datetime(1970, 1, 1)).total_seconds()
 
 def OpenSpreadsheet(name):
   """Opens the provided spreadsheet.
   """
-  return GSPREAD_CLIENT.open(name)
+  return SESSION.OpenSpreadsheet(name)
+
+def OpenWorksheet(name, sheet_name):
+  """Opens the named worksheet of the named spreadsheet.
+  """
+  return SESSION.OpenWorksheet(name, sheet_name)
 
 def ReadRow(spreadsheet, row_num):
   """Reads the specified row number from the spreadsheet.
@@ -36,19 +253,89 @@ def ReadCells(worksheet, start_row, end_row):
     end_row       - Row number (1-based) and exclusive.
   """
   cells_as_array = dd(lambda: dd(str))
-  cells = worksheet.range('A%s:Z%s' % (start_row, (end_row-1)))
+  _RefreshToken()
+  with tracing.Span('sheets.read_range', rows=end_row - start_row):
+    cells = worksheet.range('A%s:Z%s' % (start_row, (end_row-1)))
+  tracing.Count('sheets.cells_read', len(cells))
   for c in cells:
     cells_as_array[c.row-1][c.col-1] = c
   return cells_as_array
 
-def WriteCells(worksheet, data_cells):
+def WriteCells(
+  worksheet,
+  data_cells,
+  original_values=None,
+  max_cells_per_batch=_MAX_CELLS_PER_BATCH):
   """Write the provided cells.
+
+  Args:
+    worksheet
+    data_cells          - The cells, as returned by ReadCells().
+    original_values     - If present, the values returned by CellValues() when
+                          the cells were loaded.  Only the cells whose value
+                          differs are written, and original_values is updated
+                          with the written values.
+    max_cells_per_batch - The maximum number of cells per update request.
   """
-  all_cells = []
-  for row in data_cells.values():
-    all_cells.extend(row.values())
+  cells = [c for row in data_cells.values() for c in row.values()
+           if hasattr(c, 'row')]
+  if original_values is not None:
+    cells = [c for c in cells
+             if _NormalizeValue(c.value) != original_values.get((c.row, c.col))]
+
+  for batch in _BatchRanges(_ContiguousRanges(cells), max_cells_per_batch):
+    _RefreshToken()
+    with tracing.Span('sheets.update_cells', cells=len(batch)):
+      worksheet.update_cells(batch)
+    tracing.Count('sheets.cells_written', len(batch))
+    if original_values is not None:
+      for c in batch:
+        original_values[(c.row, c.col)] = _NormalizeValue(c.value)
 
-  worksheet.update_cells(all_cells)
+def CellValues(data_cells):
+  """Returns a dict of (row, col) -> value for the provided cells, with which
+  WriteCells() can tell which cells have changed.
+  """
+  return dict(((c.row, c.col), _NormalizeValue(c.value))
+              for row in data_cells.values() for c in row.values()
+              if hasattr(c, 'row'))
+
+def _NormalizeValue(value):
+  """Returns a cell value in the form used to compare values.
+  """
+  if value is None:
+    return u''
+  if isinstance(value, str):
+    return value.decode('utf-8', 'replace')
+  return unicode(value)
+
+def _ContiguousRanges(cells):
+  """Groups the cells into runs of adjacent cells within a row.
+  """
+  ranges = []
+  for c in sorted(cells, key=lambda c: (c.row, c.col)):
+    last = ranges[-1][-1] if ranges else None
+    if last and last.row == c.row and last.col + 1 == c.col:
+      ranges[-1].append(c)
+    else:
+      ranges.append([c])
+  return ranges
+
+def _BatchRanges(ranges, max_cells_per_batch):
+  """Packs the ranges of cells into batches of at most max_cells_per_batch
+  cells.  A range is only split if it doesn't fit in a batch by itself.
+  """
+  batch = []
+  for r in ranges:
+    if len(batch) + len(r) > max_cells_per_batch and batch:
+      yield batch
+      batch = []
+    while len(r) > max_cells_per_batch:
+      yield r[:max_cells_per_batch]
+      r = r[max_cells_per_batch:]
+    batch.extend(r)
+  if batch:
+    yield batch
 
 def ReadAllRows(spreadsheet):
   """Read all the rows from the provided spreadsheet.
@@ -58,52 +345,62 @@ def ReadAllRows(spreadsheet):
 def LoadSpreadsheet(
   name,
   sheet_name,
-  row_batch_size=10):
+  max_rows_per_read=_MAX_ROWS_PER_READ):
   """Loads the provided spreadsheet.
+
+  The rows of the sheet's grid (its row_count) are read in one request, or
+  in parallel windows of max_rows_per_read rows for very large sheets.  Empty
+  rows are left out of the result.
   """
-  spreadsheet = OpenSpreadsheet(name)
-  worksheet = GetWorksheet(spreadsheet, sheet_name)
-  all_cells = None
-  for i in xrange(100):
-    start_row = 1+(i*row_batch_size)
-    cells = ReadCells(worksheet, start_row, start_row+row_batch_size)
-
-    # Check if there are empty rows.
-    empty_rows = []
-    for row in cells.keys():
-      is_empty = True
-      for col in cells[row].keys():
-        if cells[row][col].value:
-          is_empty = False
-          break
-      if is_empty:
-        empty_rows.append(row)
-
-    # Delete the empty rows.
-    for row in empty_rows:
-      del cells[row]
-
-    # Update all cells.
-    if not all_cells:
-      all_cells = cells
-    else:
-      all_cells.update(cells)
+  worksheet = OpenWorksheet(name, sheet_name)
+  last_row = worksheet.row_count
 
-    # Break, if there were empty rows.
-    if empty_rows:
-      break
+  windows = [(start_row, min(start_row + max_rows_per_read, last_row + 1))
+             for start_row in xrange(1, last_row + 1, max_rows_per_read)]
+  if len(windows) <= 1:
+    window_cells = [ReadCells(worksheet, *w) for w in windows]
+  else:
+    window_cells = RunInThreads(lambda w: ReadCells(worksheet, *w), windows)
+
+  all_cells = dd(lambda: dd(str))
+  for cells in window_cells:
+    all_cells.update(cells)
+
+  # Delete the empty rows.
+  for row in all_cells.keys():
+    if not any(c.value for c in all_cells[row].values()):
+      del all_cells[row]
 
   return all_cells
 
+def IterRows(worksheet, max_rows_per_read=_MAX_ROWS_PER_READ):
+  """Yields the (row, cells) of the non-empty rows of the worksheet in order,
+  with row 0-based and cells as in ReadCells().
+
+  The rows of the sheet's grid are read in windows of max_rows_per_read rows,
+  each once the rows of the previous window have been consumed, so that only
+  one window is held in memory at a time.
+  """
+  last_row = worksheet.row_count
+  for start_row in xrange(1, last_row + 1, max_rows_per_read):
+    cells = ReadCells(worksheet, start_row,
+                      min(start_row + max_rows_per_read, last_row + 1))
+    for row in sorted(cells):
+      if any(c.value for c in cells[row].values()):
+        yield row, cells[row]
+
 def WriteSpreadsheet(
   name,
   sheet_name,
-  all_cells):
+  all_cells,
+  original_values=None):
   """Writes the provided spreadsheet.
+
+  If original_values (see CellValues()) is present, only the changed cells
+  are written.
   """
-  spreadsheet = OpenSpreadsheet(name)
-  worksheet = GetWorksheet(spreadsheet, sheet_name)
-  WriteCells(worksheet, all_cells)
+  worksheet = OpenWorksheet(name, sheet_name)
+  WriteCells(worksheet, all_cells, original_values)
 
 def GetWorksheet(spreadsheet, sheet_name):
   """Returns a worksheet object with the provided sheet name.
@@ -0,0 +1,302 @@
+"""A persistent, size-bounded on-disk cache of HTTP responses.
+
+Entries are keyed by URL and stored as a pair of files in the cache directory:
+'<key>.body' holds the response body and '<key>.meta' holds a JSON document
+with the validators (ETag / Last-Modified), the expiry time and the response
+headers.  The modification time of the meta file records the last access and
+drives LRU eviction.  Files are written to '*.tmp' files first and renamed
+into place, so a reader never sees a partly written entry.
+"""
+
+from cStringIO import StringIO
+import errno
+import hashlib
+import httplib
+import json
+import os
+import tempfile
+import threading
+import time
+
+from misc_util import Bunch
+
+# Default time for which an entry is served without revalidation.
+DEFAULT_TTL_SECS = 60 * 60
+
+# Default bound on the total size of the cached bodies.
+DEFAULT_MAX_SIZE_BYTES = 1024 * 1024 * 1024
+
+_BODY_SUFFIX = '.body'
+_META_SUFFIX = '.meta'
+_TEMP_SUFFIX = '.tmp'
+
+# The age after which a temp file left in the cache directory, e.g. by a
+# process that died while writing it, is removed when a cache is opened.
+_STALE_TEMP_SECS = 60 * 60
+
+class HttpCache(object):
+  """A thread-safe on-disk HTTP response cache with LRU eviction.
+  """
+
+  def __init__(self, cache_dir, default_ttl_secs=DEFAULT_TTL_SECS,
+               max_size_bytes=DEFAULT_MAX_SIZE_BYTES):
+    """
+    Args:
+      cache_dir - The directory in which to store the entries. Created if it
+                  doesn't exist.
+      default_ttl_secs - The time for which a stored entry is fresh, unless a
+                         different TTL is given when it is stored.
+      max_size_bytes - Least recently used entries are evicted once the total
+                       size of the bodies exceeds this bound.
+    """
+    self.cache_dir = cache_dir
+    self.default_ttl_secs = default_ttl_secs
+    self.max_size_bytes = max_size_bytes
+    self._lock = threading.Lock()
+    # key -> [body size, last access time]
+    self._index = {}
+    self._total_size = 0
+
+    try:
+      os.makedirs(cache_dir)
+    except OSError, e:
+      if e.errno != errno.EEXIST:
+        raise
+    self._LoadIndex()
+
+  def Get(self, url):
+    """Returns the entry stored for url, or None.
+
+    The returned entry is a Bunch with the attributes url, final_url,
+    status_code, etag, last_modified, expires_at and headers.  Its body can be
+    read with OpenBody().
+    """
+    key = _Key(url)
+    with self._lock:
+      if key not in self._index:
+        return None
+      self._index[key][1] = time.time()
+
+    try:
+      with open(self._Path(key, _META_SUFFIX)) as f:
+        meta = json.load(f)
+      os.utime(self._Path(key, _META_SUFFIX), None)
+    except (IOError, OSError, ValueError):
+      self._Remove(key)
+      return None
+
+    return Bunch(key=key, **dict((str(k), v) for k, v in meta.iteritems()))
+
+  def IsFresh(self, entry, now=None):
+    """Returns whether entry may be served without revalidation.
+    """
+    return (now or time.time()) < entry.expires_at
+
+  def ConditionalHeaders(self, entry):
+    """Returns the request headers that revalidate entry with the server.
+    """
+    headers = {}
+    if entry.etag:
+      headers['If-None-Match'] = entry.etag
+    if entry.last_modified:
+      headers['If-Modified-Since'] = entry.last_modified
+    return headers
+
+  def OpenBody(self, entry):
+    """Returns the stored body of entry as a file opened for reading, or None
+    if the entry has been evicted since Get() returned it.  The open file can
+    still be read if the entry is evicted afterwards.
+    """
+    try:
+      return open(self._Path(entry.key, _BODY_SUFFIX), 'rb')
+    except IOError, e:
+      if e.errno != errno.ENOENT:
+        raise
+      self._Remove(entry.key)
+      return None
+
+  def Headers(self, entry):
+    """Returns the stored response headers of entry as an httplib.HTTPMessage.
+    """
+    return httplib.HTTPMessage(StringIO(entry.headers.encode('latin-1')))
+
+  def Refresh(self, entry, ttl_secs=None):
+    """Marks entry as fresh again, e.g. after a 304 Not Modified response.
+    """
+    entry.expires_at = time.time() + self._Ttl(ttl_secs)
+    with self._lock:
+      # An evicted entry isn't brought back without its body.
+      if entry.key in self._index:
+        self._WriteMeta(entry.key, entry.ToDict())
+
+  def OpenWriter(self, url):
+    """Returns a _CacheWriter to which the body for url can be written while
+    it is being fetched.  The entry is only stored once the writer is
+    committed.
+    """
+    fd, temp_path = tempfile.mkstemp(dir=self.cache_dir, suffix=_TEMP_SUFFIX)
+    return _CacheWriter(self, url, os.fdopen(fd, 'wb'), temp_path)
+
+  def _Commit(self, url, temp_path, result, ttl_secs, decoded):
+    """Stores the body at temp_path as the entry for url.  temp_path is
+    renamed into place, or left for the caller to remove on failure.
+    """
+    key = _Key(url)
+    headers = result.headers
+    size = os.path.getsize(temp_path)
+    header_lines = headers.headers if headers else []
+    if decoded:
+      header_lines = _DecodedHeaderLines(header_lines, size)
+    meta = {
+      'url': url,
+      'final_url': result.final_url,
+      'status_code': result.status_code,
+      'etag': headers.getheader('etag') if headers else None,
+      'last_modified': headers.getheader('last-modified') if headers else None,
+      'expires_at': time.time() + self._Ttl(ttl_secs),
+      'headers': ''.join(header_lines).decode('latin-1'),
+    }
+
+    with self._lock:
+      os.rename(temp_path, self._Path(key, _BODY_SUFFIX))
+      self._WriteMeta(key, meta)
+      old_size = self._index.get(key, (0, 0))[0]
+      self._index[key] = [size, time.time()]
+      self._total_size += size - old_size
+      self._Evict()
+
+  def _WriteMeta(self, key, meta):
+    meta = dict((k, v) for k, v in meta.iteritems() if k != 'key')
+    fd, temp_path = tempfile.mkstemp(dir=self.cache_dir, suffix=_TEMP_SUFFIX)
+    try:
+      with os.fdopen(fd, 'w') as f:
+        json.dump(meta, f)
+      os.rename(temp_path, self._Path(key, _META_SUFFIX))
+    except:
+      _RemoveFile(temp_path)
+      raise
+
+  def _Evict(self):
+    """Removes least recently used entries until the cache is within its size
+    bound.  Must be called with the lock held.
+    """
+    if self._total_size <= self.max_size_bytes:
+      return
+    for key in sorted(self._index, key=lambda k: self._index[k][1]):
+      if self._total_size <= self.max_size_bytes:
+        break
+      self._RemoveLocked(key)
+
+  def _Remove(self, key):
+    with self._lock:
+      self._RemoveLocked(key)
+
+  def _RemoveLocked(self, key):
+    if key in self._index:
+      self._total_size -= self._index.pop(key)[0]
+    for suffix in (_META_SUFFIX, _BODY_SUFFIX):
+      _RemoveFile(self._Path(key, suffix))
+
+  def _LoadIndex(self):
+    """Builds the in-memory index from the entries already on disk, and
+    removes the stale temp files.
+    """
+    stale_before = time.time() - _STALE_TEMP_SECS
+    for name in os.listdir(self.cache_dir):
+      if name.endswith(_TEMP_SUFFIX):
+        path = os.path.join(self.cache_dir, name)
+        try:
+          if os.path.getmtime(path) < stale_before:
+            _RemoveFile(path)
+        except OSError:
+          pass
+        continue
+      if not name.endswith(_META_SUFFIX):
+        continue
+      key = name[:-len(_META_SUFFIX)]
+      try:
+        size = os.path.getsize(self._Path(key, _BODY_SUFFIX))
+        last_access = os.path.getmtime(self._Path(key, _META_SUFFIX))
+      except OSError:
+        continue
+      self._index[key] = [size, last_access]
+      self._total_size += size
+    with self._lock:
+      self._Evict()
+
+  def _Ttl(self, ttl_secs):
+    return self.default_ttl_secs if ttl_secs is None else ttl_secs
+
+  def _Path(self, key, suffix):
+    return os.path.join(self.cache_dir, key + suffix)
+
+class _CacheWriter(object):
+  """A file-like object that collects a response body for the cache.
+  """
+  def __init__(self, cache, url, f, temp_path):
+    self._cache = cache
+    self._url = url
+    self._file = f
+    self._temp_path = temp_path
+
+  def write(self, data):
+    self._file.write(data)
+
+  def Commit(self, result, ttl_secs=None, decoded=False):
+    """Stores the written body as the entry for the URL.
+
+    Args:
+      result - The fetch result, with the final_url, status_code and headers
+               of the response.
+      ttl_secs - The time for which the entry is fresh, if not the cache's
+                 default.
+      decoded - Whether the written body was decoded from the response's
+                Content-Encoding, in which case that header is dropped and
+                the Content-Length is that of the written body.
+    """
+    try:
+      self._file.close()
+      self._cache._Commit(self._url, self._temp_path, result, ttl_secs,
+                          decoded)
+    except:
+      _RemoveFile(self._temp_path)
+      raise
+
+  def Abort(self):
+    try:
+      self._file.close()
+    finally:
+      _RemoveFile(self._temp_path)
+
+# The headers that describe the encoded body of a response rather than the
+# decoded body that's stored.
+_ENCODED_BODY_HEADERS = frozenset(['content-encoding', 'content-length'])
+
+def _DecodedHeaderLines(header_lines, size):
+  """Returns the raw header lines of a response, with those that describe its
+  encoded body replaced by the Content-Length of the size-byte decoded body.
+  """
+  lines = []
+  dropping = False
+  for line in header_lines:
+    if line[:1] in ' \t':
+      # A continuation of the previous header.
+      if not dropping:
+        lines.append(line)
+      continue
+    dropping = line.split(':', 1)[0].strip().lower() in _ENCODED_BODY_HEADERS
+    if not dropping:
+      lines.append(line)
+  lines.append('Content-Length: %d\r\n' % size)
+  return lines
+
+def _RemoveFile(path):
+  """Removes the file at path, if it exists.
+  """
+  try:
+    os.remove(path)
+  except OSError:
+    pass
+
+def _Key(url):
+  return hashlib.sha1(url).hexdigest()
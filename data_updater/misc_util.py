@@ -1,4 +1,5 @@
 import string
+import threading
 
 def GetInt(s):
   """Treats the provided string as an integer and parses it.
@@ -105,3 +106,32 @@ class Bunch(BaseBunch):
 
   def __delitem__(self, obj):
     del self.__dict__[obj]
+
+def RunInThreads(fn, items):
+  """Applies fn to every item, each on its own thread.
+
+  Returns:
+    The list of results, in the same order as items.
+
+  Raises:
+    The first exception raised by fn, once all of the threads are done.
+  """
+  results = [None] * len(items)
+  errors = []
+
+  def _Run(i):
+    try:
+      results[i] = fn(items[i])
+    except Exception, e:
+      errors.append(e)
+
+  threads = [threading.Thread(target=_Run, args=(i,))
+             for i in xrange(len(items))]
+  for t in threads:
+    t.start()
+  for t in threads:
+    t.join()
+
+  if errors:
+    raise errors[0]
+  return results
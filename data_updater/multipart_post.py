@@ -0,0 +1,108 @@
+"""A urllib2 handler that POSTs dicts of form values, uploading the values
+that are files as a multipart message.
+
+It's only needed for dict POST data, so net_util builds the openers that use
+it on the first such request, rather than importing this module (and the MIME
+modules it needs) on the fetch path.
+"""
+
+from cStringIO import StringIO
+import mimetools
+import mimetypes
+import os
+import stat
+import sys
+import urllib
+import urllib2
+
+class MultipartPostHandler(urllib2.BaseHandler):
+  """A subclass of urllib2.BaseHandler that allows for the use of multipart
+  form-data to POST files to a remote server.  This handler also supports
+  generic POST key-value pairs.  If there are no values to be included, then
+  a GET request will be performed instead.
+  """
+
+  # BaseHandler subclasses can change the handler_order member variable to modify its
+  # position in the handler list.  The post handler should run before other default
+  # handlers.
+  handler_order = urllib2.HTTPHandler.handler_order - 1
+
+  def http_request(self, request):
+    """Override the http_request() processing.  Retrieve the data and files to
+    be posted, and create the data blob to send to the server.
+
+    The necessary Content-Type headers will also be added.
+    """
+    data = request.get_data()
+    if data is not None and type(data) == dict:
+      v_files = []
+      v_vars = []
+      try:
+        for key, value in data.iteritems():
+          if type(value) == file:
+            v_files.append((key, value))
+          else:
+            v_vars.append((key, value))
+      except TypeError:
+        systype, value, traceback = sys.exc_info()
+        raise TypeError, "not a valid non-string sequence or mapping object", traceback
+
+      if len(v_files) == 0:
+        data = urllib.urlencode(v_vars)
+      else:
+        boundary, data = self._MultipartEncode(v_vars, v_files)
+        contenttype = 'multipart/form-data; boundary=%s' % boundary
+        request.add_unredirected_header('Content-Type', contenttype)
+
+      request.add_data(data)
+
+    elif data is not None and isinstance(data, basestring):
+      request.add_data(data)
+
+    return request
+
+  https_request = http_request
+
+  def _MultipartEncode(self, vars, files, boundary=None, buf=None):
+    """Given the provided POST variables, and files, will encode the data
+    as a multipart message if files is present.
+
+    Args:
+      vars - List of POST keys that should be sent in request
+      files - List of files that should be sent in the request
+      boundary - Boundary to be used to send the MIME request
+      buf - Buffer to use to construct the message data
+
+    Returns:
+      Tuple of the chosen boundary and the buffer containing the message data.
+    """
+    if boundary is None:
+      boundary = mimetools.choose_boundary()
+
+    if buf is None:
+      buf = StringIO()
+
+    for key, value in vars:
+      buf.write('--%s\r\n' % boundary)
+      buf.write('Content-Disposition: form-data; name="%s"' % key)
+      buf.write('\r\n\r\n' + value + '\r\n')
+
+    for key, fd in files:
+      file_size = os.fstat(fd.fileno())[stat.ST_SIZE]
+      filename = fd.name.split('/')[-1]
+      contenttype = mimetypes.guess_type(filename)[0] or 'application/octet-stream'
+      buf.write('--%s\r\n' % boundary)
+      buf.write('Content-Disposition: form-data; name="%s"; filename="%s"\r\n' % (key, filename))
+      buf.write('Content-Type: %s\r\n' % contenttype)
+      fd.seek(0)
+      file_size = os.fstat(fd.fileno())[stat.ST_SIZE]
+
+      # Commenting out Content-Length for now, as it's not required, and there
+      # have been cases when I've seen erroneous lengths.
+      # buf.write('Content-Length: %s\r\n' % file_size)
+
+      buf.write('\r\n' + fd.read() + '\r\n')
+
+    buf.write('--' + boundary + '--\r\n\r\n')
+    buf = buf.getvalue()
+    return boundary, buf
@@ -4,35 +4,68 @@
 from collections import namedtuple
 from cStringIO import StringIO
 import errno
+import httplib
 import os
-import mimetools
-import mimetypes
+import shutil
 import socket
-import stat
-import struct
-import subprocess
 import sys
-import tempfile
 import threading
+import time
 import urllib
 import urllib2
 import urlparse
-
-from SocketServer import BaseServer
-from BaseHTTPServer import HTTPServer
-from SimpleHTTPServer import SimpleHTTPRequestHandler
-from SocketServer import ForkingMixIn
+import zlib
 
 CHROME_USER_AGENT = \
   'Mozilla/5.0 (Macintosh; U; Intel Mac OS X 10_6_4; en-US) AppleWebKit/534.7' \
   ' (KHTML, like Gecko) Chrome/7.0.517.44 Safari/534.7 (Tellapart)'
 
-from tellapart.third_party import keepalive
-from tellapart.util import misc_util
+import misc_util
+import tracing
 
 # How much data to read at a time in GenericFetchFromUrl() and its variants.
 _HTTP_READ_BUFFER_SIZE = 1024 * 1024
 
+# The content codings that are requested and transparently decoded.
+_ACCEPT_ENCODING = 'gzip, deflate'
+
+class HostRateLimiter(object):
+  """A thread-safe limiter that caps the number of requests per second made to
+  any single host.
+
+  Requests to different hosts are independent; requests to the same host are
+  spaced at least 1 / max_requests_per_sec seconds apart, in the order in which
+  Wait() was called.
+  """
+  def __init__(self, max_requests_per_sec=None):
+    """
+    Args:
+      max_requests_per_sec - The maximum request rate per host. If None or 0,
+                             requests are not limited.
+    """
+    if max_requests_per_sec:
+      self._interval_secs = 1.0 / max_requests_per_sec
+    else:
+      self._interval_secs = 0.0
+    self._lock = threading.Lock()
+    self._host_to_next_slot = {}
+
+  def Wait(self, url):
+    """Blocks until a request to the host of 'url' may be made.
+    """
+    if not self._interval_secs:
+      return
+
+    host = urlparse.urlparse(url)[1]
+    with self._lock:
+      now = time.time()
+      slot = max(now, self._host_to_next_slot.get(host, now))
+      self._host_to_next_slot[host] = slot + self._interval_secs
+
+    delay_secs = slot - time.time()
+    if delay_secs > 0:
+      time.sleep(delay_secs)
+
 # Options for running CurlFetchFromUrlToFile.
 CurlOptsType = namedtuple('CurlOpts', ['connect_timeout', 'max_elapsed_time'])
 
@@ -51,7 +84,9 @@ def GenericFetchFromUrlToString(
       username=None,
       password=None,
       timeout_secs=None,
-      http_method=None):
+      http_method=None,
+      cache=None,
+      cache_ttl_secs=None):
   """A more generic form of FetchFromUrlToString().
 
   This function supports GET/POST requests and returns response headers and
@@ -73,7 +108,8 @@ def GenericFetchFromUrlToString(
     follow_redirects - Whether to automatically follow redirects (HTTP 30x).
                        Default: True.
     keep_alive - Whether to set the 'Connection' request header to 'Keep-Alive'.
-                 Default: False.
+                 Default: False.  Connections are pooled and reused either
+                 way (see ConnectionPool).
     basic_auth - Whether to use basic HTTP authentication to make the request.
                  If True, the username and password params should be provided.
     user_agent - The user agent to use for this request, Uses the python
@@ -83,6 +119,11 @@ def GenericFetchFromUrlToString(
     timeout_secs - If present, the number of seconds after which to timeout the
                    request.
     http_method - If present, use this http method instead of the default.
+    cache - If present, an http_cache.HttpCache through which GET requests are
+            served.  Fresh entries are returned without a request, and stale
+            entries are revalidated with a conditional GET.
+    cache_ttl_secs - If present, the time for which a newly cached response is
+                     fresh.  Defaults to the cache's TTL.
 
   Returns
     A Bunch object representing the response, containing the attributes:
@@ -93,28 +134,53 @@ def GenericFetchFromUrlToString(
       * final_url - The real URL of the page.  In some cases, the server may
                     redirect the client to a different URL, so this value may
                     differ from that of the 'url' argument.
+      * cache_status - None if no cache was used, otherwise one of 'hit',
+                       'revalidated' or 'miss'.
+      * wire_bytes - The number of body bytes received over the network, before
+                     any gzip/deflate decoding.
+      * decoded_bytes - The number of body bytes after decoding.
   """
-  body_buffer = StringIO()
-  try:
-    result = _GenericFetchFromUrl(
-        url,
-        body_buffer,
-        headers,
-        post_data,
-        follow_redirects,
-        keep_alive=keep_alive,
-        basic_auth=basic_auth,
-        user_agent=user_agent,
-        username=username,
-        password=password,
-        timeout_secs=timeout_secs,
-        http_method=http_method)
+  return _GenericFetchFromUrl(
+      url,
+      None,
+      headers,
+      post_data,
+      follow_redirects,
+      keep_alive=keep_alive,
+      basic_auth=basic_auth,
+      user_agent=user_agent,
+      username=username,
+      password=password,
+      timeout_secs=timeout_secs,
+      http_method=http_method,
+      cache=cache,
+      cache_ttl_secs=cache_ttl_secs)
+
+def FetchFromCache(url, cache):
+  """Returns the response for url from the cache, without making a request,
+  if the cache has a fresh entry for it.
 
-    result.body = body_buffer.getvalue()
-  finally:
-    body_buffer.close()
+  Args:
+    url - The URL of the response.
+    cache - An http_cache.HttpCache.
 
-  return result
+  Returns
+    A GenericFetchFromUrlToString() result with a cache_status of 'hit', or
+    None if there is no fresh entry for url.
+  """
+  start_time = time.time()
+  cache_entry = cache.Get(url)
+  if not cache_entry or not cache.IsFresh(cache_entry):
+    return None
+  cached_body = cache.OpenBody(cache_entry)
+  if not cached_body:
+    return None
+  result = misc_util.Bunch(body=None, headers=None, status_code=None,
+                           final_url=None, exc=None, cache_status=None,
+                           wire_bytes=0, decoded_bytes=0)
+  return _TraceFetch(
+    _CachedResult(cache, cache_entry, cached_body, None, result, 'hit'),
+    start_time)
 
 def FetchFromUrlToString(url, user_agent=None, timeout_secs=None):
   """Retrieves content from the given URL and returns it as a string.
@@ -173,6 +239,7 @@ def FetchFromUrlToTempFile(url, num_tries=1,
       if e.errno != errno.EEXIST:
         raise
 
+    import tempfile
     f = tempfile.TemporaryFile(dir=dir)
   else:
     f = StringIO()
@@ -237,6 +304,7 @@ def CurlFetchFromUrlToFile(url, local_filename, curl_opts):
     cmd += ['--max-time', str(curl_opts.max_elapsed_time)]
   cmd.append(url)
 
+  import subprocess
   with open(local_filename, 'w+b') as f:
     retcode = subprocess.call(cmd, stdout=f, stderr=sys.stderr)
     return (retcode == 0)
@@ -248,107 +316,259 @@ class _NoRedirectHandler(urllib2.HTTPRedirectHandler):
   def redirect_request(self, req, fp, code, msg, hdrs, newurl):
     return None
 
-class _MultipartPostHandler(urllib2.BaseHandler):
-  """A subclass of urllib2.BaseHandler that allows for the use of multipart
-  form-data to POST files to a remote server.  This handler also supports
-  generic POST key-value pairs.  If there are no values to be included, then
-  a GET request will be performed instead.
+class ConnectionPool(object):
+  """A thread-safe pool of persistent httplib connections, keyed by
+  (scheme, host, port).
+
+  At most max_per_host connections (idle or in use) are open to any one host;
+  callers beyond that block until a connection is released.  At most
+  max_idle_per_host released connections are kept for reuse, and idle
+  connections are closed once they have been unused for idle_timeout_secs.
   """
 
-  # BaseHandler subclasses can change the handler_order member variable to modify its
-  # position in the handler list.  The post handler should run before other default
-  # handlers.
-  handler_order = urllib2.HTTPHandler.handler_order - 1
+  def __init__(self, max_per_host=32, max_idle_per_host=16,
+               idle_timeout_secs=30):
+    self.max_per_host = max_per_host
+    self.max_idle_per_host = max_idle_per_host
+    self.idle_timeout_secs = idle_timeout_secs
+    self._cond = threading.Condition()
+    # key -> list of (connection, release time), most recently released last.
+    self._idle = {}
+    # key -> number of open connections, idle or in use.
+    self._num_open = {}
+
+  @staticmethod
+  def Key(scheme, host):
+    """Returns the pool key for a 'host[:port]' string.
+    """
+    host, port = urllib.splitport(host.lower())
+    if not port:
+      port = httplib.HTTPS_PORT if scheme == 'https' else httplib.HTTP_PORT
+    return (scheme, host, int(port))
 
-  def http_request(self, request):
-    """Override the http_request() processing.  Retrieve the data and files to
-    be posted, and create the data blob to send to the server.
+  def Acquire(self, key, connection_class, timeout, reuse=True):
+    """Returns a (connection, reused) tuple for the host of key.
 
-    The necessary Content-Type headers will also be added.
+    Args:
+      key - A key returned by Key().
+      connection_class - The httplib connection class used to open a new
+                         connection.
+      timeout - The socket timeout for the connection.
+      reuse - Whether an idle connection may be returned.  If False, a new
+              connection is opened, closing an idle one if the host is at
+              max_per_host.
     """
-    data = request.get_data()
-    if data is not None and type(data) == dict:
-      v_files = []
-      v_vars = []
-      try:
-        for key, value in data.iteritems():
-          if type(value) == file:
-            v_files.append((key, value))
-          else:
-            v_vars.append((key, value))
-      except TypeError:
-        systype, value, traceback = sys.exc_info()
-        raise TypeError, "not a valid non-string sequence or mapping object", traceback
-
-      if len(v_files) == 0:
-        data = urllib.urlencode(v_vars)
+    with self._cond:
+      self._ReapLocked(time.time())
+      while True:
+        idle = self._idle.get(key)
+        if idle and reuse:
+          conn = idle.pop()[0]
+          conn.timeout = timeout
+          if conn.sock:
+            conn.sock.settimeout(
+              None if timeout is socket._GLOBAL_DEFAULT_TIMEOUT else timeout)
+          return conn, True
+        if self._num_open.get(key, 0) < self.max_per_host:
+          self._num_open[key] = self._num_open.get(key, 0) + 1
+          break
+        if idle:
+          # Make room for the new connection.
+          idle.pop(0)[0].close()
+          self._num_open[key] -= 1
+          continue
+        self._cond.wait()
+
+    _, host, port = key
+    return connection_class(host, port, timeout=timeout), False
+
+  def Release(self, key, conn, reusable):
+    """Returns a connection that was obtained from Acquire() to the pool.
+
+    Args:
+      reusable - Whether the last response on the connection was read to the
+                 end and the connection may be used for another request.
+    """
+    with self._cond:
+      idle = self._idle.setdefault(key, [])
+      if reusable and len(idle) < self.max_idle_per_host:
+        idle.append((conn, time.time()))
       else:
-        boundary, data = self._MultipartEncode(v_vars, v_files)
-        contenttype = 'multipart/form-data; boundary=%s' % boundary
-        request.add_unredirected_header('Content-Type', contenttype)
+        conn.close()
+        self._num_open[key] -= 1
+      self._cond.notify()
 
-      request.add_data(data)
+  def Reap(self):
+    """Closes all connections that have been idle for too long.
+    """
+    with self._cond:
+      self._ReapLocked(time.time())
 
-    elif data is not None and isinstance(data, basestring):
-      request.add_data(data)
+  def Stats(self):
+    """Returns a dict of key -> (open connections, idle connections).
+    """
+    with self._cond:
+      return dict((key, (num_open, len(self._idle.get(key, []))))
+                  for key, num_open in self._num_open.iteritems())
+
+  def _ReapLocked(self, now):
+    for key, idle in self._idle.iteritems():
+      expired = [c for c, released in idle
+                 if now - released > self.idle_timeout_secs]
+      if not expired:
+        continue
+      idle[:] = [(c, released) for c, released in idle
+                 if now - released <= self.idle_timeout_secs]
+      for conn in expired:
+        conn.close()
+      self._num_open[key] -= len(expired)
+      self._cond.notifyAll()
+
+class _PooledResponseFile(object):
+  """A file-like wrapper around an httplib.HTTPResponse that returns its
+  connection to the pool once the response has been read to the end or
+  closed.
+  """
+  def __init__(self, pool, key, conn, response):
+    self._pool = pool
+    self._key = key
+    self._conn = conn
+    self._response = response
+
+  def read(self, amt=None):
+    if self._response is None:
+      return ''
+    data = self._response.read(amt)
+    if self._response.isclosed():
+      self._Release()
+    return data
+
+  def readline(self, limit=-1):
+    chars = []
+    while limit < 0 or len(chars) < limit:
+      c = self.read(1)
+      if not c:
+        break
+      chars.append(c)
+      if c == '\n':
+        break
+    return ''.join(chars)
 
-    return request
+  def readlines(self, sizehint=0):
+    return list(iter(self.readline, ''))
 
-  https_request = http_request
+  def close(self):
+    if self._response is not None:
+      self._Release()
 
-  def _MultipartEncode(self, vars, files, boundary=None, buf=None):
-    """Given the provided POST variables, and files, will encode the data
-    as a multipart message if files is present.
+  def __del__(self):
+    self.close()
 
-    Args:
-      vars - List of POST keys that should be sent in request
-      files - List of files that should be sent in the request
-      boundary - Boundary to be used to send the MIME request
-      buf - Buffer to use to construct the message data
+  def _Release(self):
+    response, self._response = self._response, None
+    reusable = response.isclosed() and not response.will_close
+    if not reusable:
+      response.close()
+    self._pool.Release(self._key, self._conn, reusable)
 
-    Returns:
-      Tuple of the chosen boundary and the buffer containing the message data.
-    """
-    if boundary is None:
-      boundary = mimetools.choose_boundary()
-
-    if buf is None:
-      buf = StringIO()
-
-    for key, value in vars:
-      buf.write('--%s\r\n' % boundary)
-      buf.write('Content-Disposition: form-data; name="%s"' % key)
-      buf.write('\r\n\r\n' + value + '\r\n')
-
-    for key, fd in files:
-      file_size = os.fstat(fd.fileno())[stat.ST_SIZE]
-      filename = fd.name.split('/')[-1]
-      contenttype = mimetypes.guess_type(filename)[0] or 'application/octet-stream'
-      buf.write('--%s\r\n' % boundary)
-      buf.write('Content-Disposition: form-data; name="%s"; filename="%s"\r\n' % (key, filename))
-      buf.write('Content-Type: %s\r\n' % contenttype)
-      fd.seek(0)
-      file_size = os.fstat(fd.fileno())[stat.ST_SIZE]
-
-      # Commenting out Content-Length for now, as it's not required, and there
-      # have been cases when I've seen erroneous lengths.
-      # buf.write('Content-Length: %s\r\n' % file_size)
-
-      buf.write('\r\n' + fd.read() + '\r\n')
-
-    buf.write('--' + boundary + '--\r\n\r\n')
-    buf = buf.getvalue()
-    return boundary, buf
-
-_MULTIPART_NO_REDIRECT_OPENER = urllib2.build_opener(
-  _MultipartPostHandler, _NoRedirectHandler)
-_MULTIPART_OPENER = urllib2.build_opener(_MultipartPostHandler)
-_KEEPALIVE_OPENER = urllib2.build_opener(keepalive.HTTPHandler)
+def _PooledOpen(pool, connection_class, scheme, req):
+  """Opens req on a pooled connection, in the manner of
+  urllib2.AbstractHTTPHandler.do_open().
+  """
+  host = req.get_host()
+  if not host:
+    raise urllib2.URLError('no host given')
+
+  headers = dict(req.unredirected_hdrs)
+  headers.update(dict((k, v) for k, v in req.headers.items()
+                      if k not in headers))
+  headers = dict((name.title(), val) for name, val in headers.items())
+
+  key = pool.Key(scheme, host)
+  reuse = True
+  while True:
+    conn, reused = pool.Acquire(key, connection_class, req.timeout, reuse)
+    try:
+      conn.request(req.get_method(), req.get_selector(), req.data, headers)
+      response = conn.getresponse()
+      break
+    except (socket.error, httplib.HTTPException), e:
+      pool.Release(key, conn, reusable=False)
+      # An idle connection may have been closed by the server in the meantime,
+      # so an idempotent request is retried once, on a new connection.
+      if (not reused or not _IsStaleConnectionError(e) or
+          req.get_method() not in _IDEMPOTENT_METHODS):
+        raise urllib2.URLError(e)
+      reuse = False
+
+  f = urllib2.addinfourl(_PooledResponseFile(pool, key, conn, response),
+                         response.msg, req.get_full_url())
+  f.code = response.status
+  f.msg = response.reason
+  return f
+
+# The methods whose requests are resent after failing on a stale connection.
+_IDEMPOTENT_METHODS = frozenset(['GET', 'HEAD', 'OPTIONS', 'PUT', 'DELETE'])
+
+# The errnos with which a request fails on a connection that the server has
+# closed.
+_STALE_CONNECTION_ERRNOS = frozenset([errno.ECONNRESET, errno.EPIPE])
+
+def _IsStaleConnectionError(e):
+  """Returns whether e is how a request fails on a connection that the server
+  closed while it was idle, as opposed to e.g. a timeout.
+  """
+  if isinstance(e, httplib.BadStatusLine):
+    return True
+  return (isinstance(e, socket.error) and
+          not isinstance(e, socket.timeout) and
+          e.errno in _STALE_CONNECTION_ERRNOS)
+
+class _PooledHTTPHandler(urllib2.HTTPHandler):
+  """An HTTP handler that sends requests over _CONNECTION_POOL.
+  """
+  def http_open(self, req):
+    return _PooledOpen(_CONNECTION_POOL, httplib.HTTPConnection, 'http', req)
+
+class _PooledHTTPSHandler(urllib2.HTTPSHandler):
+  """An HTTPS handler that sends requests over _CONNECTION_POOL.
+  """
+  def https_open(self, req):
+    return _PooledOpen(_CONNECTION_POOL, httplib.HTTPSConnection, 'https', req)
+
+# The pool of persistent connections used by all of the Fetch* functions.
+_CONNECTION_POOL = ConnectionPool()
+
+_NO_REDIRECT_OPENER = urllib2.build_opener(
+  _NoRedirectHandler, _PooledHTTPHandler, _PooledHTTPSHandler)
+_OPENER = urllib2.build_opener(_PooledHTTPHandler, _PooledHTTPSHandler)
+
+# follow_redirects -> the opener that also encodes dict POST data, built on
+# first use by _MultipartOpener().
+_MULTIPART_OPENERS = {}
+_MULTIPART_OPENERS_LOCK = threading.Lock()
+
+def _MultipartOpener(follow_redirects):
+  """Returns an opener like _OPENER or _NO_REDIRECT_OPENER that also encodes
+  dict POST data, with files as a multipart message.
+  """
+  with _MULTIPART_OPENERS_LOCK:
+    opener = _MULTIPART_OPENERS.get(follow_redirects)
+    if opener is None:
+      import multipart_post
+      handlers = [multipart_post.MultipartPostHandler, _PooledHTTPHandler,
+                  _PooledHTTPSHandler]
+      if not follow_redirects:
+        handlers.insert(1, _NoRedirectHandler)
+      opener = _MULTIPART_OPENERS[follow_redirects] = \
+          urllib2.build_opener(*handlers)
+    return opener
 
 def _GenericFetchFromUrl(url, body_output, headers=None, post_data=None,
                         follow_redirects=True, keep_alive=False,
                         basic_auth=False, user_agent=None, username=None,
-                        password=None, timeout_secs=None, http_method=None):
+                        password=None, timeout_secs=None, http_method=None,
+                        cache=None, cache_ttl_secs=None):
   """A generic HTTP fetcher.
 
   This function supports GET/POST requests and returns response headers and
@@ -357,7 +577,8 @@ def _GenericFetchFromUrl(url, body_output, headers=None, post_data=None,
   Args:
     url - The URL from which to fetch.
     body_output - A file-like object to which the HTTP response body will be
-                  written.
+                  written.  If None, the body is returned as the 'body'
+                  attribute of the result instead.
     headers - A dictionary of request headers, or None.
     post_data - A raw data string, or a dictionary or sequence of two-element
                 tuples representing POST data keys/values.  If None (default),
@@ -372,7 +593,8 @@ def _GenericFetchFromUrl(url, body_output, headers=None, post_data=None,
     follow_redirects - Whether to automatically follow redirects (HTTP 30x).
                        Default: True.
     keep_alive - Whether to set the 'Connection' request header to 'Keep-Alive'.
-                 Default: False.
+                 Default: False.  Connections are pooled and reused either
+                 way (see ConnectionPool).
     basic_auth - Whether to use basic HTTP authentication to make the request.
                  If True, the username and password params should be provided.
     user_agent - The user agent to use for this request, Uses the python
@@ -382,6 +604,11 @@ def _GenericFetchFromUrl(url, body_output, headers=None, post_data=None,
     timeout_secs - If present, the number of seconds after which to timeout the
                    request.
     http_method - If present, use this http method instead of the default.
+    cache - If present, an http_cache.HttpCache through which GET requests are
+            served.  Fresh entries are returned without a request, and stale
+            entries are revalidated with a conditional GET.
+    cache_ttl_secs - If present, the time for which a newly cached response is
+                     fresh.  Defaults to the cache's TTL.
 
   Returns
     A Bunch object representing the response, containing the attributes:
@@ -391,27 +618,60 @@ def _GenericFetchFromUrl(url, body_output, headers=None, post_data=None,
       * final_url - The real URL of the page.  In some cases, the server may
                     redirect the client to a different URL, so this value may
                     differ from that of the 'url' argument.
+      * cache_status - None if no cache was used, otherwise one of 'hit',
+                       'revalidated' or 'miss'.
+      * wire_bytes - The number of body bytes received over the network, before
+                     any gzip/deflate decoding.
+      * decoded_bytes - The number of body bytes after decoding.
   """
+  start_time = time.time()
   result = misc_util.Bunch(body=None, headers=None, status_code=None,
-                           final_url=None, exc=None)
-
-  headers = headers or {}
+                           final_url=None, exc=None, cache_status=None,
+                           wire_bytes=0, decoded_bytes=0)
+
+  headers = dict(headers or {})
+  headers.setdefault('Accept-Encoding', _ACCEPT_ENCODING)
+
+  if cache and (post_data is not None or http_method not in (None, 'GET')):
+    cache = None
+  cache_entry = cache and cache.Get(url)
+  # The body is opened up front, so that it can still be read after a 304 if
+  # the entry is evicted in the meantime.  An entry whose body is already
+  # gone is a miss.
+  cached_body = cache_entry and cache.OpenBody(cache_entry)
+  if cached_body:
+    if cache.IsFresh(cache_entry):
+      return _TraceFetch(
+        _CachedResult(cache, cache_entry, cached_body, body_output, result,
+                      'hit'),
+        start_time)
+    headers.update(cache.ConditionalHeaders(cache_entry))
+
+  body_buffer = None
+  if body_output is None:
+    body_output = body_buffer = StringIO()
+  cache_writer = None
+  if cache:
+    cache_writer = cache.OpenWriter(url)
+    body_output = _TeeFile(body_output, cache_writer)
 
   if user_agent:
     # Add a dummy User Agent as many sites block requests with invalid
     # user agent
     headers['User-Agent'] = user_agent
 
+  if keep_alive:
+    headers['Connection'] = 'Keep-Alive'
+
   try:
     if basic_auth and username and password:
       opener = _GetHTTPBasicAuthOpener(url, username, password)
-    elif keep_alive:
-      headers['Connection'] = 'Keep-Alive'
-      opener = _KEEPALIVE_OPENER
+    elif isinstance(post_data, dict):
+      opener = _MultipartOpener(follow_redirects)
     elif follow_redirects:
-      opener = _MULTIPART_OPENER
+      opener = _OPENER
     else:
-      opener = _MULTIPART_NO_REDIRECT_OPENER
+      opener = _NO_REDIRECT_OPENER
 
     request = urllib2.Request(url, post_data, headers)
 
@@ -424,17 +684,50 @@ def _GenericFetchFromUrl(url, body_output, headers=None, post_data=None,
       result.status_code = f.code
       result.final_url = f.geturl()
 
-      _ReadHttpBodyContent(f, body_output)
+      result.wire_bytes, result.decoded_bytes = _ReadHttpBodyContent(
+          f, body_output,
+          content_encoding=result.headers.getheader('content-encoding'))
 
     finally:
       f.close()
+
+    if cache_writer and result.status_code == httplib.OK:
+      cache_writer.Commit(result, cache_ttl_secs, decoded=_IsDecodedEncoding(
+        result.headers.getheader('content-encoding')))
+      cache_writer = None
+      result.cache_status = 'miss'
   except urllib2.HTTPError as e:
+    if e.code == httplib.NOT_MODIFIED and cached_body:
+      e.close()
+      cache.Refresh(cache_entry, cache_ttl_secs)
+      if body_buffer is not None:
+        body_buffer.close()
+        body_output = None
+      else:
+        body_output = body_output.primary
+      return _TraceFetch(
+        _CachedResult(cache, cache_entry, cached_body, body_output, result,
+                      'revalidated'),
+        start_time)
+
     result.headers = e.info()
     result.status_code = e.code
     result.final_url = e.geturl()
     result.exc = e
 
-    _ReadHttpBodyContent(e, body_output, catch_http_error=True)
+    try:
+      result.wire_bytes, result.decoded_bytes = _ReadHttpBodyContent(
+          e, body_output, catch_http_error=True,
+          content_encoding=(result.headers and
+                            result.headers.getheader('content-encoding')))
+    except IOError as read_error:
+      # A corrupt gzip/deflate error body, handled like the failures below.
+      result.headers = None
+      result.status_code = 503
+      result.final_url = None
+      result.exc = read_error
+    finally:
+      e.close()
 
   except IOError as e:
     result.headers = None
@@ -442,9 +735,69 @@ def _GenericFetchFromUrl(url, body_output, headers=None, post_data=None,
     result.final_url = None
     result.exc = e
 
+  finally:
+    if cache_writer:
+      cache_writer.Abort()
+    if cached_body:
+      cached_body.close()
+
+  if body_buffer is not None:
+    result.body = body_buffer.getvalue()
+    body_buffer.close()
+
+  return _TraceFetch(result, start_time)
+
+def _TraceFetch(result, start_time):
+  """Records the status, size and latency of a finished fetch with the
+  tracing module.
+
+  Returns:
+    result
+  """
+  if tracing.IsEnabled():
+    tracing.Count('http.requests')
+    tracing.Count('http.status.%s' % result.status_code)
+    tracing.Count('http.wire_bytes', result.wire_bytes)
+    tracing.Count('http.decoded_bytes', result.decoded_bytes)
+    if result.cache_status:
+      tracing.Count('http.cache.%s' % result.cache_status)
+    tracing.Observe('http.latency_ms', (time.time() - start_time) * 1e3)
+  return result
+
+def _CachedResult(cache, cache_entry, cached_body, body_output, result,
+                  cache_status):
+  """Fills in result from a cache entry, whose body was opened with
+  HttpCache.OpenBody() as cached_body.  Closes cached_body.
+
+  If body_output is None, the cached body is returned as result.body without
+  an intermediate copy.
+  """
+  result.headers = cache.Headers(cache_entry)
+  result.status_code = cache_entry.status_code
+  result.final_url = cache_entry.final_url
+  result.cache_status = cache_status
+  with cached_body:
+    if body_output is None:
+      result.body = cached_body.read()
+      result.decoded_bytes = len(result.body)
+    else:
+      shutil.copyfileobj(cached_body, body_output)
+      result.decoded_bytes = cached_body.tell()
   return result
 
-def _ReadHttpBodyContent(input_file, output_file, catch_http_error=False):
+class _TeeFile(object):
+  """A write-only file-like object that writes to two files.
+  """
+  def __init__(self, primary, secondary):
+    self.primary = primary
+    self.secondary = secondary
+
+  def write(self, data):
+    self.primary.write(data)
+    self.secondary.write(data)
+
+def _ReadHttpBodyContent(input_file, output_file, catch_http_error=False,
+                         content_encoding=None):
   """Read HTTP response body content from 'input_file' in chunks of size
   _HTTP_READ_BUFFER_SIZE.
 
@@ -457,15 +810,78 @@ def _ReadHttpBodyContent(input_file, output_file, catch_http_error=False):
                        should only be set to True if _ReadHttpBodyContent() is
                        called from within an exception handler for an HTTPError
                        that already occurred. (default: False)
+    content_encoding - The Content-Encoding of the response.  gzip and deflate
+                       bodies are decompressed chunk by chunk as they are
+                       read; any other encoding is written as-is.
+
+  Returns:
+    A (wire_bytes, decoded_bytes) tuple with the number of bytes read from
+    input_file and the number of bytes written to output_file.
   """
+  decoder = _BodyDecoder(content_encoding)
+  wire_bytes = decoded_bytes = 0
   try:
     while True:
       body_chunk = input_file.read(_HTTP_READ_BUFFER_SIZE)
-      if body_chunk:
-        output_file.write(body_chunk)
+      wire_bytes += len(body_chunk)
+      decoded_chunk = decoder.Decode(body_chunk)
+      if decoded_chunk:
+        output_file.write(decoded_chunk)
+        decoded_bytes += len(decoded_chunk)
       if len(body_chunk) < _HTTP_READ_BUFFER_SIZE:
         break
+    decoded_chunk = decoder.Flush()
+    if decoded_chunk:
+      output_file.write(decoded_chunk)
+      decoded_bytes += len(decoded_chunk)
   except urllib2.HTTPError, e:
     if not catch_http_error:
       raise e
 
+  return wire_bytes, decoded_bytes
+
+# The content codings that _BodyDecoder decodes.
+_GZIP_ENCODINGS = ('gzip', 'x-gzip')
+_DEFLATE_ENCODING = 'deflate'
+
+def _IsDecodedEncoding(content_encoding):
+  """Returns whether a body with the Content-Encoding is decoded as it's read,
+  rather than written as-is.
+  """
+  return ((content_encoding or '').strip().lower() in
+          _GZIP_ENCODINGS + (_DEFLATE_ENCODING,))
+
+class _BodyDecoder(object):
+  """Incrementally decodes a gzip or deflate encoded response body.
+  """
+  def __init__(self, content_encoding):
+    self._encoding = (content_encoding or '').strip().lower()
+    if self._encoding in _GZIP_ENCODINGS:
+      self._decompressor = zlib.decompressobj(16 + zlib.MAX_WBITS)
+    elif self._encoding == _DEFLATE_ENCODING:
+      self._decompressor = zlib.decompressobj()
+    else:
+      self._decompressor = None
+    self._first_chunk = True
+
+  def Decode(self, chunk):
+    if not self._decompressor or not chunk:
+      return chunk
+    try:
+      try:
+        return self._decompressor.decompress(chunk)
+      except zlib.error:
+        # Some servers send raw deflate data without the zlib wrapper.
+        if self._encoding != _DEFLATE_ENCODING or not self._first_chunk:
+          raise
+        self._decompressor = zlib.decompressobj(-zlib.MAX_WBITS)
+        return self._decompressor.decompress(chunk)
+    except zlib.error, e:
+      raise IOError('Invalid %s response body: %s' % (self._encoding, e))
+    finally:
+      self._first_chunk = False
+
+  def Flush(self):
+    if not self._decompressor:
+      return ''
+    return self._decompressor.flush()
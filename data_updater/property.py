@@ -7,40 +7,85 @@ import zillow_api_wrapper as zaw
 
 class Property(object):
 
-  def __init__(self, property_attributes):
+  def __init__(self, property_attributes, row=None):
     self.property_attributes = property_attributes
+    # The 0-based spreadsheet row of the property, if it was loaded from one.
+    self.row = row
 
   def __repr__(self):
     return str(self.property_attributes)
 
   @staticmethod
-  def FromSpreadsheet(header, spreadsheet_cells):
+  def FromSpreadsheet(header, spreadsheet_cells, row=None):
     """Creates a property object from the provided spreadsheet attributes.
     """
-    attrs = []
+    property_attributes = attributes.PropertyAttributes()
     for i, cell in enumerate(spreadsheet_cells.values()):
-      if cell.value:
-        a = attributes.FromName(header[i].value, cell.value)
-        if a:
-          attrs.append(a)
-    return Property(attributes.PropertyAttributes(attrs))
+      if cell.value and header[i].value in attributes.NAME_TO_INDEX:
+        property_attributes.SetValue(header[i].value, cell.value)
+    return Property(property_attributes, row)
 
   def RenderToSpreadsheet(self, spreadsheet_cells):
     self.property_attributes.RenderToSpreadsheet(spreadsheet_cells)
     return spreadsheet_cells
 
-  def LoadFromZillow(self):
+  def GetZillowId(self):
+    """Returns the Zillow property id, or None if the property has none.
+    """
+    if not self.property_attributes.HasValue('zillow_id'):
+      return None
+    return self.property_attributes.GetValue('zillow_id')
+
+  def LoadFromZillow(self, store=None):
     """Loads the property data from Zillow.
+
+    If a property_store.PropertyStore is provided, the merged attributes are
+    recorded in it as a new snapshot.
+    """
+    zillow_attrs = zaw.LoadZillowProperty(self.GetZillowId())
+    self.MergeZillowAttributes(zillow_attrs)
+    if zillow_attrs and store:
+      store.RecordSnapshot(zaw.NormalizeZpid(self.GetZillowId()),
+                           self.property_attributes)
+
+  def LoadFromStore(self, store):
+    """Fills in the attributes that have no value from the latest attributes
+    recorded in the property store, if any.
+
+    The values the property already has, e.g. from a cell that was edited in
+    the sheet, are kept: a property that was fetched in this run has its
+    fetched values, and one that wasn't keeps the values of the sheet.
     """
-    zillow_attrs = zaw.LoadZillowProperty(
-      self.property_attributes.GetValue('zillow_id'))
-    self.property_attributes.Merge(zillow_attrs)
+    zpid = self.GetZillowId()
+    stored_attrs = zpid and store.LoadAttributes(zaw.NormalizeZpid(zpid))
+    if stored_attrs:
+      self.property_attributes.UpdateDerivedAttributes(
+        self.property_attributes.MergeMissing(stored_attrs))
+
+  def MergeZillowAttributes(self, zillow_attrs):
+    """Merges the attributes loaded from Zillow into this property.
+
+    A failed load (None) leaves the current attributes untouched.  The
+    derived attributes that depend on the changed attributes are reevaluated.
+    """
+    if zillow_attrs:
+      self.property_attributes.UpdateDerivedAttributes(
+        self.property_attributes.Merge(zillow_attrs))
 
 def ParseFromSpreadsheet(spreadsheet_cells):
   """Parses into a list of Property objects from the spreadsheet data.
+
+  Row 0 is the header, and every other row that is present is a property.
+  """
+  return [Property.FromSpreadsheet(spreadsheet_cells[0], spreadsheet_cells[r], r)
+          for r in sorted(spreadsheet_cells.keys()) if r > 0]
+
+def RecomputeDerivedAttributes(properties):
+  """Recomputes the derived attributes of all of the properties from their
+  current attribute values, without fetching anything.
   """
-  return [Property.FromSpreadsheet(spreadsheet_cells[0], spreadsheet_cells[r+1])
-          for r in xrange(len(spreadsheet_cells) - 1)]
+  for p in properties:
+    p.property_attributes.UpdateDerivedAttributes()
 
 def RenderToSpreadsheet(properties, all_cells):
   """Render the properties objects to spreadsheet cells.
@@ -50,5 +95,6 @@ def RenderToSpreadsheet(properties, all_cells):
   """
   rows = {0: attributes.RenderHeaderToSpreadsheet(all_cells[0])}
   for i, p in enumerate(properties):
-    rows[i + 1] = p.RenderToSpreadsheet(all_cells[i+1])
+    row = i + 1 if p.row is None else p.row
+    rows[row] = p.RenderToSpreadsheet(all_cells[row])
   return rows
@@ -0,0 +1,104 @@
+"""A local SQLite store of the properties and their history.
+
+The 'properties' table holds the latest attributes of each property, keyed by
+Zillow id, and the append-only 'snapshots' table holds the attributes of the
+property after every fetch, so that price and estimate history can be queried
+without going through the spreadsheet.
+"""
+
+import errno
+import json
+import os
+import sqlite3
+import threading
+import time
+
+import attributes
+
+_SCHEMA = [
+  '''CREATE TABLE IF NOT EXISTS properties (
+       zpid TEXT PRIMARY KEY,
+       attributes TEXT NOT NULL,
+       updated_at REAL NOT NULL)''',
+  '''CREATE TABLE IF NOT EXISTS snapshots (
+       id INTEGER PRIMARY KEY AUTOINCREMENT,
+       zpid TEXT NOT NULL,
+       fetched_at REAL NOT NULL,
+       attributes TEXT NOT NULL)''',
+  '''CREATE INDEX IF NOT EXISTS snapshots_zpid_fetched_at
+       ON snapshots (zpid, fetched_at)''',
+  '''CREATE INDEX IF NOT EXISTS snapshots_fetched_at
+       ON snapshots (fetched_at)''',
+]
+
+class PropertyStore(object):
+  """A thread-safe handle to the property database.
+  """
+
+  def __init__(self, db_path):
+    """
+    Args:
+      db_path - The path of the SQLite database file, which is created if it
+                doesn't exist.
+    """
+    db_dir = os.path.dirname(db_path)
+    if db_dir:
+      try:
+        os.makedirs(db_dir)
+      except OSError, e:
+        if e.errno != errno.EEXIST:
+          raise
+
+    self.db_path = db_path
+    self._lock = threading.Lock()
+    self._conn = sqlite3.connect(db_path, check_same_thread=False)
+    with self._lock:
+      for statement in _SCHEMA:
+        self._conn.execute(statement)
+      self._conn.commit()
+
+  def RecordSnapshot(self, zpid, property_attributes, fetched_at=None):
+    """Stores the attributes of a property that was just fetched, both as its
+    latest attributes and as a new snapshot.
+    """
+    fetched_at = fetched_at or time.time()
+    attrs_json = json.dumps(property_attributes.ToDict(), sort_keys=True)
+    with self._lock:
+      self._conn.execute(
+        'INSERT INTO snapshots (zpid, fetched_at, attributes) '
+        'VALUES (?, ?, ?)', (zpid, fetched_at, attrs_json))
+      self._conn.execute(
+        'INSERT OR REPLACE INTO properties (zpid, attributes, updated_at) '
+        'VALUES (?, ?, ?)', (zpid, attrs_json, fetched_at))
+
+  def LoadAttributes(self, zpid):
+    """Returns the latest PropertyAttributes of the property, or None.
+    """
+    with self._lock:
+      row = self._conn.execute(
+        'SELECT attributes FROM properties WHERE zpid = ?', (zpid,)).fetchone()
+    return attributes.FromDict(json.loads(row[0])) if row else None
+
+  def History(self, zpid, since=None):
+    """Returns the snapshots of the property as a list of
+    (fetched_at, PropertyAttributes) tuples, oldest first.
+
+    Args:
+      since - If present, only snapshots fetched at or after this time.
+    """
+    with self._lock:
+      rows = self._conn.execute(
+        'SELECT fetched_at, attributes FROM snapshots '
+        'WHERE zpid = ? AND fetched_at >= ? ORDER BY fetched_at',
+        (zpid, since or 0)).fetchall()
+    return [(fetched_at, attributes.FromDict(json.loads(attrs_json)))
+            for fetched_at, attrs_json in rows]
+
+  def Commit(self):
+    with self._lock:
+      self._conn.commit()
+
+  def Close(self):
+    with self._lock:
+      self._conn.commit()
+      self._conn.close()
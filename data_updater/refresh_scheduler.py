@@ -0,0 +1,141 @@
+"""Decides which properties are due to be refreshed from Zillow.
+
+The scheduler remembers, per Zillow id, when the listing was last fetched and
+when its status, price or estimate last changed.  Each property gets a refresh
+interval from its status and days on Zillow, so that hot listings are fetched
+often and off-market ones rarely, and only the properties whose interval has
+elapsed are fetched in a run.
+"""
+
+import errno
+import json
+import os
+import tempfile
+import time
+
+from misc_util import GetInt
+
+_HOUR_SECS = 60 * 60
+_DAY_SECS = 24 * _HOUR_SECS
+
+# Refresh intervals by the kind of listing.
+_NEW_LISTING_INTERVAL_SECS = 6 * _HOUR_SECS
+_ACTIVE_INTERVAL_SECS = _DAY_SECS
+_PENDING_INTERVAL_SECS = 2 * _DAY_SECS
+_OFF_MARKET_INTERVAL_SECS = 14 * _DAY_SECS
+
+# Listings with at most this many days on Zillow count as new.
+_NEW_LISTING_MAX_DAYS = 14
+
+# Listings that haven't changed for this long are refreshed half as often.
+_STABLE_AFTER_SECS = 30 * _DAY_SECS
+
+# The attributes whose changes count as a change of the listing.
+_CHANGE_ATTRIBUTES = ('status', 'price', 'estimate')
+
+class RefreshScheduler(object):
+  """Tracks the fetch history of each Zillow id, persisted as a JSON file.
+  """
+
+  def __init__(self, state_path):
+    self.state_path = state_path
+    # zpid -> {'last_fetch': secs, 'last_change': secs, 'fingerprint': str}
+    self._state = {}
+    try:
+      with open(state_path) as f:
+        self._state = json.load(f)
+    except IOError, e:
+      if e.errno != errno.ENOENT:
+        raise
+
+  def RefreshIntervalSecs(self, zpid, property_attributes):
+    """Returns the time after which the property should be fetched again.
+    """
+    status = _Value(property_attributes, 'status').lower()
+    if 'pending' in status or 'contingent' in status:
+      interval_secs = _PENDING_INTERVAL_SECS
+    elif 'off market' in status or 'sold' in status:
+      interval_secs = _OFF_MARKET_INTERVAL_SECS
+    else:
+      days_on_zillow = _Value(property_attributes, 'days_on_zillow')
+      if days_on_zillow and GetInt(days_on_zillow) <= _NEW_LISTING_MAX_DAYS:
+        interval_secs = _NEW_LISTING_INTERVAL_SECS
+      else:
+        interval_secs = _ACTIVE_INTERVAL_SECS
+
+    history = self._state.get(zpid)
+    if history and time.time() - history['last_change'] > _STABLE_AFTER_SECS:
+      interval_secs *= 2
+    return interval_secs
+
+  def SelectDue(self, zpid_to_attributes, max_fetches=None):
+    """Returns the Zillow ids that are due for a refresh.
+
+    Args:
+      zpid_to_attributes - A dict of zpid -> the current PropertyAttributes.
+      max_fetches - If present, at most this many ids are returned.  Ids that
+                    were never fetched come first, then the most overdue ones.
+
+    Returns:
+      The list of due zpids.
+    """
+    now = time.time()
+    overdue = []
+    for zpid, attrs in zpid_to_attributes.iteritems():
+      overdue_secs = self._OverdueSecs(zpid, attrs, now)
+      if overdue_secs >= 0:
+        overdue.append((overdue_secs, zpid))
+
+    overdue.sort(reverse=True)
+    return [zpid for _, zpid in overdue[:max_fetches]]
+
+  def IsDue(self, zpid, property_attributes):
+    """Returns whether a single property is due for a refresh, for callers
+    that decide one property at a time.
+    """
+    return self._OverdueSecs(zpid, property_attributes, time.time()) >= 0
+
+  def _OverdueSecs(self, zpid, property_attributes, now):
+    """Returns the time since the property became due, which is infinite if
+    it was never fetched and negative if it isn't due yet.
+    """
+    history = self._state.get(zpid)
+    if not history:
+      return float('inf')
+    return (now - history['last_fetch'] -
+            self.RefreshIntervalSecs(zpid, property_attributes))
+
+  def RecordFetch(self, zpid, property_attributes):
+    """Records that the property was just fetched with the given attributes.
+    """
+    now = time.time()
+    fingerprint = '\t'.join(
+      _Value(property_attributes, name) for name in _CHANGE_ATTRIBUTES)
+    history = self._state.get(zpid)
+    if not history or history['fingerprint'] != fingerprint:
+      history = self._state[zpid] = {'last_change': now,
+                                     'fingerprint': fingerprint}
+    history['last_fetch'] = now
+
+  def Save(self):
+    """Writes the state file.
+    """
+    state_dir = os.path.dirname(self.state_path) or '.'
+    try:
+      os.makedirs(state_dir)
+    except OSError, e:
+      if e.errno != errno.EEXIST:
+        raise
+
+    fd, temp_path = tempfile.mkstemp(dir=state_dir, suffix='.tmp')
+    with os.fdopen(fd, 'w') as f:
+      json.dump(self._state, f)
+    os.rename(temp_path, self.state_path)
+
+def _Value(property_attributes, name):
+  if not property_attributes.HasValue(name):
+    return u''
+  value = property_attributes.GetValue(name)
+  if isinstance(value, str):
+    return value.decode('utf-8', 'replace')
+  return unicode(value)
@@ -0,0 +1,176 @@
+"""A durable record of the fetches of an update run, from which a run that
+died halfway is resumed.
+
+The checkpoint is a file of JSON lines, appended to and flushed to disk as
+each fetch completes:
+
+  {"started_at": 1444444444.0}
+  {"zpid": "24838363", "attributes": {...}}
+  {"zpid": "15155842", "error": "Unexpected home details page: ...",
+   "skip": true}
+
+A rerun that finds the checkpoint of an unfinished run takes the fetched
+attributes from it instead of fetching them again, and skips the properties
+whose failures are marked to be skipped, e.g. pages that could not be parsed.
+Other failures, such as timeouts, are fetched again.  Once a run completes,
+its checkpoint is removed.
+"""
+
+import errno
+import json
+import os
+import threading
+import time
+
+import attributes
+
+class RunCheckpoint(object):
+  """The checkpoint of the current run.  Thread-safe.
+  """
+
+  def __init__(self, path, max_age_secs=None):
+    """Opens the checkpoint, resuming the run recorded in it, if any.
+
+    Args:
+      path - The path of the checkpoint file.
+      max_age_secs - If present, a checkpoint of a run that started longer
+                     ago than this is discarded rather than resumed, so that
+                     stale data isn't written to the sheets.
+    """
+    self.path = path
+    self._lock = threading.Lock()
+    # zpid -> attribute dict
+    self._fetched = {}
+    # zpid -> (error, skip)
+    self._failed = {}
+    self.started_at = None
+
+    records = _ReadRecords(path)
+    if records and 'started_at' in records[0]:
+      started_at = records[0]['started_at']
+      if max_age_secs is None or time.time() - started_at <= max_age_secs:
+        self.started_at = started_at
+        self._Load(records[1:])
+    self.resumed = self.started_at is not None
+    if self.resumed:
+      print 'Resuming the run started at %s: %d fetched, %d failed' % (
+        time.ctime(self.started_at), len(self._fetched), len(self._failed))
+
+    path_dir = os.path.dirname(path)
+    if path_dir:
+      try:
+        os.makedirs(path_dir)
+      except OSError, e:
+        if e.errno != errno.EEXIST:
+          raise
+    if self.resumed:
+      self._file = open(path, 'a')
+      if not _EndsWithNewline(path):
+        # Terminate the partly written last record.
+        self._file.write('\n')
+    else:
+      self.started_at = time.time()
+      self._file = open(path, 'w')
+      self._Append({'started_at': self.started_at})
+
+  def _Load(self, records):
+    for record in records:
+      zpid = record.get('zpid')
+      if not zpid:
+        continue
+      if 'attributes' in record:
+        self._fetched[zpid] = record['attributes']
+        self._failed.pop(zpid, None)
+      else:
+        self._failed[zpid] = (record.get('error'), record.get('skip', False))
+
+  def GetAttributes(self, zpid):
+    """Returns the PropertyAttributes recorded for zpid, or None.
+    """
+    with self._lock:
+      attrs = self._fetched.get(zpid)
+    return attributes.FromDict(attrs) if attrs is not None else None
+
+  def ShouldSkip(self, zpid):
+    """Returns whether zpid failed in a way that isn't worth retrying.
+    """
+    with self._lock:
+      return self._failed.get(zpid, (None, False))[1]
+
+  def RecordFetch(self, zpid, property_attributes):
+    """Records the attributes fetched for zpid.
+    """
+    attrs = property_attributes.ToDict()
+    with self._lock:
+      self._fetched[zpid] = attrs
+      self._failed.pop(zpid, None)
+      self._Append({'zpid': zpid, 'attributes': attrs})
+
+  def RecordFailure(self, zpid, error, skip=False):
+    """Records a failed fetch of zpid.
+
+    Args:
+      zpid - The Zillow id.
+      error - A description of the failure.
+      skip - Whether a resumed run should skip zpid instead of retrying it.
+    """
+    with self._lock:
+      self._failed[zpid] = (error, skip)
+      self._Append({'zpid': zpid, 'error': error, 'skip': skip})
+
+  def Failures(self):
+    """Returns a dict of zpid -> error of the fetches of the run that failed
+    and haven't succeeded since, including those from before it was resumed.
+    """
+    with self._lock:
+      return dict((zpid, error)
+                  for zpid, (error, _) in self._failed.iteritems())
+
+  def Complete(self):
+    """Removes the checkpoint once the run has completed.
+    """
+    with self._lock:
+      self._file.close()
+      try:
+        os.remove(self.path)
+      except OSError, e:
+        if e.errno != errno.ENOENT:
+          raise
+
+  def _Append(self, record):
+    """Appends a record and flushes it to disk.  Must be called with the lock
+    held (or before the checkpoint is shared).
+    """
+    self._file.write(json.dumps(record, sort_keys=True) + '\n')
+    self._file.flush()
+    os.fsync(self._file.fileno())
+
+def _ReadRecords(path):
+  """Returns the records of the checkpoint file, or [] if there is none.  A
+  partly written last line, from a run killed mid-write, is dropped.
+  """
+  try:
+    with open(path) as f:
+      lines = f.readlines()
+  except IOError, e:
+    if e.errno != errno.ENOENT:
+      raise
+    return []
+
+  records = []
+  for line in lines:
+    if not line.strip():
+      continue
+    try:
+      records.append(json.loads(line))
+    except ValueError:
+      print 'Ignoring a malformed checkpoint record: %r' % line[:80]
+  return records
+
+def _EndsWithNewline(path):
+  with open(path, 'rb') as f:
+    f.seek(0, os.SEEK_END)
+    if not f.tell():
+      return True
+    f.seek(-1, os.SEEK_END)
+    return f.read(1) == '\n'
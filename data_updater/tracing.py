@@ -0,0 +1,251 @@
+"""Lightweight instrumentation of the update pipeline.
+
+Code is instrumented with spans, counters and histograms:
+
+  with tracing.Span('parse', zpid=zpid):
+    ...
+  tracing.Count('http.status.200')
+  tracing.Observe('http.latency_ms', latency_ms)
+
+All of these do nothing until Enable() is called, so that instrumented code
+costs a single global lookup per call when tracing is off.  Once enabled,
+the recorded events can be summarized with Summary() and exported with
+WriteChromeTrace() for chrome://tracing or Perfetto.
+"""
+
+import json
+import math
+import os
+import threading
+import time
+
+# The active Tracer, or None when tracing is disabled.
+_TRACER = None
+
+class Tracer(object):
+  """Collects the spans, counters and histograms of a run.
+  """
+
+  def __init__(self):
+    self.start_time = time.time()
+    self._lock = threading.Lock()
+    # Chrome trace events of the finished spans.
+    self._events = []
+    # Span name -> [count, total secs, max secs]
+    self._span_stats = {}
+    # Counter name -> total
+    self._counters = {}
+    # Histogram name -> _Histogram
+    self._histograms = {}
+
+  def AddSpan(self, name, start_time, end_time, args):
+    secs = end_time - start_time
+    event = {
+      'name': name,
+      'cat': name.split('.')[0],
+      'ph': 'X',
+      'ts': int((start_time - self.start_time) * 1e6),
+      'dur': int(secs * 1e6),
+      'pid': os.getpid(),
+      'tid': threading.current_thread().ident,
+    }
+    if args:
+      event['args'] = args
+    with self._lock:
+      self._events.append(event)
+      stats = self._span_stats.setdefault(name, [0, 0.0, 0.0])
+      stats[0] += 1
+      stats[1] += secs
+      stats[2] = max(stats[2], secs)
+
+  def Count(self, name, value):
+    with self._lock:
+      self._counters[name] = self._counters.get(name, 0) + value
+
+  def Observe(self, name, value):
+    with self._lock:
+      if name not in self._histograms:
+        self._histograms[name] = _Histogram()
+      self._histograms[name].Add(value)
+
+  def Counters(self):
+    with self._lock:
+      return dict(self._counters)
+
+  def Percentile(self, name, p):
+    with self._lock:
+      if name not in self._histograms:
+        return None
+      return self._histograms[name].Percentile(p)
+
+  def Summary(self):
+    """Returns a text summary of the run: the time spent in each kind of
+    span, the counters and the histogram percentiles.
+    """
+    with self._lock:
+      lines = ['Run time: %.3fs' % (time.time() - self.start_time)]
+      if self._span_stats:
+        lines.append('%-32s %8s %12s %12s %12s' % (
+          'span', 'count', 'total secs', 'mean ms', 'max ms'))
+        for name, (count, total, longest) in sorted(
+            self._span_stats.iteritems(), key=lambda x: -x[1][1]):
+          lines.append('%-32s %8d %12.3f %12.2f %12.2f' % (
+            name, count, total, total * 1e3 / count, longest * 1e3))
+      if self._counters:
+        lines.append('%-32s %12s' % ('counter', 'value'))
+        for name, value in sorted(self._counters.iteritems()):
+          lines.append('%-32s %12s' % (name, value))
+      if self._histograms:
+        lines.append('%-32s %8s %10s %10s %10s %10s' % (
+          'histogram', 'count', 'p50', 'p90', 'p99', 'max'))
+        for name, h in sorted(self._histograms.iteritems()):
+          lines.append('%-32s %8d %10.1f %10.1f %10.1f %10.1f' % (
+            name, h.count, h.Percentile(50), h.Percentile(90),
+            h.Percentile(99), h.max))
+    return '\n'.join(lines)
+
+  def ChromeTrace(self):
+    """Returns the run in the Chrome trace-event format, with the counters as
+    counter events at the end of the run.
+    """
+    with self._lock:
+      events = list(self._events)
+      ts = int((time.time() - self.start_time) * 1e6)
+      for name, value in sorted(self._counters.iteritems()):
+        events.append({'name': name, 'ph': 'C', 'ts': ts, 'pid': os.getpid(),
+                       'args': {'value': value}})
+    return {'traceEvents': events, 'displayTimeUnit': 'ms'}
+
+class _Histogram(object):
+  """A histogram with logarithmic buckets, 10 per power of ten, so that
+  percentiles are within about 12% of the exact values.
+  """
+
+  _BUCKETS_PER_DECADE = 10
+
+  def __init__(self):
+    self.count = 0
+    self.max = 0
+    # Bucket index -> count
+    self._buckets = {}
+
+  def Add(self, value):
+    self.count += 1
+    self.max = max(self.max, value)
+    bucket = self._Bucket(value)
+    self._buckets[bucket] = self._buckets.get(bucket, 0) + 1
+
+  def Percentile(self, p):
+    """Returns the upper bound of the bucket holding the p-th percentile.
+    """
+    rank = self.count * p / 100.0
+    seen = 0
+    for bucket in sorted(self._buckets):
+      seen += self._buckets[bucket]
+      if seen >= rank:
+        upper_bound = 10 ** (float(bucket + 1) / self._BUCKETS_PER_DECADE)
+        return min(self.max, upper_bound)
+    return self.max
+
+  def _Bucket(self, value):
+    if value <= 0:
+      return -10 * self._BUCKETS_PER_DECADE
+    return int(math.floor(math.log10(value) * self._BUCKETS_PER_DECADE))
+
+class _Span(object):
+  """A span that records its duration with the tracer when it ends.
+  """
+  __slots__ = ('_tracer', '_name', '_args', '_start_time')
+
+  def __init__(self, tracer, name, args):
+    self._tracer = tracer
+    self._name = name
+    self._args = args
+    self._start_time = None
+
+  def Set(self, key, value):
+    """Adds an argument to the span, e.g. a result known only at its end.
+    """
+    self._args[key] = value
+
+  def __enter__(self):
+    self._start_time = time.time()
+    return self
+
+  def __exit__(self, exc_type, exc_value, tb):
+    if exc_type is not None:
+      self._args['error'] = repr(exc_value)
+    self._tracer.AddSpan(self._name, self._start_time, time.time(), self._args)
+
+class _NullSpan(object):
+  """The span returned while tracing is disabled.
+  """
+  __slots__ = ()
+
+  def Set(self, key, value):
+    pass
+
+  def __enter__(self):
+    return self
+
+  def __exit__(self, exc_type, exc_value, tb):
+    pass
+
+_NULL_SPAN = _NullSpan()
+
+def Enable():
+  """Starts recording, discarding anything recorded before.
+  """
+  global _TRACER
+  _TRACER = Tracer()
+
+def Disable():
+  global _TRACER
+  _TRACER = None
+
+def IsEnabled():
+  return _TRACER is not None
+
+def Span(name, **args):
+  """Returns a context manager that records the time spent in its block as a
+  span with the given name and arguments.
+  """
+  if _TRACER is None:
+    return _NULL_SPAN
+  return _Span(_TRACER, name, args)
+
+def Count(name, value=1):
+  """Adds value to the named counter.
+  """
+  if _TRACER is not None:
+    _TRACER.Count(name, value)
+
+def Observe(name, value):
+  """Adds a value, e.g. a latency in ms, to the named histogram.
+  """
+  if _TRACER is not None:
+    _TRACER.Observe(name, value)
+
+def Counters():
+  """Returns a dict of counter name -> value, empty if tracing is disabled.
+  """
+  return _TRACER.Counters() if _TRACER else {}
+
+def Percentile(name, p):
+  """Returns the p-th percentile of the named histogram, or None if it has no
+  values.
+  """
+  return _TRACER.Percentile(name, p) if _TRACER else None
+
+def Summary():
+  """Returns the summary of the run, or '' if tracing is disabled.
+  """
+  return _TRACER.Summary() if _TRACER else ''
+
+def WriteChromeTrace(path):
+  """Writes the run as Chrome trace-event JSON.
+  """
+  if _TRACER is None:
+    return
+  with open(path, 'w') as f:
+    json.dump(_TRACER.ChromeTrace(), f)
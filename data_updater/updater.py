@@ -2,46 +2,784 @@
 current information.
 """
 
+import collections
+import optparse
+import os
+import Queue
+import threading
+import time
+
+import attributes
+import extract_pool as ep
+import fetch_controller
 import google_sheets_wrapper as gsw
 import zillow_api_wrapper as zaw
+import zillow_xml_api
+import net_util
 import property
+import property_store
+import refresh_scheduler
+import run_checkpoint
+import tracing
+from misc_util import Bunch, RunInThreads
 
 _SPREADSHEET_NAME = 'Real Estate'
 _BATCH_ROWS = 10
 _BUY_SHEET_NAME = 'Buy'
 _RENT_SHEET_NAME = 'Rent'
+_SHEET_NAMES = (
+  _BUY_SHEET_NAME,
+  _RENT_SHEET_NAME,
+  )
+
+# Defaults for fetching the property details from Zillow.
+_NUM_FETCH_WORKERS = 8
+_MAX_REQUESTS_PER_SEC = 4.0
+_FETCH_TIMEOUT_SECS = 30
+_MAX_FETCH_TRIES = 4
+# The number of concurrent fetches at the start of a run, from which it adapts
+# up to the number of workers.
+_INITIAL_FETCH_CONCURRENCY = 4
+
+# Defaults for streaming the rows through the update (see
+# StreamUpdateSheet()).
+_STREAM_ROWS_PER_READ = 200
+_STREAM_ROWS_PER_WRITE = 50
+_STREAM_FLUSH_INTERVAL_SECS = 5.0
+# How often a wait for a fetch to complete is interrupted to check whether a
+# partial batch is due to be written.
+_STREAM_POLL_SECS = 0.25
+# The number of recent fetch results kept, so that a property that appears
+# again shortly after, e.g. in the next sheet, isn't fetched twice.
+_STREAM_RECENT_FETCHES = 1000
+
+# Backend name -> the function that loads a property with it.
+_LOADERS = {
+  'html': zaw.LoadZillowProperty,
+  'xml': zillow_xml_api.LoadZillowProperty,
+}
+
+# Defaults for the persistent cache of fetched Zillow pages.
+_CACHE_DIR = os.path.expanduser('~/.realestate/http_cache')
+_CACHE_TTL_SECS = 6 * 60 * 60
+
+# Where the refresh history of each property is kept between runs.
+_REFRESH_STATE_PATH = os.path.expanduser('~/.realestate/refresh_state.json')
 
-def UpdateSheet():
+# The record of the fetches of the current run, from which a run that died is
+# resumed, and the age after which such a run is started over instead.
+_CHECKPOINT_PATH = os.path.expanduser('~/.realestate/checkpoint.jsonl')
+_CHECKPOINT_MAX_AGE_SECS = 24 * 60 * 60
+
+# The local database of the properties and their snapshots.
+_STORE_PATH = os.path.expanduser('~/.realestate/properties.db')
+
+# Where the Google Sheets access token is kept between runs.
+_SHEETS_TOKEN_PATH = os.path.expanduser('~/.realestate/sheets_token.json')
+
+def UpdateSheet(
+  sheet_names=_SHEET_NAMES,
+  num_workers=_NUM_FETCH_WORKERS,
+  max_requests_per_sec=_MAX_REQUESTS_PER_SEC,
+  scheduler=None,
+  max_fetches=None,
+  store=None,
+  recompute_derived=False,
+  max_tries=_MAX_FETCH_TRIES,
+  checkpoint=None,
+  backend='html',
+  extract_pool=None):
   """Updates the spreadsheet with the current real-estate data.
+
+  All of the sheets are loaded first, so that a property that appears in
+  several sheets is fetched only once, and the sheets are then written
+  concurrently.
+
+  The derived attributes of a property are reevaluated when the attributes
+  they depend on change.
+
+  Args:
+    sheet_names - The names of the sheets to update.
+    num_workers - The maximum number of concurrent fetches.
+    max_requests_per_sec - The maximum request rate to any single host.
+    scheduler - If present, a RefreshScheduler that selects the properties
+                that are due for a refresh.  Otherwise every property is
+                fetched.
+    max_fetches - If present, the maximum number of properties fetched in
+                  this run.
+    store - If present, a PropertyStore in which every fetch is recorded and
+            from which the attributes that have no value in the sheets are
+            filled in.
+    recompute_derived - Whether to recompute the derived attributes of every
+                        property before writing, e.g. after a formula change.
+    max_tries - The number of times a failed fetch is tried.
+    checkpoint - If present, a RunCheckpoint in which every fetch is recorded
+                 as it completes, and from which the properties fetched
+                 before the run was resumed are taken.
+    backend - 'html' to scrape the home details pages, or 'xml' to load the
+              properties from the Zillow API (see zillow_xml_api).
+    extract_pool - If present, an ExtractPool on which the fetched pages are
+                   parsed, so that the fetch threads only do I/O.
   """
-  for sheet_name in (
-    _BUY_SHEET_NAME,
-    _RENT_SHEET_NAME,
-    ):
-    all_cells, properties = _LoadSpreadsheetData(sheet_name)
-    _LoadCurrentData(properties)
-    _WriteSpreadsheetData(sheet_name, properties, all_cells)
+  with tracing.Span('load_sheets'):
+    sheets = RunInThreads(_LoadSpreadsheetData, sheet_names)
+  all_properties = [p for _, _, properties in sheets for p in properties]
+  tracing.Count('properties', len(all_properties))
+
+  with tracing.Span('load_current_data'):
+    _LoadCurrentData(
+      all_properties,
+      num_workers,
+      max_requests_per_sec,
+      scheduler=scheduler,
+      max_fetches=max_fetches,
+      store=store,
+      max_tries=max_tries,
+      checkpoint=checkpoint,
+      backend=backend,
+      extract_pool=extract_pool)
+
+  if store:
+    with tracing.Span('load_from_store'):
+      for p in all_properties:
+        p.LoadFromStore(store)
+  if recompute_derived:
+    with tracing.Span('recompute_derived'):
+      property.RecomputeDerivedAttributes(all_properties)
+
+  def _Write(i):
+    all_cells, original_values, properties = sheets[i]
+    _WriteSpreadsheetData(sheet_names[i], properties, all_cells,
+                          original_values)
+  with tracing.Span('write_sheets'):
+    RunInThreads(_Write, range(len(sheet_names)))
 
 def _LoadSpreadsheetData(sheet_name):
   """Load the current data from the spreadsheet.
+
+  Returns:
+    A (all_cells, original_values, properties) tuple, where original_values
+    are the loaded cell values (see gsw.CellValues()).
   """
-  all_cells = gsw.LoadSpreadsheet(_SPREADSHEET_NAME, sheet_name)
-  return all_cells, property.ParseFromSpreadsheet(all_cells)
+  with tracing.Span('load_sheet', sheet=sheet_name):
+    all_cells = gsw.LoadSpreadsheet(_SPREADSHEET_NAME, sheet_name)
+  with tracing.Span('parse_sheet', sheet=sheet_name):
+    return (all_cells, gsw.CellValues(all_cells),
+            property.ParseFromSpreadsheet(all_cells))
 
-def _LoadCurrentData(properties):
+def _LoadCurrentData(
+  properties,
+  num_workers=_NUM_FETCH_WORKERS,
+  max_requests_per_sec=_MAX_REQUESTS_PER_SEC,
+  timeout_secs=_FETCH_TIMEOUT_SECS,
+  scheduler=None,
+  max_fetches=None,
+  store=None,
+  max_tries=_MAX_FETCH_TRIES,
+  checkpoint=None,
+  backend='html',
+  extract_pool=None):
   """Loads the current property details from Zillow.
+
+  Each distinct Zillow id is fetched once, by a bounded pool of worker
+  threads, and the result is merged into every property with that id, in the
+  properties' original order.  The fetches go through a FetchController, which
+  retries failed fetches and adapts the number of fetches in flight to how
+  the site responds.
+
+  Args:
+    properties - The list of Property objects to update.
+    num_workers - The maximum number of concurrent fetches. 1 fetches
+                  serially.
+    max_requests_per_sec - The maximum number of requests per second to any
+                           single host, or None for no limit.
+    timeout_secs - The number of seconds after which a single fetch is
+                   abandoned.
+    scheduler - If present, a RefreshScheduler; only the properties that it
+                finds due are fetched, and the fetches are recorded with it.
+    max_fetches - If present, the maximum number of properties to fetch.
+    store - If present, a PropertyStore in which a snapshot of each fetched
+            property is recorded.
+    max_tries - The number of times a failed fetch is tried.
+    checkpoint - If present, the RunCheckpoint of the run.
+    backend - The name of the backend from which the properties are loaded.
+    extract_pool - If present, the ExtractPool on which pages are parsed.
   """
+  zpid_to_properties = {}
   for p in properties:
-    p.LoadFromZillow()
+    zpid = p.GetZillowId()
+    if zpid:
+      zpid_to_properties.setdefault(zaw.NormalizeZpid(zpid), []).append(p)
+
+  if scheduler:
+    zpids = sorted(scheduler.SelectDue(
+      dict((zpid, ps[0].property_attributes)
+           for zpid, ps in zpid_to_properties.iteritems()),
+      max_fetches))
+  else:
+    zpids = sorted(zpid_to_properties)[:max_fetches]
+  print 'Fetching %d of %d properties' % (len(zpids), len(zpid_to_properties))
+
+  rate_limiter = net_util.HostRateLimiter(max_requests_per_sec)
+  controller = fetch_controller.FetchController(
+    initial_concurrency=min(_INITIAL_FETCH_CONCURRENCY, num_workers),
+    max_concurrency=num_workers,
+    max_tries=max_tries)
+  load_fn = _LOADERS[backend]
+  fetch_fn = lambda zpid: load_fn(
+    zpid, rate_limiter=rate_limiter, timeout_secs=timeout_secs,
+    controller=controller, extract_pool=extract_pool)
+  if checkpoint:
+    fetch_fn = _CheckpointedFetchFn(fetch_fn, checkpoint)
+  with tracing.Span('fetch_all', count=len(zpids)):
+    zillow_attrs = _FetchConcurrently(zpids, fetch_fn, num_workers)
+  print 'Fetch controller: %s' % controller.Stats()
+
+  with tracing.Span('merge'):
+    for zpid, attrs in zip(zpids, zillow_attrs):
+      zpid_properties = zpid_to_properties[zpid]
+      for p in zpid_properties:
+        p.MergeZillowAttributes(attrs)
+      if scheduler and attrs:
+        scheduler.RecordFetch(zpid, attrs)
+      if store and attrs:
+        store.RecordSnapshot(zpid, zpid_properties[0].property_attributes)
 
-def _WriteSpreadsheetData(sheet_name, properties, all_cells):
+    if scheduler:
+      scheduler.Save()
+    if store:
+      store.Commit()
+
+def _FetchConcurrently(zillow_ids, fetch_fn, num_workers):
+  """Applies fetch_fn to every zillow id using a pool of worker threads.
+
+  A fetch that fails is logged and yields None, so that it does not affect the
+  other fetches.
+
+  Returns:
+    The list of fetch_fn results, in the same order as zillow_ids.
+  """
+  results = [None] * len(zillow_ids)
+  work_queue = Queue.Queue()
+  for i, zpid in enumerate(zillow_ids):
+    if zpid:
+      work_queue.put((i, zpid))
+
+  def _Worker():
+    while True:
+      try:
+        i, zpid = work_queue.get_nowait()
+      except Queue.Empty:
+        return
+      try:
+        results[i] = fetch_fn(zpid)
+      except Exception, e:
+        print 'Failed loading: %s (%r)' % (zpid, e)
+        tracing.Count('fetch.failed')
+
+  workers = [threading.Thread(target=_Worker)
+             for _ in xrange(max(1, min(num_workers, work_queue.qsize())))]
+  for w in workers:
+    w.setDaemon(True)
+    w.start()
+  for w in workers:
+    w.join()
+
+  return results
+
+def _CheckpointedFetchFn(fetch_fn, checkpoint):
+  """Wraps fetch_fn to record each fetch in the checkpoint as soon as it
+  completes, and to take the properties fetched before the run was resumed
+  from the checkpoint instead.
+
+  Properties whose page could not be parsed are recorded to be skipped by a
+  resumed run; other failures are fetched again.
+  """
+  def _Fetch(zpid):
+    attrs = checkpoint.GetAttributes(zpid)
+    if attrs is not None:
+      tracing.Count('checkpoint.resumed')
+      return attrs
+    if checkpoint.ShouldSkip(zpid):
+      tracing.Count('checkpoint.skipped')
+      return None
+
+    try:
+      attrs = fetch_fn(zpid)
+    except zaw.ZillowParseError, e:
+      checkpoint.RecordFailure(zpid, str(e), skip=True)
+      raise
+    except Exception, e:
+      checkpoint.RecordFailure(zpid, '%s: %s' % (e.__class__.__name__, e))
+      raise
+    if attrs:
+      checkpoint.RecordFetch(zpid, attrs)
+    else:
+      checkpoint.RecordFailure(zpid, 'The page could not be fetched')
+    return attrs
+  return _Fetch
+
+def _WriteSpreadsheetData(sheet_name, properties, all_cells, original_values):
   """Write the data to the spreadsheet.
+
+  Only the cells whose values differ from original_values are sent.
+  """
+  with tracing.Span('render', sheet=sheet_name):
+    all_cells = property.RenderToSpreadsheet(properties, all_cells)
+  with tracing.Span('write_sheet', sheet=sheet_name):
+    gsw.WriteSpreadsheet(_SPREADSHEET_NAME, sheet_name, all_cells,
+                         original_values)
+
+def StreamUpdateSheet(
+  sheet_names=_SHEET_NAMES,
+  num_workers=_NUM_FETCH_WORKERS,
+  max_requests_per_sec=_MAX_REQUESTS_PER_SEC,
+  scheduler=None,
+  max_fetches=None,
+  store=None,
+  recompute_derived=False,
+  max_tries=_MAX_FETCH_TRIES,
+  checkpoint=None,
+  backend='html',
+  extract_pool=None,
+  rows_per_read=_STREAM_ROWS_PER_READ,
+  rows_per_write=_STREAM_ROWS_PER_WRITE,
+  flush_interval_secs=_STREAM_FLUSH_INTERVAL_SECS):
+  """Updates the spreadsheet like UpdateSheet(), streaming the rows through
+  the update instead of running each stage over the whole spreadsheet.
+
+  The rows of each sheet are read a window at a time, their properties are
+  fetched as they are read, and the completed rows are written back in
+  batches, so that the first rows are updated within seconds and the memory
+  used is bounded by the rows in flight rather than by the size of the
+  sheets.
+
+  Because the properties are only seen one at a time, the fetch budget of the
+  scheduler goes to the due properties in sheet order rather than to the most
+  overdue ones, and a property that appears in several sheets is fetched only
+  once as long as it's among the recent fetches.
+
+  Args:
+    The UpdateSheet() arguments, and:
+    rows_per_read - The number of rows read from a sheet per request.
+    rows_per_write - The number of completed rows written per batch.
+    flush_interval_secs - The time after which a partial batch is written.
   """
-  all_cells = property.RenderToSpreadsheet(properties, all_cells)
-  gsw.WriteSpreadsheet(_SPREADSHEET_NAME, sheet_name, all_cells)
+  rate_limiter = net_util.HostRateLimiter(max_requests_per_sec)
+  controller = fetch_controller.FetchController(
+    initial_concurrency=min(_INITIAL_FETCH_CONCURRENCY, num_workers),
+    max_concurrency=num_workers,
+    max_tries=max_tries)
+  load_fn = _LOADERS[backend]
+  fetch_fn = lambda zpid: load_fn(
+    zpid,
+    rate_limiter=rate_limiter,
+    timeout_secs=_FETCH_TIMEOUT_SECS,
+    controller=controller,
+    extract_pool=extract_pool)
+  if checkpoint:
+    fetch_fn = _CheckpointedFetchFn(fetch_fn, checkpoint)
+  pool = _FetchPool(fetch_fn, num_workers)
+  update = _StreamingUpdate(pool, 2 * num_workers, scheduler, max_fetches,
+                            store, recompute_derived)
+  try:
+    for sheet_name in sheet_names:
+      with tracing.Span('stream_sheet', sheet=sheet_name):
+        update.UpdateSheet(sheet_name, rows_per_read, rows_per_write,
+                           flush_interval_secs)
+  finally:
+    pool.Close()
+  print 'Fetched %d properties' % update.num_fetches
+  print 'Fetch controller: %s' % controller.Stats()
+
+  if scheduler:
+    scheduler.Save()
+  if store:
+    store.Commit()
+
+class _StreamingUpdate(object):
+  """The state of a StreamUpdateSheet() run, shared by its sheets.
+
+  The sheets, the scheduler and the store are only used from the calling
+  thread; only the fetches run on the pool's threads.
+  """
+
+  def __init__(self, pool, max_in_flight, scheduler, max_fetches, store,
+               recompute_derived):
+    self.pool = pool
+    self.max_in_flight = max_in_flight
+    self.scheduler = scheduler
+    self.max_fetches = max_fetches
+    self.store = store
+    self.recompute_derived = recompute_derived
+    self.num_fetches = 0
+    self.recent = _RecentFetches(_STREAM_RECENT_FETCHES)
+
+  def UpdateSheet(self, sheet_name, rows_per_read, rows_per_write,
+                  flush_interval_secs):
+    worksheet = gsw.OpenWorksheet(_SPREADSHEET_NAME, sheet_name)
+    rows = self._FetchRows(_ReadRows(worksheet, rows_per_read))
+    for batch in _Batches(rows, rows_per_write, flush_interval_secs):
+      self._WriteRows(worksheet, batch)
+
+  def _FetchRows(self, rows):
+    """Fetches the properties of the rows, keeping up to max_in_flight
+    fetches in flight.
+
+    Yields:
+      The rows, as their fetches complete, and _NO_ROW every
+      _STREAM_POLL_SECS while waiting for a fetch, so that _Batches() can
+      write a partial batch in time.
+    """
+    # zpid -> the rows waiting for its fetch
+    pending = {}
+    for r in rows:
+      if r.zpid in pending:
+        pending[r.zpid].append(r)
+        continue
+      if r.zpid in self.recent:
+        r.property.MergeZillowAttributes(self.recent.Get(r.zpid))
+        yield r
+        continue
+      if not r.zpid or not self._ShouldFetch(r.zpid, r.property):
+        yield r
+        continue
+
+      pending[r.zpid] = [r]
+      self.num_fetches += 1
+      self.pool.Submit(r.zpid)
+      while len(pending) >= self.max_in_flight:
+        for done in self._Complete(pending):
+          yield done
+    while pending:
+      for done in self._Complete(pending):
+        yield done
+
+  def _ShouldFetch(self, zpid, p):
+    if self.max_fetches is not None and self.num_fetches >= self.max_fetches:
+      return False
+    return not self.scheduler or self.scheduler.IsDue(zpid,
+                                                      p.property_attributes)
+
+  def _Complete(self, pending):
+    """Waits up to _STREAM_POLL_SECS for the next fetch to complete and
+    merges its result.
+
+    Returns:
+      The rows that were waiting for the fetch, or [_NO_ROW] if none
+      completed in time.
+    """
+    completed = self.pool.Next(_STREAM_POLL_SECS)
+    if completed is None:
+      return [_NO_ROW]
+    zpid, attrs = completed
+    rows = pending.pop(zpid)
+    self.recent.Add(zpid, attrs)
+    with tracing.Span('merge', rows=len(rows)):
+      for r in rows:
+        r.property.MergeZillowAttributes(attrs)
+      if self.scheduler and attrs:
+        self.scheduler.RecordFetch(zpid, attrs)
+      if self.store and attrs:
+        self.store.RecordSnapshot(zpid, rows[0].property.property_attributes)
+    return rows
+
+  def _WriteRows(self, worksheet, rows):
+    """Renders the rows and writes the changed cells.
+    """
+    properties = [r.property for r in rows if r.property]
+    if self.store:
+      for p in properties:
+        p.LoadFromStore(self.store)
+    if self.recompute_derived:
+      property.RecomputeDerivedAttributes(properties)
+
+    with tracing.Span('render', rows=len(rows)):
+      data_cells = {}
+      original_values = {}
+      for r in rows:
+        if r.property:
+          r.property.RenderToSpreadsheet(r.cells)
+        else:
+          attributes.RenderHeaderToSpreadsheet(r.cells)
+        data_cells[r.row] = r.cells
+        original_values.update(r.original_values)
+    with tracing.Span('write_rows', rows=len(rows)):
+      gsw.WriteCells(worksheet, data_cells, original_values)
+
+def _ReadRows(worksheet, rows_per_read):
+  """Reads the rows of the worksheet as they are consumed.
+
+  Yields:
+    A Bunch for the header row and then for each property row, with the
+    attributes row, cells, original_values (see gsw.CellValues()), property
+    (None for the header) and zpid (the normalized Zillow id, or None).
+  """
+  header = None
+  for row, cells in gsw.IterRows(worksheet, rows_per_read):
+    original_values = gsw.CellValues({row: cells})
+    if header is None:
+      header = cells
+      yield Bunch(row=row, cells=cells, original_values=original_values,
+                  property=None, zpid=None)
+      continue
+
+    p = property.Property.FromSpreadsheet(header, cells, row)
+    zpid = p.GetZillowId()
+    tracing.Count('properties')
+    yield Bunch(row=row, cells=cells, original_values=original_values,
+                property=p, zpid=zpid and zaw.NormalizeZpid(zpid))
+
+# Yielded by _StreamingUpdate._FetchRows() in place of a row while it waits
+# for a fetch.
+_NO_ROW = object()
+
+def _Batches(items, batch_size, max_wait_secs):
+  """Groups the items into lists of up to batch_size items.  A partial batch
+  is also yielded once max_wait_secs have passed since its first item, as
+  soon as the next item or _NO_ROW arrives; items yields _NO_ROW
+  periodically while it has no item, so that the batch isn't held until the
+  next item.
+  """
+  batch = []
+  start_time = None
+  for item in items:
+    if item is not _NO_ROW:
+      if not batch:
+        start_time = time.time()
+      batch.append(item)
+    if batch and (len(batch) >= batch_size or
+                  time.time() - start_time >= max_wait_secs):
+      yield batch
+      batch = []
+  if batch:
+    yield batch
+
+class _FetchPool(object):
+  """Runs fetch_fn for the Zillow ids submitted to it on a pool of worker
+  threads.  A fetch that fails is logged and yields None.
+  """
+
+  def __init__(self, fetch_fn, num_workers):
+    self._fetch_fn = fetch_fn
+    self._requests = Queue.Queue()
+    self._results = Queue.Queue()
+    self._workers = [threading.Thread(target=self._Work)
+                     for _ in xrange(max(1, num_workers))]
+    for w in self._workers:
+      w.setDaemon(True)
+      w.start()
+
+  def Submit(self, zpid):
+    self._requests.put(zpid)
+
+  def Next(self, timeout_secs=None):
+    """Waits for a fetch to complete.
+
+    Args:
+      timeout_secs - If present, the time after which to stop waiting.
+
+    Returns:
+      A (zpid, fetch_fn result) tuple, or None if no fetch completed within
+      timeout_secs.
+    """
+    try:
+      return self._results.get(timeout=timeout_secs)
+    except Queue.Empty:
+      return None
+
+  def Close(self):
+    """Stops the workers once the submitted fetches are done, and waits for
+    them to exit.
+    """
+    for _ in self._workers:
+      self._requests.put(None)
+    for w in self._workers:
+      w.join()
+
+  def _Work(self):
+    while True:
+      zpid = self._requests.get()
+      if zpid is None:
+        return
+      result = None
+      try:
+        result = self._fetch_fn(zpid)
+      except Exception, e:
+        print 'Failed loading: %s (%r)' % (zpid, e)
+        tracing.Count('fetch.failed')
+      self._results.put((zpid, result))
+
+class _RecentFetches(object):
+  """The results of the most recent fetches, up to a maximum number.
+  """
+
+  def __init__(self, max_size):
+    self._max_size = max_size
+    self._results = {}
+    self._order = collections.deque()
+
+  def __contains__(self, zpid):
+    return zpid in self._results
+
+  def Get(self, zpid):
+    return self._results[zpid]
+
+  def Add(self, zpid, result):
+    if zpid not in self._results:
+      self._order.append(zpid)
+      if len(self._order) > self._max_size:
+        del self._results[self._order.popleft()]
+    self._results[zpid] = result
+
+def _ParseArgs():
+  parser = optparse.OptionParser()
+  parser.add_option('--sheets', default=','.join(_SHEET_NAMES),
+                    help='Comma-separated names of the sheets to update.')
+  parser.add_option('--workers', type='int', default=_NUM_FETCH_WORKERS,
+                    help='Maximum number of concurrent Zillow fetches.')
+  parser.add_option('--max_tries', type='int', default=_MAX_FETCH_TRIES,
+                    help='Number of times a failed fetch is tried.')
+  parser.add_option('--max_rps', type='float', default=_MAX_REQUESTS_PER_SEC,
+                    help='Maximum requests per second to a single host '
+                         '(0 for no limit).')
+  parser.add_option('--zillow_base_url', default=zaw.DEFAULT_BASE_URL,
+                    help='Site from which the listing pages are fetched, e.g. '
+                         'a local fake_listing_server.')
+  parser.add_option('--zillow_backend', default='html',
+                    choices=sorted(_LOADERS),
+                    help='Where the properties are loaded from: html to '
+                         'scrape the home details pages, or xml to call the '
+                         'Zillow API.')
+  parser.add_option('--zws_id', default=None,
+                    help='Zillow Web Services ID for --zillow_backend xml.')
+  parser.add_option('--xml_fallback_attributes', default='',
+                    help='Comma-separated attributes that are scraped from '
+                         'the home details page when the API lacks them, '
+                         'e.g. days_on_zillow.')
+  parser.add_option('--extract_processes', type='int', default=None,
+                    help='Number of processes that parse the fetched pages '
+                         '(default: one per core; 0 to parse them on the '
+                         'fetch threads).')
+  parser.add_option('--extract_queue_depth', type='int', default=None,
+                    help='Maximum number of fetched pages waiting to be '
+                         'parsed (default: twice the number of processes).')
+  parser.add_option('--cache_dir', default=_CACHE_DIR,
+                    help='Directory of the Zillow page cache (empty to '
+                         'disable caching).')
+  parser.add_option('--cache_ttl_secs', type='int', default=_CACHE_TTL_SECS,
+                    help='Time for which a cached page is used without '
+                         'revalidation.')
+  parser.add_option('--refresh_state', default=_REFRESH_STATE_PATH,
+                    help='File in which the refresh history of the '
+                         'properties is kept.')
+  parser.add_option('--refresh_all', action='store_true', default=False,
+                    help='Fetch every property, whether or not it is due.')
+  parser.add_option('--max_fetches', type='int', default=None,
+                    help='Maximum number of properties to fetch in this run.')
+  parser.add_option('--recompute_only', action='store_true', default=False,
+                    help='Fetch nothing; only recompute the derived '
+                         'attributes of every property.')
+  parser.add_option('--stream', action='store_true', default=False,
+                    help='Stream the rows through the update, writing them '
+                         'back in batches as they complete.')
+  parser.add_option('--rows_per_write', type='int',
+                    default=_STREAM_ROWS_PER_WRITE,
+                    help='Number of completed rows written per batch with '
+                         '--stream.')
+  parser.add_option('--trace', default=None,
+                    help='File to which a Chrome trace of the run is written; '
+                         'a summary of the run is also printed.')
+  parser.add_option('--checkpoint', default=_CHECKPOINT_PATH,
+                    help='File in which the fetches of the run are recorded, '
+                         'so that a run that dies is resumed by the next one '
+                         '(empty to disable).')
+  parser.add_option('--checkpoint_max_age_secs', type='int',
+                    default=_CHECKPOINT_MAX_AGE_SECS,
+                    help='Age after which the checkpoint of a run that died '
+                         'is discarded instead of resumed.')
+  parser.add_option('--store', default=_STORE_PATH,
+                    help='SQLite database of the properties and their history '
+                         '(empty to disable).')
+  parser.add_option('--sheets_token_cache', default=_SHEETS_TOKEN_PATH,
+                    help='File in which the Google Sheets access token is '
+                         'kept, so that runs within its lifetime skip '
+                         'authorization (empty to disable).')
+  options, _ = parser.parse_args()
+  if options.max_tries < 1:
+    parser.error('--max_tries must be at least 1.')
+  return options
 
 if __name__ == '__main__':
-  gsw.Initialize()
-  zaw.Initialize()
+  options = _ParseArgs()
+  if options.trace:
+    tracing.Enable()
+
+  gsw.Initialize(token_cache_path=options.sheets_token_cache or None)
+  zaw.Initialize(
+    cache_dir=options.cache_dir,
+    cache_ttl_secs=options.cache_ttl_secs,
+    base_url=options.zillow_base_url)
+  if options.zillow_backend == 'xml':
+    if not options.zws_id:
+      raise SystemExit('--zillow_backend xml requires --zws_id')
+    zillow_xml_api.Initialize(
+      options.zws_id,
+      base_url=options.zillow_base_url,
+      fallback_attributes=filter(None,
+                                 options.xml_fallback_attributes.split(',')))
+
+  scheduler = None
+  if not options.refresh_all:
+    scheduler = refresh_scheduler.RefreshScheduler(options.refresh_state)
+
+  store = None
+  if options.store:
+    store = property_store.PropertyStore(options.store)
+
+  # Created before any threads are started, since its processes are forked,
+  # and only for the runs that parse pages: the XML backend scrapes few, and
+  # a recompute fetches none.
+  pool = None
+  if (options.extract_processes != 0 and options.zillow_backend == 'html' and
+      not options.recompute_only and options.max_fetches != 0):
+    pool = ep.ExtractPool(
+      num_processes=options.extract_processes,
+      max_pending=options.extract_queue_depth)
+
+  checkpoint = None
+  if options.checkpoint:
+    checkpoint = run_checkpoint.RunCheckpoint(
+      options.checkpoint, max_age_secs=options.checkpoint_max_age_secs)
+
+  update_args = dict(
+    sheet_names=options.sheets.split(','),
+    num_workers=options.workers,
+    max_requests_per_sec=options.max_rps,
+    scheduler=scheduler,
+    max_fetches=0 if options.recompute_only else options.max_fetches,
+    store=store,
+    recompute_derived=options.recompute_only,
+    max_tries=options.max_tries,
+    checkpoint=checkpoint,
+    backend=options.zillow_backend,
+    extract_pool=pool)
+  try:
+    if options.stream:
+      StreamUpdateSheet(rows_per_write=options.rows_per_write, **update_args)
+    else:
+      UpdateSheet(**update_args)
+  finally:
+    if pool:
+      pool.Close()
+
+  if checkpoint:
+    failures = checkpoint.Failures()
+    for zpid, error in sorted(failures.iteritems()):
+      print 'Failed: %s (%s)' % (zpid, error)
+    print '%d properties failed' % len(failures)
+    checkpoint.Complete()
 
-  UpdateSheet()
+  if options.trace:
+    tracing.WriteChromeTrace(options.trace)
+    print tracing.Summary()
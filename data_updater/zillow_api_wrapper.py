@@ -5,10 +5,44 @@
 
 import attributes
 
-from bs4 import BeautifulSoup
+import http_cache
 from misc_util import Bunch
 import net_util
 import string
+import tracing
+
+# The site from which the home details pages are fetched.
+DEFAULT_BASE_URL = 'http://www.zillow.com'
+_BASE_URL = DEFAULT_BASE_URL
+
+# The on-disk cache through which the home details pages are fetched, if any.
+_HTTP_CACHE = None
+
+# Whether to build the parse tree only for the parts of the page that are read.
+_PARTIAL_PARSE = True
+
+def _IsExtractedTag(name, attrs):
+  """Matches the tags whose subtrees are read when extracting a property: the
+  meta tags and the main content div.
+  """
+  if name == 'meta':
+    return 'property' in attrs
+  return name == 'div' and attrs.get('role') == 'main'
+
+# The SoupStrainer of the extracted tags, once _ExtractedTags() has made it.
+_EXTRACTED_TAGS = None
+
+def _ExtractedTags():
+  global _EXTRACTED_TAGS
+  if _EXTRACTED_TAGS is None:
+    from bs4 import SoupStrainer
+    _EXTRACTED_TAGS = SoupStrainer(_IsExtractedTag)
+  return _EXTRACTED_TAGS
+
+class ZillowParseError(ValueError):
+  """Raised for a home details page from which the property can't be
+  extracted, e.g. after a change of the page layout.
+  """
 
 def ws(text):
   """Clean up whitespace in provided text.
@@ -20,50 +54,167 @@ def fb_meta(bs, name):
   """
   return bs.find('meta', {'property':name}).attrs['content']
 
-def Initialize():
+def Initialize(cache_dir=None, cache_ttl_secs=http_cache.DEFAULT_TTL_SECS,
+               cache_max_size_bytes=http_cache.DEFAULT_MAX_SIZE_BYTES,
+               partial_parse=True, base_url=DEFAULT_BASE_URL):
   """Initializes the Zillow API wrapper.
-  """
-  pass
 
-def LoadZillowProperty(zpid):
+  Args:
+    cache_dir - If present, the directory of a persistent cache for the fetched
+                pages.  Pages fetched less than cache_ttl_secs ago are served
+                from the cache, and older ones are revalidated with Zillow.
+    cache_ttl_secs - The time for which a cached page is served as-is.
+    cache_max_size_bytes - The size bound of the cache.
+    partial_parse - Whether to parse only the meta tags and the main content of
+                    the pages (the default), rather than the whole document.
+    base_url - The site from which the pages are fetched, e.g. the URL of a
+               fake_listing_server for testing.
+  """
+  global _BASE_URL, _HTTP_CACHE, _PARTIAL_PARSE
+  _BASE_URL = base_url.rstrip('/')
+  _PARTIAL_PARSE = partial_parse
+  if cache_dir:
+    _HTTP_CACHE = http_cache.HttpCache(
+      cache_dir,
+      default_ttl_secs=cache_ttl_secs,
+      max_size_bytes=cache_max_size_bytes)
+  else:
+    _HTTP_CACHE = None
+
+def LoadZillowProperty(zpid, rate_limiter=None, timeout_secs=None,
+                       controller=None, extract_pool=None):
   """Loads the information for the provided property.
 
   Args:
     zpid - Zillow property id.
+    rate_limiter - If present, a net_util.HostRateLimiter that is waited on
+                   before the page is requested.
+    timeout_secs - If present, the number of seconds after which to timeout the
+                   page request.
+    controller - If present, a fetch_controller.FetchController that retries
+                 the request and limits the concurrent requests.
+    extract_pool - If present, an extract_pool.ExtractPool on which the page
+                   is parsed, instead of on the calling thread.
 
   Returns:
-    A Bunch with the property attributes.
+    The PropertyAttributes of the property, or None if the page could not be
+    fetched.
+
+  Raises:
+    ZillowParseError if the fetched page could not be parsed.
   """
   print 'Loading: ', zpid
-  if '_' in zpid:
-    zpid = zpid.split('_')[0]
-  url = 'http://www.zillow.com/homedetails/%s_zpid/' % zpid
+  with tracing.Span('fetch', zpid=zpid) as span:
+    c = FetchUrl(_PropertyUrl(zpid), rate_limiter, timeout_secs, controller)
+    span.Set('status', c.status_code)
+
+  with tracing.Span('parse', zpid=zpid):
+    return _ParseFetchResult(c, extract_pool)
+
+def FetchUrl(url, rate_limiter=None, timeout_secs=None, controller=None):
+  """Fetches a Zillow URL through the page cache set by Initialize().
+
+  Args:
+    The LoadZillowProperty() arguments, with the URL in place of the zpid.
+
+  Returns:
+    The net_util.GenericFetchFromUrlToString() result.
+  """
+  if _HTTP_CACHE:
+    # Fresh pages are served without a request, so they neither wait for the
+    # rate limiter nor take one of the controller's slots.
+    c = net_util.FetchFromCache(url, _HTTP_CACHE)
+    if c:
+      return c
+
+  def _Fetch():
+    return net_util.GenericFetchFromUrlToString(
+      url,
+      user_agent=net_util.CHROME_USER_AGENT,
+      timeout_secs=timeout_secs,
+      cache=_HTTP_CACHE)
+
+  if controller:
+    return controller.Fetch(url, _Fetch, rate_limiter)
+  if rate_limiter:
+    with tracing.Span('fetch.rate_limit_wait'):
+      rate_limiter.Wait(url)
+  return _Fetch()
+
+def NormalizeZpid(zpid):
+  """Returns the bare Zillow property id for an id as entered in the sheet,
+  e.g. '24838363' for '24838363_zpid'.
+  """
+  return zpid.split('_')[0].strip()
 
-  c = net_util.GenericFetchFromUrlToString(
-    url,
-    user_agent=net_util.CHROME_USER_AGENT)
+def _PropertyUrl(zpid):
+  """Returns the Zillow home details URL for the provided property id.
+  """
+  return '%s/homedetails/%s_zpid/' % (_BASE_URL, NormalizeZpid(zpid))
 
+def _ParseFetchResult(c, extract_pool=None):
+  """Parses the property attributes out of a fetched home details page, on
+  the extract_pool if one is provided.
+  """
   if c.status_code != 200:
     return None
 
-  bs = BeautifulSoup(c.body)
+  if extract_pool:
+    return extract_pool.Extract(c.body)
+  return ParseZillowPage(c.body)
+
+def ParseZillowPage(body, partial_parse=None, derive=True):
+  """Extracts the property attributes from the HTML of a home details page.
+
+  Args:
+    body - The page HTML.
+    partial_parse - Whether to build the parse tree only for the meta tags and
+                    the main content div, which are the only parts of the page
+                    that are read.  Defaults to the mode set by Initialize().
+    derive - Whether to evaluate the derived attributes, or to return only the
+             attributes extracted from the page.
+
+  Returns:
+    The PropertyAttributes of the property.
+
+  Raises:
+    ZillowParseError if the page doesn't have the expected structure.
+  """
+  if partial_parse is None:
+    partial_parse = _PARTIAL_PARSE
+  # Imported here, as bs4 is slow to import and only needed once pages are
+  # parsed.
+  from bs4 import BeautifulSoup
+  with tracing.Span('parse.soup'):
+    if partial_parse:
+      bs = BeautifulSoup(body, parse_only=_ExtractedTags())
+    else:
+      bs = BeautifulSoup(body)
 
+  try:
+    entity_info = _ExtractEntityInfo(bs)
+  except (AttributeError, IndexError, KeyError), e:
+    # A tag or attribute that the extraction relies on is missing.
+    raise ZillowParseError('Unexpected home details page: %r' % e)
+
+  property_attributes = _ToPropertyAttributes(entity_info)
+  if derive:
+    with tracing.Span('parse.derive'):
+      property_attributes.UpdateDerivedAttributes()
+  return property_attributes
+
+def _ExtractEntityInfo(bs):
+  """Extracts the bag of entity_info attributes from the parsed page.
+  """
   main = bs.find('div', role='main')
 
   entity_info = Bunch()
   entity_info.address = fb_meta(bs, 'og:zillow_fb:address')
 
   bbs = main.findAll('span', class_='addr_bbs')
-  try:
-    entity_info.beds = fb_meta(bs, 'zillow_fb:beds')
-    entity_info.bath = fb_meta(bs, 'zillow_fb:baths')
-    entity_info.sqft = ws(bbs[2].text)
-  except Exception:
-    import code
-    vars = globals()
-    vars.update(locals())
-    shell = code.InteractiveConsole(vars)
-    shell.interact()
+  entity_info.beds = fb_meta(bs, 'zillow_fb:beds')
+  entity_info.bath = fb_meta(bs, 'zillow_fb:baths')
+  entity_info.sqft = ws(bbs[2].text)
 
   price_info = main.find('div', {'id':'home-value-wrapper'})
   entity_info.status = ws(price_info.find('div', class_='status-icon-row').text)
@@ -77,17 +228,16 @@ def LoadZillowProperty(zpid):
   facts_div = main.find('div', class_='hdp-facts')
   entity_info.facts = '; '.join([ws(f.text) for f in facts_div.findAll('li')])
 
-  _PopulateFromFacts([ws(f.text) for f in facts_div.findAll('li')], entity_info)
-
-  _PopulateDerivedAttributes(entity_info)
+  with tracing.Span('parse.facts'):
+    _PopulateFromFacts([ws(f.text) for f in facts_div.findAll('li')],
+                       entity_info)
 
   for attr in ('description', 'facts'):
     val = getattr(entity_info, attr, None)
     if val:
       val = filter(lambda x: x in string.printable, val)
     setattr(entity_info, attr, val)
-
-  return _ToPropertyAttributes(entity_info)
+  return entity_info
 
 
 _ALL_FACT_NAMES = [fp.name for fp in attributes.ALL_FACT_PARSERS]
@@ -95,24 +245,9 @@ _ALL_FACT_NAMES = [fp.name for fp in attributes.ALL_FACT_PARSERS]
 def _PopulateFromFacts(facts_list, entity_info):
   """Populates specific facts from the provided list on the webpage.
   """
+  values = attributes.FACT_MATCHER.MatchAll(facts_list)
   for name in _ALL_FACT_NAMES:
-    setattr(entity_info, name, '')
-
-  for fact in facts_list:
-    for parser in attributes.ALL_FACT_PARSERS:
-      x = parser.Parse(fact)
-      if x:
-        setattr(entity_info, parser.name, x)
-
-def _PopulateDerivedAttributes(entity_info):
-  """Populates attributes derived from the scraped data.
-  """
-  for a in attributes.ALL_DERIVED_ATTRIBUTES:
-    setattr(entity_info, a.name, '')
-
-  for a in attributes.ALL_DERIVED_ATTRIBUTES:
-    vals = [getattr(entity_info, requested, '') for requested in a.attrs]
-    setattr(entity_info, a.name, a.fn(*vals))
+    setattr(entity_info, name, values.get(name, ''))
 
 def _ToPropertyAttributes(entity_info):
   """Convert the provided bag of entity_info attributes to a Property object.
@@ -120,14 +255,7 @@ def _ToPropertyAttributes(entity_info):
   :param entity_info:
   :return:
   """
-  attrs = []
-  for k in entity_info.keys():
-    if k in attributes.NAME_TO_ATTRIBUTE:
-      attrs.append(attributes.PropertyAttributeWithValue(
-        attributes.NAME_TO_ATTRIBUTE[k],
-        getattr(entity_info, k)))
-
-  return attributes.PropertyAttributes(attrs)
+  return attributes.FromDict(entity_info.ToDict())
 
 if __name__ == '__main__':
 
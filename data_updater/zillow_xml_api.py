@@ -0,0 +1,321 @@
+"""Loads the property details from the Zillow API instead of the home details
+pages.
+
+Each property is loaded with two small XML requests: GetUpdatedPropertyDetails
+by Zillow id, for the listing and the home facts, and GetDeepSearchResults by
+the address that it returns, for the Zestimate and the last sale.  The
+responses are parsed with iterparse, clearing each element once it's read.
+
+The attributes that the API doesn't have, such as the days on Zillow, are
+left unset, so that the values already in the sheet are kept, unless they're
+listed in Initialize(fallback_attributes=...), in which case they're scraped
+from the home details page.  A property that the API can't return at all is
+scraped entirely.
+"""
+
+import cStringIO
+import string
+import time
+import urllib
+
+import attributes
+import tracing
+import zillow_api_wrapper as zaw
+
+# The site of the API; its endpoints are under /webservice/.
+DEFAULT_BASE_URL = zaw.DEFAULT_BASE_URL
+_BASE_URL = DEFAULT_BASE_URL
+
+# The Zillow Web Services ID with which the API is called.
+_ZWS_ID = None
+
+# The names of the attributes that are scraped from the home details page
+# when the API doesn't return them.
+_FALLBACK_ATTRIBUTES = ()
+
+# The message code of a successful API request.
+_CODE_OK = '0'
+
+def Initialize(zws_id, base_url=DEFAULT_BASE_URL, fallback_attributes=()):
+  """Initializes the API backend.  The page cache and the scraping fallback
+  are set up by zillow_api_wrapper.Initialize().
+
+  Args:
+    zws_id - The Zillow Web Services ID.
+    base_url - The site of the API, e.g. the URL of a fake_listing_server for
+               testing.
+    fallback_attributes - The names of the attributes to scrape from the home
+                          details page when the API doesn't return them.
+
+  Raises:
+    ValueError for an unknown attribute name.
+  """
+  for name in fallback_attributes:
+    if name not in attributes.NAME_TO_INDEX:
+      raise ValueError('Unknown attribute: %s' % name)
+
+  global _BASE_URL, _FALLBACK_ATTRIBUTES, _ZWS_ID
+  _ZWS_ID = zws_id
+  _BASE_URL = base_url.rstrip('/')
+  _FALLBACK_ATTRIBUTES = tuple(fallback_attributes)
+
+def LoadZillowProperty(zpid, rate_limiter=None, timeout_secs=None,
+                       controller=None, extract_pool=None):
+  """Loads the information for the provided property from the API, like
+  zillow_api_wrapper.LoadZillowProperty() does from its page.
+
+  Returns:
+    The PropertyAttributes of the property, or None if it could not be
+    fetched.
+
+  Raises:
+    ZillowParseError if a response could not be parsed.
+  """
+  print 'Loading: ', zpid
+  zpid = zaw.NormalizeZpid(zpid)
+  fetch_args = dict(rate_limiter=rate_limiter, timeout_secs=timeout_secs,
+                    controller=controller)
+  scrape_args = dict(fetch_args, extract_pool=extract_pool)
+
+  details = _Call('GetUpdatedPropertyDetails', [('zpid', zpid)], 'response',
+                  fetch_args)
+  if not details:
+    tracing.Count('xml.scraped')
+    return zaw.LoadZillowProperty(zpid, **scrape_args)
+  values = _DetailsValues(details[0])
+
+  street, city_state_zip = _SearchAddress(details[0])
+  if street and city_state_zip:
+    results = _Call('GetDeepSearchResults',
+                    [('address', street), ('citystatezip', city_state_zip)],
+                    'response/results/result', fetch_args)
+    if results:
+      matching = [r for r in results if r.get('zpid') == zpid]
+      _AddSearchValues((matching or results)[0], values)
+
+  missing = [name for name in _FALLBACK_ATTRIBUTES if not values.get(name)]
+  if missing:
+    _AddPageValues(zpid, missing, values, scrape_args)
+
+  property_attributes = attributes.FromDict(values)
+  with tracing.Span('parse.derive'):
+    property_attributes.UpdateDerivedAttributes()
+  return property_attributes
+
+def _Call(name, params, record_path, fetch_args):
+  """Calls an API endpoint.
+
+  Args:
+    name - The name of the endpoint, e.g. 'GetUpdatedPropertyDetails'.
+    params - The list of (name, value) query parameters, other than the
+             ZWSID.
+    record_path - The path of the elements of the response to return (see
+                  _ParseResponse()).
+    fetch_args - The zaw.FetchUrl() arguments.
+
+  Returns:
+    The records of the response, or None if the request failed.
+
+  Raises:
+    ZillowParseError if the response is not well-formed.
+  """
+  if not _ZWS_ID:
+    raise ValueError('zillow_xml_api.Initialize() has not been called')
+  url = '%s/webservice/%s.htm?%s' % (
+    _BASE_URL, name, urllib.urlencode([('zws-id', _ZWS_ID)] + params))
+  with tracing.Span('fetch.xml', call=name) as span:
+    c = zaw.FetchUrl(url, **fetch_args)
+    span.Set('status', c.status_code)
+  if c.status_code != 200:
+    return None
+
+  with tracing.Span('parse.xml', call=name):
+    try:
+      code, message, records = _ParseResponse(c.body, record_path)
+    except SyntaxError, e:
+      raise zaw.ZillowParseError('Malformed %s response: %s' % (name, e))
+  if code != _CODE_OK:
+    print 'Zillow API %s failed: %s (%s)' % (name, message, code)
+    tracing.Count('xml.api_errors')
+    return None
+  return records
+
+def _ParseResponse(body, record_path):
+  """Parses an API response, clearing each element once it has been read.
+
+  Args:
+    body - The XML of the response.
+    record_path - The path, below the root element, of the elements to
+                  return, e.g. 'response/results/result'.
+
+  Returns:
+    A (message code, message text, records) tuple, where each record is a
+    dict of the text of the elements within one record element, keyed by
+    their path below it, e.g. {'zpid': '48749425', 'zestimate/amount': ...}.
+  """
+  import xml.etree.cElementTree as ElementTree
+
+  record_parts = record_path.split('/')
+  code = message = None
+  records = []
+  record = None
+  # The tags of the elements enclosing the current one, below the root.
+  path = []
+  depth = 0
+  for event, elem in ElementTree.iterparse(cStringIO.StringIO(body),
+                                           events=('start', 'end')):
+    if event == 'start':
+      if depth:
+        path.append(elem.tag)
+        if path == record_parts:
+          record = {}
+      depth += 1
+      continue
+
+    text = (elem.text or '').strip()
+    if record is not None and len(path) > len(record_parts):
+      record['/'.join(path[len(record_parts):])] = text
+    elif path == ['message', 'code']:
+      code = text
+    elif path == ['message', 'text']:
+      message = text
+    elif path == record_parts:
+      records.append(record)
+      record = None
+
+    if path:
+      path.pop()
+    depth -= 1
+    elem.clear()
+  return code, message, records
+
+def _Commas(number):
+  """Returns e.g. '1,398,000' for '1398000', or number itself if it isn't a
+  number.
+  """
+  try:
+    digits = str(int(float(number)))
+  except ValueError:
+    return number
+  groups = []
+  while len(digits) > 3:
+    groups.insert(0, digits[-3:])
+    digits = digits[:-3]
+  groups.insert(0, digits)
+  return ','.join(groups)
+
+def _Dollars(amount):
+  return '$%s' % _Commas(amount)
+
+# (attribute name, path, format) of the values of a GetUpdatedPropertyDetails
+# response.
+_DETAILS_FIELDS = [
+  ('beds', 'editedFacts/bedrooms', None),
+  ('bath', 'editedFacts/bathrooms', None),
+  ('sqft', 'editedFacts/finishedSqFt', lambda v: '%s sqft' % _Commas(v)),
+  ('lot_size', 'editedFacts/lotSizeSqFt', _Commas),
+  ('built_year', 'editedFacts/yearBuilt', None),
+  ('last_remodel', 'editedFacts/yearUpdated', None),
+  ('stories', 'editedFacts/numFloors', None),
+  ('room_count', 'editedFacts/numRooms', None),
+  ('parking', 'editedFacts/parkingType', None),
+  ('heating', 'editedFacts/heatingSystem', None),
+  ('cooling', 'editedFacts/coolingSystem', None),
+  ('description', 'homeDescription',
+   lambda v: filter(lambda x: x in string.printable, zaw.ws(v))),
+  ('views', 'pageViewCount/total', _Commas),
+]
+
+# The same for the values of a GetDeepSearchResults result, which are only
+# used for the attributes that the details don't have.
+_SEARCH_FIELDS = [
+  ('estimate', 'zestimate/amount', _Dollars),
+  ('beds', 'bedrooms', None),
+  ('bath', 'bathrooms', None),
+  ('sqft', 'finishedSqFt', lambda v: '%s sqft' % _Commas(v)),
+  ('lot_size', 'lotSizeSqFt', _Commas),
+  ('built_year', 'yearBuilt', None),
+]
+
+# posting/status -> the status shown on the home details page.
+_STATUSES = {
+  'active': 'For Sale',
+  'pending': 'Pending',
+}
+
+def _DetailsValues(details):
+  """Returns a dict of attribute name -> value of a property's details.  The
+  attributes that the details lack are left out, so that the values already
+  in the sheet are kept.
+  """
+  values = {}
+  for name, path, format_fn in _DETAILS_FIELDS:
+    value = details.get(path)
+    if value:
+      values[name] = format_fn(value) if format_fn else value
+
+  address = details.get('address/street')
+  if address:
+    city_state_zip = _CityStateZip(details)
+    values['address'] = ('%s, %s' % (address, city_state_zip)
+                         if city_state_zip else address)
+
+  posting_status = details.get('posting/status')
+  if posting_status:
+    values['status'] = _STATUSES.get(posting_status.lower(), posting_status)
+    if details.get('price'):
+      values['price'] = _Dollars(details['price'])
+  else:
+    # A property without a posting isn't for sale, and has no price, as on
+    # its home details page.
+    values['status'] = 'Off Market'
+    values['price'] = ''
+  return values
+
+def _AddSearchValues(result, values):
+  """Adds the values of a deep search result that values doesn't have.
+  """
+  for name, path, format_fn in _SEARCH_FIELDS:
+    value = result.get(path, '')
+    if value and not values.get(name):
+      values[name] = format_fn(value) if format_fn else value
+
+  sold_date = result.get('lastSoldDate')
+  sold_price = result.get('lastSoldPrice')
+  if sold_date and sold_price and not values.get('last_sold'):
+    try:
+      sold = time.strftime('%b %Y', time.strptime(sold_date, '%m/%d/%Y'))
+    except ValueError:
+      sold = sold_date
+    values['last_sold'] = '%s for %s' % (sold, _Dollars(sold_price))
+
+def _AddPageValues(zpid, names, values, scrape_args):
+  """Adds the named attributes from the home details page, if they're on it.
+  """
+  tracing.Count('xml.page_fallbacks')
+  try:
+    page_attrs = zaw.LoadZillowProperty(zpid, **scrape_args)
+  except zaw.ZillowParseError, e:
+    print 'Failed scraping %s for %s: %s' % (zpid, ', '.join(names), e)
+    return
+  if not page_attrs:
+    return
+  for name in names:
+    if page_attrs.HasValue(name):
+      values[name] = page_attrs.GetValue(name)
+
+def _SearchAddress(details):
+  """Returns the (address, citystatezip) parameters of a deep search for the
+  property of the details.
+  """
+  return details.get('address/street', ''), _CityStateZip(details)
+
+def _CityStateZip(details):
+  """Returns e.g. 'Palo Alto, CA 94303', or '' if the details lack the city.
+  """
+  city = details.get('address/city', '')
+  if not city:
+    return ''
+  state_zip = ' '.join(v for v in (details.get('address/state', ''),
+                                   details.get('address/zipcode', '')) if v)
+  return '%s, %s' % (city, state_zip) if state_zip else city